@@ -1,20 +1,29 @@
 import os
+import json
+import time
+import asyncio
+from itertools import islice
+from collections import deque
 from dotenv import load_dotenv
 from argparse import ArgumentParser
 
 import llm
 import utils
-from promts import get_system_prompt
+import router
+import metrics
+import config
+from context import ContextBuilder
+from promts import ROLES, get_system_prompt, get_static_prompt
 
 
-def cli_arguments_preprocess() -> str:
+def cli_arguments_preprocess():
     parser = ArgumentParser(description="A script for asking LLM a question about the lore of the game S.T.A.L.K.E.R.")
 
-    parser.add_argument('question',
+    parser.add_argument('question', nargs="?", default=None,
                         help='Question for LLM')
 
     parser.add_argument("--model_type", required=True,
-                      help="Type of model: gigachat-remote/deepseek-remote/local")
+                      help="Type of model: gigachat-remote/deepseek-remote/local/router")
     
     parser.add_argument("--model_name", required=False, default=None,
                       help="Name of model like GigaChat-Pro or Hugging Face model (in local model case)")
@@ -22,77 +31,467 @@ def cli_arguments_preprocess() -> str:
     parser.add_argument("--role", required=False, default="default",
                       help="Role of the model (default/bandit)")
 
+    parser.add_argument("--no_stream", action="store_true",
+                      help="Print the answer only when it is fully generated")
+
+    parser.add_argument("--questions_file", "--questions-file", required=False, default=None,
+                      help="JSONL file with questions ({\"question\": ..., \"id\": ..., \"role\": ...} per line) "
+                           "to answer in bulk instead of a single question")
+
+    parser.add_argument("--output", required=False, default=None,
+                      help="JSONL file for bulk answers (default: <questions_file>.answers.jsonl). "
+                           "Questions already answered in it are skipped, so an interrupted run can be resumed")
+
+    parser.add_argument("--concurrency", required=False, type=int, default=config.BULK_CONCURRENCY,
+                      help="Number of simultaneous LLM requests in bulk mode")
+
+    parser.add_argument("--profile", action="store_true",
+                      help=f"Profile the run and print the report to stderr (profiler: {config.PROFILER})")
+
+    parser.add_argument("--profile_output", required=False, default=None,
+                      help="File for the full profiler report (.prof for cProfile, .html for pyinstrument)")
+
     args = parser.parse_args()
 
-    return args.question, args.model_type, args.model_name, args.role
+    if (args.question is None) == (args.questions_file is None):
+        parser.error("either a question or --questions_file is required")
+
+    return args
+
+
+def create_llm(model_type: str, model_name=None) -> llm.LLM:
+    """
+    Создает модель по типу: local, gigachat-remote, deepseek-remote или router - маршрутизатор
+    между моделями config.ROUTER_BACKENDS (model_name для него не используется)
+    """
+    if model_type == "local":
+        return llm.LocalLLM(model_name or "ai-forever/ruGPT-3.5-13B")
+    elif model_type == "gigachat-remote":
+        scope = os.getenv("SBER_SCOPE")
+        authorization_key = os.getenv("SBER_API_KEY")
+
+        if not scope or not authorization_key:
+            raise ValueError("API URL, scope, or authorization key is not set in environment variables.")
+
+        # Адреса API можно переопределить в .env, например, для локальной заглушки gigachat_stub.py
+        return llm.RemoteGigaChatLLM(
+            model_name=model_name or "GigaChat",
+            scope=scope,
+            authorization_key=authorization_key,
+            auth_url=os.getenv("SBER_AUTH_URL", config.SBER_AUTH_URL),
+            api_url=os.getenv("GIGACHAT_API_URL", config.GIGACHAT_API_URL)
+        )
+    elif model_type == "deepseek-remote":
+        api_key = os.getenv("DEEPSEEK_API_KEY")
+
+        return llm.RemoteDeepseekLLM(
+            api_key=api_key
+        )
+    elif model_type == "router":
+        return router.RouterLLM({backend: create_llm(backend) for backend in config.ROUTER_BACKENDS})
+    else:
+        raise ValueError(f"Model type {model_type} not realized yet")
 
 
 class RAGAssistant:
-    def __init__(self, model_type="deepseek-remote", model_name=None):
+    def __init__(self, model_type="deepseek-remote", model_name=None, use_answer_cache=config.ANSWER_CACHE_ENABLED):
         load_dotenv()
-        self.model = None
-
-        if model_type == "local":
-            if not model_name:
-                model_name = "ai-forever/ruGPT-3.5-13B"
-
-            self.model = llm.LocalLLM(model_name)
-        elif model_type == "gigachat-remote":
-            scope = os.getenv("SBER_SCOPE")
-            authorization_key = os.getenv("SBER_API_KEY")
-
-            if not scope or not authorization_key:
-                raise ValueError("API URL, scope, or authorization key is not set in environment variables.")
-
-            if not model_name:
-                model_name = "GigaChat"
-            
-            self.model = llm.RemoteGigaChatLLM(
-                model_name=model_name,
-                scope=scope,
-                authorization_key=authorization_key
-            )
-        elif model_type == "deepseek-remote":
-            api_key = os.getenv("DEEPSEEK_API_KEY")
-
-            self.model = llm.RemoteDeepseekLLM(
-                api_key=api_key
-            )
-        else:
-            raise ValueError(f"Model type {model_type} not realized yet")
+
+        self.model = create_llm(model_type, model_name)
 
         self.db_worker = utils.get_db_worker()
 
-    def generate_answer(self, question, role="default"):
-        results = self.db_worker.search(question, top_k=5)
-        context_documents = []
+        # Ответы разных моделей на один вопрос различаются, поэтому модель входит в ключ кэша ответов
+        self.model_key = f"{model_type}:{model_name or ''}"
+        self.answer_cache = utils.get_answer_cache(self.db_worker.embedder) if use_answer_cache else None
+
+        max_tokens = config.CONTEXT_TOKEN_BUDGETS.get(model_type, config.CONTEXT_MAX_TOKENS)
+        # Полные тексты статей (после filldb.py) позволяют брать короткие статьи в контекст целиком
+        self.context_builder = ContextBuilder(self.model.token_counter(), max_tokens,
+                                              utils.get_document_store(create=False))
+
+        # Статические части промптов ролей - общий префикс всех запросов, модель кэширует его заранее
+        for role in ROLES:
+            self.model.cache_prompt_prefix(get_static_prompt(role))
+
+    def retrieve(self, question, top_k=config.CONTEXT_TOP_K):
+        """
+        Ищет документы, релевантные вопросу
+        """
+        with metrics.span("retrieve"):
+            return self.db_worker.search(question, top_k=top_k)
+
+    def build_prompt(self, question, results, role="default"):
+        """
+        Собирает системный промпт из найденных документов: чанки одной статьи склеиваются под её заголовком,
+        контекст ограничен бюджетом токенов модели
+        """
+        with metrics.span("prompt_build"):
+            context = self.context_builder.build(results)
+            return get_system_prompt(question, context, role)
+
+    def cached_entry(self, question, role="default", vector=None):
+        """
+        :param vector: эмбеддинг вопроса, если уже посчитан
+        :return: сохраненный ответ на близкий по смыслу вопрос вместе с id статей (см. SemanticAnswerCache.get_entry) или None
+        """
+        if self.answer_cache is None:
+            return None
+
+        with metrics.span("answer_cache"):
+            if vector is None:
+                vector = self.db_worker.embed_query(question)
+
+            return self.answer_cache.get_entry(vector, role, self.model_key)
+
+    def cached_answer(self, question, role="default", vector=None):
+        """
+        :param vector: эмбеддинг вопроса, если уже посчитан
+        :return: сохраненный ответ на близкий по смыслу вопрос или None
+        """
+        entry = self.cached_entry(question, role, vector)
+        return entry.get("answer") if entry is not None else None
+
+    def cache_answer(self, question, answer, results, role="default", vector=None):
+        """
+        Сохраняет ответ в кэш вместе с id статей, по которым он получен
+        """
+        if self.answer_cache is None or not answer:
+            return
+
+        if vector is None:
+            vector = self.db_worker.embed_query(question)
+
+        self.answer_cache.put(vector, role, self.model_key, question, answer, sorted(source_wiki_ids(results)))
 
-        for r in results:
-            context_documents.append(
-                f"{r.payload.get('title', '')}: {r.payload.get('content', '')}"
-            )
+    def prepare_batch(self, questions, roles, top_k=config.CONTEXT_TOP_K):
+        """
+        Готовит пачку вопросов к генерации: вопросы векторизуются одним батчем, для каждого ищется сохраненный ответ,
+        а документы для остальных находятся одним пакетным запросом к хранилищу
+        :return: список троек (эмбеддинг вопроса, сохраненный ответ (см. cached_entry) или None, результаты поиска или None)
+        """
+        vectors = self.db_worker.embed_queries(questions)
+        cached = [self.cached_entry(question, role, vector) for question, role, vector in zip(questions, roles, vectors)]
+        results = [None] * len(questions)
 
-        context = "\n".join(context_documents)
-        system_prompt = get_system_prompt(question, context, role)
+        missing = [i for i, entry in enumerate(cached) if entry is None]
+        if missing:
+            for i, found in zip(missing, self.db_worker.search_by_vectors(vectors[missing], top_k)):
+                results[i] = found
 
-        answer = ""
+        return list(zip(vectors, cached, results))
+
+    async def aanswer_prepared(self, question, role, vector, results, executor=None):
+        """
+        Генерирует ответ по уже найденным документам (см. prepare_batch) и сохраняет его в кэш
+        """
+        system_prompt = self.build_prompt(question, results, role)
 
         try:
-            answer = self.model.answer(system_prompt, question)
+            answer = await self.model.aanswer(system_prompt, question)
         except llm.InvalidAuthKeyException:
             # Try again with regenerated key
-            answer = self.model.answer(system_prompt, question)
-        except Exception as e:
-            print("Exception: ", e)
+            answer = await self.model.aanswer(system_prompt, question)
+
+        await metrics.run_in_executor(executor, self.cache_answer, question, answer, results, role, vector)
 
         return answer
 
+    def generate_answer(self, question, role="default"):
+        with metrics.span("answer", role=role):
+            cached = self.cached_answer(question, role)
+            if cached is not None:
+                return cached
+
+            results = self.retrieve(question)
+            system_prompt = self.build_prompt(question, results, role)
+
+            with metrics.span("llm"):
+                try:
+                    answer = self.model.answer(system_prompt, question)
+                except llm.InvalidAuthKeyException:
+                    # Try again with regenerated key
+                    answer = self.model.answer(system_prompt, question)
+
+            self.cache_answer(question, answer, results, role)
+
+            return answer
+
+    async def agenerate_answer(self, question, role="default", executor=None):
+        """
+        Асинхронная версия generate_answer для сервера. Поиск (векторизация запроса на CPU)
+        выполняется в пуле потоков executor, ошибки LLM пробрасываются вызывающему коду
+        """
+        with metrics.span("answer", role=role):
+            cached = await metrics.run_in_executor(executor, self.cached_answer, question, role)
+            if cached is not None:
+                return cached
+
+            results = await metrics.run_in_executor(executor, self.retrieve, question)
+            system_prompt = self.build_prompt(question, results, role)
+
+            with metrics.span("llm"):
+                try:
+                    answer = await self.model.aanswer(system_prompt, question)
+                except llm.InvalidAuthKeyException:
+                    # Try again with regenerated key
+                    answer = await self.model.aanswer(system_prompt, question)
+
+            await metrics.run_in_executor(executor, self.cache_answer, question, answer, results, role)
+
+            return answer
+
+    def stream_answer(self, question, role="default"):
+        """
+        Генерирует ответ по частям по мере готовности
+        :return: генератор фрагментов ответа
+        """
+        with metrics.span("answer", role=role, stream=True):
+            cached = self.cached_answer(question, role)
+            if cached is not None:
+                yield cached
+                return
+
+            results = self.retrieve(question)
+            system_prompt = self.build_prompt(question, results, role)
+
+            chunks = []
+
+            try:
+                for chunk in timed_stream(self.model.stream_answer(system_prompt, question)):
+                    chunks.append(chunk)
+                    yield chunk
+            except llm.InvalidAuthKeyException:
+                # Try again with regenerated key, if the answer has not started yet
+                if chunks:
+                    raise
+
+                for chunk in timed_stream(self.model.stream_answer(system_prompt, question)):
+                    chunks.append(chunk)
+                    yield chunk
+
+            # В кэш попадает только полностью сгенерированный ответ
+            self.cache_answer(question, "".join(chunks), results, role)
+
+    async def astream_answer(self, question, role="default", executor=None):
+        """
+        Асинхронная версия stream_answer для сервера
+        """
+        with metrics.span("answer", role=role, stream=True):
+            cached = await metrics.run_in_executor(executor, self.cached_answer, question, role)
+            if cached is not None:
+                yield cached
+                return
+
+            results = await metrics.run_in_executor(executor, self.retrieve, question)
+            system_prompt = self.build_prompt(question, results, role)
+
+            chunks = []
+            async for chunk in atimed_stream(self.model.astream_answer(system_prompt, question)):
+                chunks.append(chunk)
+                yield chunk
+
+            await metrics.run_in_executor(executor, self.cache_answer, question, "".join(chunks), results, role)
+
+
+def timed_stream(chunks):
+    """
+    Пропускает фрагменты ответа LLM, измеряя время до первого фрагмента (llm_first_token) и всей генерации (llm)
+    """
+    start_time = time.perf_counter()
+    first = True
+
+    for chunk in chunks:
+        if first:
+            metrics.record_stage("llm_first_token", time.perf_counter() - start_time)
+            first = False
+        yield chunk
+
+    metrics.record_stage("llm", time.perf_counter() - start_time)
+
+
+async def atimed_stream(chunks):
+    """
+    Асинхронная версия timed_stream
+    """
+    start_time = time.perf_counter()
+    first = True
+
+    async for chunk in chunks:
+        if first:
+            metrics.record_stage("llm_first_token", time.perf_counter() - start_time)
+            first = False
+        yield chunk
+
+    metrics.record_stage("llm", time.perf_counter() - start_time)
+
+
+def source_wiki_ids(results) -> set:
+    """
+    :return: id статей, чанки которых есть в результатах поиска
+    """
+    return {result.payload.get("metadata", {}).get("wiki_id") for result in results} - {None}
+
+
+def read_questions(path: str, role="default") -> list:
+    """
+    Читает вопросы из JSONL-файла: в каждой строке объект с полем question и необязательными id и role
+    :return: список словарей {"id": ..., "question": ..., "role": ...}; id по умолчанию - номер строки
+    """
+    questions = []
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+
+            item = json.loads(line)
+            questions.append({
+                "id": item.get("id", line_number),
+                "question": item["question"],
+                "role": item.get("role", role)
+            })
+
+    return questions
+
+
+def read_answered_ids(path: str) -> set:
+    """
+    :return: id вопросов, на которые в файле ответов уже есть ответ без ошибки
+    """
+    if not os.path.exists(path):
+        return set()
+
+    answered = set()
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла не дописаться при прерывании
+                continue
+
+            if "error" not in record:
+                answered.add(record["id"])
+
+    return answered
+
+
+async def answer_questions(assistant: RAGAssistant, questions: list, output, concurrency=config.BULK_CONCURRENCY,
+                           batch_size=config.BULK_BATCH_SIZE, max_batches=config.BULK_MAX_BATCHES):
+    """
+    Отвечает на список вопросов: поиск идет пачками по batch_size вопросов, а генерация - одновременно
+    не более чем для concurrency вопросов. Пока LLM отвечает на одну пачку, ищутся документы для следующей,
+    но не больше чем для max_batches пачек одновременно: иначе эмбеддинги и результаты поиска всего файла
+    копились бы в памяти, пока LLM отстает.
+    Ответы дописываются в output по мере готовности, каждый - отдельной строкой JSON
+    :param questions: список словарей {"id": ..., "question": ..., "role": ...}
+    :param output: открытый на запись текстовый файл
+    :return: число ответов с ошибкой
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    def write(record):
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+
+    async def answer_one(item, vector, results):
+        nonlocal failed
+
+        async with semaphore:
+            start_time = time.perf_counter()
+            record = dict(item, wiki_ids=sorted(source_wiki_ids(results)), cached=False)
+
+            try:
+                record["answer"] = await assistant.aanswer_prepared(item["question"], item["role"], vector, results)
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+                failed += 1
+
+            record["seconds"] = round(time.perf_counter() - start_time, 3)
+            write(record)
+
+    # Задачи генерации по пачкам, для которых уже найдены документы
+    in_flight = deque()
+    items = iter(questions)
+
+    while batch := list(islice(items, batch_size)):
+        while len(in_flight) >= max_batches:
+            await asyncio.gather(*in_flight.popleft())
+
+        prepared = await metrics.run_in_executor(None, assistant.prepare_batch,
+                                                 [item["question"] for item in batch], [item["role"] for item in batch])
+
+        tasks = []
+        for item, (vector, cached, results) in zip(batch, prepared):
+            if cached is not None:
+                write(dict(item, wiki_ids=sorted(cached.get("wiki_ids") or []), cached=True,
+                           answer=cached.get("answer"), seconds=0.0))
+            else:
+                tasks.append(asyncio.create_task(answer_one(item, vector, results)))
+
+        in_flight.append(tasks)
+
+    while in_flight:
+        await asyncio.gather(*in_flight.popleft())
+
+    return failed
+
+
+def main_bulk(questions_file: str, model_type: str, model_name=None, role="default", output_file=None,
+              concurrency=config.BULK_CONCURRENCY):
+    output_file = output_file or os.path.splitext(questions_file)[0] + ".answers.jsonl"
+
+    questions = read_questions(questions_file, role)
+    answered = read_answered_ids(output_file)
+    pending = [item for item in questions if item["id"] not in answered]
+
+    print(f"Questions: {len(questions)}, already answered: {len(questions) - len(pending)}")
+    if not pending:
+        return
 
-def main(question: str, model_type: str, model_name=None, role="default"):
     assistant = RAGAssistant(model_type=model_type, model_name=model_name)
-    answer = assistant.generate_answer(question, role)
-    print(f"Question: {question}\nAnswer: {answer}")
+
+    start_time = time.perf_counter()
+
+    with open(output_file, "a", encoding="utf-8") as output:
+        failed = asyncio.run(answer_questions(assistant, pending, output, concurrency))
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Answered {len(pending) - failed} questions in {elapsed:.1f}s ({failed} failed), results in {output_file}")
+
+
+def main(question: str, model_type: str, model_name=None, role="default", stream=True):
+    assistant = RAGAssistant(model_type=model_type, model_name=model_name)
+
+    if not stream:
+        try:
+            answer = assistant.generate_answer(question, role)
+        except Exception as e:
+            print(f"Question: {question}\nException: ", e)
+            return
+
+        print(f"Question: {question}\nAnswer: {answer}")
+        return
+
+    print(f"Question: {question}\nAnswer: ", end="", flush=True)
+
+    try:
+        for chunk in assistant.stream_answer(question, role):
+            print(chunk, end="", flush=True)
+    except Exception as e:
+        print("\nException: ", e)
+
+    print()
 
 if __name__ == "__main__":
-    question, model_type, model_name, role = cli_arguments_preprocess()
-    main(question, model_type, model_name, role)
+    args = cli_arguments_preprocess()
+    metrics.setup_json_logging()
+
+    with metrics.profiled(args.profile, args.profile_output):
+        if args.questions_file is not None:
+            main_bulk(args.questions_file, args.model_type, args.model_name, args.role, args.output, args.concurrency)
+        else:
+            main(args.question, args.model_type, args.model_name, args.role, not args.no_stream)
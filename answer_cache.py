@@ -0,0 +1,158 @@
+import time
+import hashlib
+import threading
+from uuid import uuid4
+
+import config
+from vectorstore import VectorStore
+
+
+def collection_version(model_name: str) -> str:
+    """
+    Версия коллекции документов, на которой получен ответ. Меняется вместе с моделью эмбеддингов
+    и параметрами чанков, то есть при полной пересборке коллекции
+    :param model_name: название модели эмбеддингов
+    """
+    fingerprint = f"{config.COLLECTION_NAME}:{model_name}:{config.CHUNK_SIZE}:{config.CHUNK_OVERLAP}"
+    return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]
+
+
+class SemanticAnswerCache:
+    """
+    Кэш ответов LLM по смыслу вопроса. Ответы хранятся в отдельной коллекции хранилища векторов вместе
+    с эмбеддингом вопроса; ответ возвращается для вопроса, близкого к сохраненному не меньше чем на threshold,
+    если совпадают роль и модель. Записи удаляются по времени жизни, по превышению размера (сначала самые старые)
+    и при переиндексации статей, по которым был получен ответ (см. invalidate_articles)
+    """
+    def __init__(self, store: VectorStore, version: str, threshold=config.ANSWER_CACHE_THRESHOLD,
+                 ttl=config.ANSWER_CACHE_TTL, max_size=config.ANSWER_CACHE_SIZE,
+                 candidates=config.ANSWER_CACHE_CANDIDATES):
+        """
+        :param store: хранилище векторов для коллекции кэша
+        :param version: версия коллекции документов (см. collection_version)
+        :param threshold: минимальная косинусная близость вопросов
+        :param ttl: время жизни ответа в секундах (None - без ограничения)
+        :param max_size: максимальное число ответов в кэше
+        :param candidates: сколько ближайших вопросов просматривать в поиске ответа с той же ролью и моделью
+        """
+        self.store = store
+        self.version = version
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.candidates = candidates
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_stale(self, payload: dict, now: float) -> bool:
+        if payload.get("collection_version") != self.version:
+            return True
+
+        return self.ttl is not None and payload.get("created_at", 0) + self.ttl <= now
+
+    def get_entry(self, vector, role: str, model: str):
+        """
+        :param vector: эмбеддинг вопроса
+        :param role: роль LLM
+        :param model: модель, давшая ответ
+        :return: payload сохраненного ответа на близкий вопрос (answer, wiki_ids, question, ...) или None
+        """
+        now = time.time()
+        stale_ids = []
+        entry = None
+
+        for hit in self.store.search([vector], self.candidates, payload_fields=None)[0]:
+            if hit.score < self.threshold:
+                break
+
+            if self._is_stale(hit.payload, now):
+                stale_ids.append(hit.id)
+                continue
+
+            if hit.payload.get("role") == role and hit.payload.get("model") == model:
+                entry = hit.payload
+                break
+
+        if stale_ids:
+            self.store.delete(stale_ids)
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return entry
+
+    def get(self, vector, role: str, model: str):
+        """
+        :return: сохраненный ответ на близкий вопрос или None (см. get_entry)
+        """
+        entry = self.get_entry(vector, role, model)
+        return entry.get("answer") if entry is not None else None
+
+    def put(self, vector, role: str, model: str, question: str, answer: str, wiki_ids):
+        """
+        Сохраняет ответ
+        :param vector: эмбеддинг вопроса
+        :param wiki_ids: id статей, найденных для ответа: при их переиндексации ответ удаляется
+        """
+        payload = {
+            "question": question,
+            "role": role,
+            "model": model,
+            "answer": answer,
+            "wiki_ids": list(wiki_ids),
+            "collection_version": self.version,
+            "created_at": time.time()
+        }
+
+        self.store.upsert([str(uuid4())], [vector], [payload], wait=True)
+
+        if self.store.count() > self.max_size:
+            self.prune()
+
+    def prune(self) -> int:
+        """
+        Удаляет устаревшие ответы и самые старые ответы сверх max_size
+        :return: число удаленных ответов
+        """
+        now = time.time()
+        entries = sorted(self.store.iter_payload_field("created_at"), key=lambda entry: entry[1] or 0)
+
+        expired = [id for id, created_at in entries if self.ttl is not None and (created_at or 0) + self.ttl <= now]
+        alive = len(entries) - len(expired)
+        oldest = [id for id, _ in entries[len(expired):len(expired) + max(0, alive - self.max_size)]]
+
+        removed = expired + oldest
+        if removed:
+            self.store.delete(removed)
+
+        return len(removed)
+
+    def invalidate_articles(self, wiki_ids) -> int:
+        """
+        Удаляет ответы, полученные по статьям wiki_ids (вызывается при их переиндексации)
+        :return: число удаленных ответов
+        """
+        wiki_ids = set(wiki_ids)
+        if not wiki_ids:
+            return 0
+
+        removed = [id for id, answer_wiki_ids in self.store.iter_payload_field("wiki_ids")
+                   if answer_wiki_ids and wiki_ids.intersection(answer_wiki_ids)]
+
+        if removed:
+            self.store.delete(removed)
+
+        return len(removed)
+
+    def clear(self):
+        self.store.drop_collection()
+        self.store.create_collection(update=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": self.store.count(), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,111 @@
+import re
+import sys
+import time
+from argparse import ArgumentParser
+
+import config
+import corpus
+import utils
+
+
+def clear_text_reference(text: str) -> str:
+    """
+    Прежняя реализация utils.clear_text (отдельный проход re.sub на каждую конструкцию).
+    Нужна как эталон: новая реализация должна давать точно такой же результат.
+    """
+    text = text.lower()
+
+    # Удаляем специальные конструкции
+    text = re.sub(r'__disambig__', '', text)
+    text = re.sub(r'__notoc__', '', text)
+    text = re.sub(r'__статическое_перенаправление__', '', text)
+    text = re.sub(r'redirect.*', '', text)
+    text = re.sub(r'перенаправление.*', '', text)
+    text = re.sub(r'\{\{.*?\}\}', '', text) # {{...}}
+
+
+    # Удаляем медиа-вставки (мини|..., thumb|..., File:...)
+    text = re.sub(r'\|?мини\|.*?(\n|$)', ' ', text)
+    text = re.sub(r'\|?thumb\|.*?(\n|$)', ' ', text)
+    text = re.sub(r'\[\[file:.*?\]\]', '', text)
+
+
+    # Удаляем wiki/HTML теги и ссылки
+    text = re.sub(r'<ref.*?>.*?</ref>', '', text)
+    text = re.sub(r'<.*?>', '', text) # HTML-теги
+    text = re.sub(r'\[\[([^\]|]+)\|?([^\]]+)?\]\]', 
+                  lambda m: m.group(2) if m.group(2) else m.group(1),
+                  text)
+    text = re.sub(r'\[.*?\]', '', text) # внешние ссылки
+
+    # Приводим кавычки к нормальному виду
+    text = text.replace("«", '"').replace("»", '"').replace("“", '"').replace("”", '"')
+
+    # Убираем шапки
+    text = re.sub(r'^это статья о.*?\.', '', text, flags=re.MULTILINE)
+    text = re.sub(r'^см\.? также.*', '', text, flags=re.MULTILINE)
+
+    return text
+
+
+def check_identical(texts: list) -> int:
+    """
+    :return: число текстов, на которых utils.clear_text расходится с эталоном
+    """
+    mismatches = 0
+
+    for text in texts:
+        if utils.clear_text(text) != clear_text_reference(text):
+            mismatches += 1
+
+    return mismatches
+
+
+def measure(clear, texts: list, repeats: int) -> float:
+    """
+    :return: лучшее время (в секундах) очистки всех текстов из repeats повторов
+    """
+    best = float("inf")
+
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        for text in texts:
+            clear(text)
+        best = min(best, time.perf_counter() - start_time)
+
+    return best
+
+
+def cli_arguments_preprocess():
+    parser = ArgumentParser(description="A microbenchmark of utils.clear_text against the previous regex cascade")
+
+    parser.add_argument("--data_path", required=False, type=str, default=config.DATA_PATH,
+                        help="Directory with wiki pages batches")
+
+    parser.add_argument("--repeats", required=False, type=int, default=5,
+                        help="Number of timed runs, the best one is reported")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = cli_arguments_preprocess()
+
+    texts = [page.get("text") or "" for page in corpus.iter_corpus(args.data_path)]
+    megabytes = sum(len(text.encode("utf-8")) for text in texts) / 2 ** 20
+
+    print(f"Loaded {len(texts)} pages ({megabytes:.1f} MB)")
+
+    mismatches = check_identical(texts)
+    if mismatches:
+        print(f"utils.clear_text differs from the reference on {mismatches} pages")
+        sys.exit(1)
+
+    print("Output is identical to the reference on all pages")
+
+    reference_time = measure(clear_text_reference, texts, args.repeats)
+    current_time = measure(utils.clear_text, texts, args.repeats)
+
+    for name, elapsed in (("reference", reference_time), ("clear_text", current_time)):
+        print(f"{name}: {elapsed:.3f} s, {len(texts) / elapsed:.0f} pages/sec, {megabytes / elapsed:.1f} MB/sec")
+
+    print(f"Speedup: {reference_time / current_time:.2f}x")
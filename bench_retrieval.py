@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+
+import numpy as np
+from qdrant_client import QdrantClient
+from transformers import AutoTokenizer
+
+import config
+import corpus
+import database
+import filldb
+import vectorstore
+from embeddings import create_embedder
+
+
+GOLDEN_SET_PATH = "benchmarks/golden_questions.json"
+BENCHMARK_COLLECTION = "benchmark_wiki_articles"
+BENCHMARK_STORE_PATH = f"{config.DATA_PATH}/benchmark_vectors"
+
+
+def load_golden_set(path: str) -> dict:
+    """
+    Читает golden set: вопросы по вселенной и id статей, в которых есть ответ
+    :return: словарь {"version": ..., "questions": [{"question": ..., "expected_ids": [...]}]}
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def select_pages(data_path: str, pages_limit: int, required_ids: set) -> list:
+    """
+    Выбирает фиксированный срез корпуса: первые pages_limit страниц и все страницы из golden set
+    :return: список страниц в порядке корпуса
+    """
+    pages = []
+
+    for index, page in enumerate(corpus.iter_corpus(data_path)):
+        if index < pages_limit or page["id"] in required_ids:
+            pages.append(page)
+
+    missing = required_ids - {page["id"] for page in pages}
+    if missing:
+        raise ValueError(f"Golden set articles are missing from the corpus: {sorted(missing)}")
+
+    return pages
+
+
+def create_store(store_type: str, location: str, size: int) -> vectorstore.VectorStore:
+    """
+    :param store_type: qdrant или numpy
+    :param location: для qdrant - ":memory:", адрес сервера (http://...) или директория локальной БД;
+        для numpy - директория хранилища
+    """
+    if store_type == "numpy":
+        return vectorstore.NumpyVectorStore(location, size)
+
+    if location == ":memory:":
+        client = QdrantClient(location=location)
+    elif location.startswith(("http://", "https://")):
+        client = QdrantClient(url=location)
+    else:
+        client = QdrantClient(path=location)
+
+    return vectorstore.QdrantVectorStore(client, BENCHMARK_COLLECTION, size)
+
+
+def ingest(pages: list, db_worker: database.DatabaseWorker, tokenizer: AutoTokenizer) -> dict:
+    """
+    Очищает, делит на чанки и записывает страницы в коллекцию тем же кодом, что и filldb.py
+    :return: статистика загрузки
+    """
+    stats = filldb.new_ingest_stats()
+    start_time = time.perf_counter()
+
+    def iter_chunks():
+        for page in pages:
+            page_start_time = time.perf_counter()
+            chunks = filldb.prepare_page(page, tokenizer)
+            stats["chunk"].add(1, time.perf_counter() - page_start_time)
+
+            if chunks is not None:
+                yield from chunks
+
+    # Прогресс загрузки уходит в stderr, чтобы в stdout остался только JSON с результатами
+    with redirect_stdout(sys.stderr):
+        written = filldb.write_chunks_into_db(iter_chunks(), db_worker, stats=stats)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "pages": len(pages),
+        "chunks": written,
+        "seconds": round(elapsed, 3),
+        "chunks_per_sec": round(written / max(elapsed, 1e-9), 2),
+        "stages": {
+            name: {
+                "items": stage.items,
+                "busy_seconds": round(stage.busy_seconds, 3),
+                "items_per_sec": round(stage.items / max(stage.busy_seconds, 1e-9), 2)
+            }
+            for name, stage in stats.items()
+        }
+    }
+
+
+def index_size(db_worker: database.DatabaseWorker, location: str) -> dict:
+    """
+    Оценивает размер индекса: число точек, объем fp32 векторов и payload, размер на диске для локального хранилища
+    """
+    store = db_worker.store
+    points = store.count()
+
+    payload_bytes = sum(
+        len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        for field in ("content", "metadata", "content_hash")
+        for _, value in store.iter_payload_field(field)
+    )
+
+    size = {
+        "points": points,
+        "vector_bytes": points * store.size * 4,
+        "payload_bytes": payload_bytes
+    }
+
+    if os.path.isdir(location):
+        size["disk_bytes"] = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(location)
+            for name in names
+        )
+
+    return size
+
+
+def percentiles(values: list) -> dict:
+    """
+    :param values: времена в секундах
+    :return: p50/p95/p99 в миллисекундах
+    """
+    return {
+        f"p{q}": round(float(np.percentile(values, q)) * 1000, 3)
+        for q in (50, 95, 99)
+    }
+
+
+def evaluate(golden_set: dict, db_worker: database.DatabaseWorker, top_ks: list, repeats: int) -> dict:
+    """
+    Прогоняет вопросы golden set через поиск и считает recall@k, MRR и задержки.
+    Статья считается найденной, если в выдаче есть хотя бы один её чанк; ранг - место статьи среди
+    различных статей выдачи. Кэши DatabaseWorker не используются, чтобы измерять задержки честно
+    """
+    max_k = max(top_ks)
+    search_params = db_worker.search_params()
+
+    hits = {k: 0 for k in top_ks}
+    reciprocal_ranks = []
+    embed_times = []
+    search_times = []
+    misses = []
+
+    for item in golden_set["questions"]:
+        query = database.normalize_query(item["question"])
+        expected_ids = set(item["expected_ids"])
+
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            vector = db_worker.embedder.encode(query, task="search_query")
+            embed_times.append(time.perf_counter() - start_time)
+
+            # Чанков берем с запасом: у одной статьи в выдаче может быть несколько чанков
+            start_time = time.perf_counter()
+            results = db_worker.search_by_vector(vector, max_k * 4, ("metadata",), search_params)
+            search_times.append(time.perf_counter() - start_time)
+
+        ranked_ids = list(dict.fromkeys(result.payload["metadata"]["wiki_id"] for result in results))[:max_k]
+
+        rank = next((i for i, wiki_id in enumerate(ranked_ids, 1) if wiki_id in expected_ids), None)
+
+        for k in top_ks:
+            if rank is not None and rank <= k:
+                hits[k] += 1
+
+        reciprocal_ranks.append(1 / rank if rank is not None else 0.0)
+
+        if rank is None:
+            misses.append({"question": item["question"], "expected_ids": item["expected_ids"], "found_ids": ranked_ids})
+
+    questions = len(golden_set["questions"])
+
+    return {
+        "questions": questions,
+        "recall": {f"@{k}": round(hits[k] / questions, 4) for k in top_ks},
+        "mrr": round(float(np.mean(reciprocal_ranks)), 4),
+        "latency_ms": {
+            "embed": percentiles(embed_times),
+            "search": percentiles(search_times)
+        },
+        "misses": misses
+    }
+
+
+def cli_arguments_preprocess():
+    parser = ArgumentParser(description="A retrieval benchmark: recall@k, MRR and latency on a fixed slice of the corpus")
+
+    parser.add_argument("--data_path", required=False, type=str, default=config.DATA_PATH,
+                        help="Directory with wiki pages batches")
+
+    parser.add_argument("--golden_set", required=False, type=str, default=GOLDEN_SET_PATH,
+                        help="JSON file with questions and expected article ids")
+
+    parser.add_argument("--pages", required=False, type=int, default=1000,
+                        help="Number of first corpus pages to ingest in addition to the golden set articles")
+
+    parser.add_argument("--vector_store", required=False, type=str, default="qdrant", choices=["qdrant", "numpy"],
+                        help="Vector store backend")
+
+    parser.add_argument("--location", required=False, type=str, default=None,
+                        help="For qdrant: :memory: (default), server url (http://...) or local directory; "
+                             f"for numpy: store directory (default: {BENCHMARK_STORE_PATH})")
+
+    parser.add_argument("--embedder_type", required=False, type=str, default=config.EMBEDDER_TYPE,
+                        help="Embedder type: local/local-int8/onnx-int8")
+
+    parser.add_argument("--model_name", required=False, type=str, default="ai-forever/ru-en-RoSBERTa",
+                        help="Embedding model name")
+
+    parser.add_argument("--top_k", required=False, type=int, nargs="+", default=[1, 3, 5, 10],
+                        help="Cutoffs for recall@k")
+
+    parser.add_argument("--repeats", required=False, type=int, default=3,
+                        help="Number of timed runs of every question")
+
+    parser.add_argument("--output", required=False, type=str, default=None,
+                        help="File to write JSON results to (default: stdout)")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = cli_arguments_preprocess()
+
+    golden_set = load_golden_set(args.golden_set)
+    required_ids = {wiki_id for item in golden_set["questions"] for wiki_id in item["expected_ids"]}
+    pages = select_pages(args.data_path, args.pages, required_ids)
+
+    embedder = create_embedder(args.embedder_type, args.model_name)
+    location = args.location or (BENCHMARK_STORE_PATH if args.vector_store == "numpy" else ":memory:")
+    db_worker = database.DatabaseWorker(create_store(args.vector_store, location, embedder.dimension), embedder)
+
+    # Коллекция пересоздается, чтобы каждый прогон начинался с одинакового состояния
+    db_worker.store.drop_collection()
+    db_worker.create_collection()
+
+    ingest_stats = ingest(pages, db_worker, embedder.tokenizer)
+
+    report = {
+        "golden_set_version": golden_set["version"],
+        "settings": {
+            "embedder_type": args.embedder_type,
+            "model_name": args.model_name,
+            "vector_store": args.vector_store,
+            "location": location,
+            "chunk_size": config.CHUNK_SIZE,
+            "chunk_overlap": config.CHUNK_OVERLAP,
+            "quantization": config.QUANTIZATION,
+            "hnsw_m": config.HNSW_M,
+            "hnsw_ef_construct": config.HNSW_EF_CONSTRUCT,
+            "search_hnsw_ef": config.SEARCH_HNSW_EF,
+            "search_rescore": config.SEARCH_RESCORE,
+            "search_oversampling": config.SEARCH_OVERSAMPLING
+        },
+        "ingest": ingest_stats,
+        "index": index_size(db_worker, location),
+        "retrieval": evaluate(golden_set, db_worker, sorted(args.top_k), args.repeats)
+    }
+
+    output = json.dumps(report, ensure_ascii=False, indent=4)
+
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
@@ -0,0 +1,59 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш ограниченного размера с временем жизни записей.
+    Считает попадания и промахи.
+    """
+    def __init__(self, maxsize: int, ttl: float = None):
+        """
+        :param maxsize: максимальное число записей (0 - кэш отключен)
+        :param ttl: время жизни записи в секундах (None - без ограничения)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+
+            if item is not None:
+                value, expires_at = item
+
+                if expires_at is None or expires_at > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.data[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self.lock:
+            self.data[key] = (value, expires_at)
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
@@ -1,20 +1,132 @@
 # WIKI
 WIKI_API_URL = "https://stalker.fandom.com/ru/api.php"
+WIKI_REQUESTS_PER_SECOND=5  # ограничение частоты запросов к API вики, не спамим
+WIKI_MAX_WORKERS=4  # число параллельных запросов к API вики
+WIKI_PAGES_PER_REQUEST=50  # максимум страниц в одном запросе prop=revisions (ограничение MediaWiki)
 
 # FILE STRUCTURE
 DATA_PATH="data"
+CORPUS_COMPRESSION=False  # сжимать ли файлы батчей страниц zstd (нужен пакет zstandard)
+CORPUS_ZSTD_LEVEL=10
+WIKI_STATE_PATH=f"{DATA_PATH}/wiki_state.json"  # прогресс загрузки вики и id ревизий сохраненных страниц
 
 # DATABASE
 COLLECTION_NAME="wiki_articles"
 VECTOR_SIZE=1024
+DOCSTORE_PATH=f"{DATA_PATH}/documents.sqlite"  # полные тексты статей, на которые ссылаются чанки в БД
 MIN_PAGE_LENGTH=25  # минимальная длина текста страницы для её добавления в БД
 
+# INDEX (Qdrant; применяются при создании коллекции и обновляются на месте при следующем create_collection)
+QUANTIZATION="scalar"  # None - без квантизации, scalar - int8 (в 4 раза меньше памяти), binary - 1 бит на компоненту
+QUANTIZATION_QUANTILE=0.99  # квантиль значений для границ int8 (отсекает выбросы)
+QUANTIZATION_ALWAYS_RAM=True  # держать квантованные векторы в RAM
+VECTORS_ON_DISK=True  # хранить исходные fp32 векторы на диске (в RAM остаются квантованные)
+PAYLOAD_ON_DISK=True  # хранить payload на диске, а не в RAM
+HNSW_M=16  # число связей вершины графа HNSW: больше - точнее и больше памяти
+HNSW_EF_CONSTRUCT=100  # ширина поиска при построении графа: больше - точнее и дольше индексация
+HNSW_ON_DISK=False  # хранить граф HNSW на диске
+SEARCH_HNSW_EF=128  # ширина поиска по графу при запросе (None - значение Qdrant по умолчанию)
+SEARCH_RESCORE=True  # пересчитывать близость кандидатов по исходным векторам
+SEARCH_OVERSAMPLING=2.0  # во сколько раз больше кандидатов отбирается по квантованным векторам для пересчета
+
+# VECTOR STORE
+VECTOR_STORE="qdrant"  # qdrant - сервер Qdrant, numpy - встроенное хранилище без сервера в VECTOR_STORE_PATH
+VECTOR_STORE_PATH=f"{DATA_PATH}/vectors"  # директория встроенного хранилища (memory-mapped матрица векторов)
+VECTOR_STORE_DTYPE="float32"  # тип хранения векторов во встроенном хранилище; float16 - вдвое меньше памяти
+VECTOR_STORE_IVF_MIN_POINTS=200000  # с какого числа векторов строить IVF-разбиение (поиск становится приближенным)
+VECTOR_STORE_IVF_LISTS=None  # число кластеров IVF (None - корень из числа векторов)
+VECTOR_STORE_NPROBE=16  # число кластеров IVF, просматриваемых при поиске
+VECTOR_STORE_FLUSH_RATIO=0.1  # доля измененных точек коллекции, после которой встроенное хранилище перезаписывает файлы
+VECTOR_STORE_FLUSH_MIN_CHANGES=1024  # но не раньше стольких изменений (остальные пишутся в конце загрузки и при выходе)
+
 # VECTORIZATION PARAMS
+EMBEDDER_TYPE="local"  # local - fp32 PyTorch, local-int8 - PyTorch int8, onnx-int8 - ONNX Runtime int8
+EMBEDDER_NUM_THREADS=None  # число потоков CPU для модели эмбеддингов (None - по умолчанию)
+EMBEDDER_MIN_COSINE=0.98  # минимальная косинусная близость квантованных эмбеддингов к fp32 (python embeddings.py)
+ONNX_MODEL_DIR="models/onnx"  # куда экспортируется ONNX-модель эмбеддингов
+EMBEDDING_BATCH_SIZE=32  # число текстов в одном проходе модели эмбеддингов
+EMBEDDING_MAX_LENGTH=512  # максимальная длина входа модели эмбеддингов в токенах (вместе с префиксом задачи)
+DOCUMENT_PREFIX="search_document: "  # префикс задачи для текстов документов
 CHUNK_SIZE=512
 CHUNK_OVERLAP=64
+UPSERT_BATCH_SIZE=256  # число чанков в одном запросе на запись в Qdrant
+
+# CONTEXT
+CONTEXT_TOP_K=8  # число чанков, которые ищутся для контекста (повторы и перекрытия потом склеиваются)
+CONTEXT_MAX_TOKENS=2048  # бюджет токенов контекста для моделей, которых нет в CONTEXT_TOKEN_BUDGETS
+CONTEXT_TOKEN_BUDGETS={  # бюджет токенов контекста для каждого типа модели: токены промпта - это задержка и стоимость
+    "local": 1536,
+    "gigachat-remote": 2048,
+    "deepseek-remote": 3072,
+    "router": 2048,  # контекст должен помещаться в бюджет любой модели маршрутизатора
+}
+CONTEXT_CHARS_PER_TOKEN=3.0  # оценка символов на токен для моделей без доступного токенизатора (с запасом для кириллицы)
+CONTEXT_MIN_OVERLAP_CHARS=8  # минимальное совпадение конца и начала соседних чанков для их склейки
+CONTEXT_MIN_DOCUMENT_TOKENS=64  # статья обрезается под остаток бюджета, только если остаток не меньше этого
+CONTEXT_FULL_ARTICLE_TOKENS=512  # статья из хранилища текстов попадает в контекст целиком, если не длиннее этого (иначе - найденные фрагменты)
+
+# LOCAL LLM
+LOCAL_LLM_DTYPE="bfloat16"  # тип весов локальной LLM: bfloat16/float16 - вдвое меньше памяти, чем float32
+LOCAL_LLM_QUANTIZATION=None  # None, int8 - динамическая int8-квантизация PyTorch (CPU), 8bit/4bit - bitsandbytes (нужен пакет bitsandbytes)
+LOCAL_LLM_MAX_NEW_TOKENS=512  # максимальная длина ответа в токенах
+LOCAL_LLM_MAX_BATCH_SIZE=4  # сколько одновременных запросов генерируется одним батчем (1 - по одному)
+LOCAL_LLM_BATCH_WAIT=0.05  # сколько секунд после первого запроса ждать остальные запросы батча
+
+# LLM ROUTER (--model_type=router)
+ROUTER_BACKENDS=["deepseek-remote", "gigachat-remote"]  # модели маршрутизатора в порядке приоритета
+ROUTER_DEADLINE=60.0  # секунд на весь ответ, включая дублирование и повторы
+ROUTER_RETRIES=2  # повторов, если ни одна модель не ответила
+ROUTER_BACKOFF_BASE=0.5  # базовая задержка повтора, секунд; растет вдвое с каждым повтором (со случайным разбросом)
+ROUTER_BACKOFF_MAX=5.0  # максимальная задержка повтора, секунд
+ROUTER_HEDGE_QUANTILE=95  # перцентиль задержки основной модели, после которого запрос дублируется следующей
+ROUTER_HEDGE_DELAY=10.0  # задержка дублирования, секунд, пока у модели меньше ROUTER_HEDGE_MIN_SAMPLES ответов
+ROUTER_HEDGE_MIN_SAMPLES=20
+ROUTER_STATS_WINDOW=200  # число последних ответов, по которым считаются перцентили задержки
+ROUTER_SLOW_CALL=30.0  # ответ дольше стольких секунд считается неудачей для circuit breaker
+ROUTER_BREAKER_FAILURES=5  # после стольких неудачных вызовов подряд модель временно отключается
+ROUTER_BREAKER_RESET=30.0  # через сколько секунд отключенной модели дается пробный вызов
+
+# CACHES
+QUERY_CACHE_SIZE=1024  # число эмбеддингов запросов в кэше
+QUERY_CACHE_TTL=3600  # время жизни эмбеддинга запроса в кэше, секунд
+RESULT_CACHE_SIZE=256  # число результатов поиска в кэше (0 - кэш отключен)
+RESULT_CACHE_TTL=300  # время жизни результатов поиска, секунд; ограничивает устаревание при записи в БД из другого процесса
+
+# ANSWER CACHE
+ANSWER_CACHE_ENABLED=True  # кэшировать ответы LLM на близкие по смыслу вопросы
+ANSWER_CACHE_COLLECTION="answer_cache"  # коллекция Qdrant с ответами
+ANSWER_CACHE_PATH=f"{DATA_PATH}/answer_cache"  # директория встроенного хранилища ответов (VECTOR_STORE="numpy")
+ANSWER_CACHE_THRESHOLD=0.95  # минимальная косинусная близость вопроса к сохраненному для использования ответа
+ANSWER_CACHE_TTL=86400  # время жизни ответа, секунд (None - без ограничения)
+ANSWER_CACHE_SIZE=10000  # максимальное число ответов; сверх него удаляются самые старые
+ANSWER_CACHE_CANDIDATES=5  # сколько ближайших сохраненных вопросов проверяется на совпадение роли и модели
+
+# BULK ANSWERS (answer.py --questions_file)
+BULK_BATCH_SIZE=64  # число вопросов, которые векторизуются и ищутся одним батчем
+BULK_CONCURRENCY=8  # число одновременных запросов к LLM
+BULK_MAX_BATCHES=2  # для скольких пачек одновременно хранятся найденные документы (ограничивает память на больших файлах)
+
+# METRICS
+LOG_LEVEL="INFO"  # уровень JSON-логов пайплайна; DEBUG - вместе с длительностью каждой стадии запроса
+METRICS_BUCKETS=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # границы гистограмм, секунд
+PROFILER="cprofile"  # профилировщик для --profile: cprofile или pyinstrument (нужен пакет pyinstrument)
+PROFILE_TOP_N=30  # число функций в отчете cProfile
+
+# SERVER
+SERVER_EMBED_WORKERS=2  # потоки для векторизации запросов; torch сам распараллеливает каждый проход
+SERVER_MAX_CONCURRENT=16  # запросы, обрабатываемые одновременно
+SERVER_MAX_QUEUE=64  # запросы, ожидающие обработки; при переполнении сервер отвечает 503
 
 # APIs
 SBER_AUTH_URL="https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
 GIGACHAT_API_URL="https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
+GIGACHAT_CA_BUNDLE="russian_trusted_root_ca.cer"  # корневой сертификат Минцифры для TLS к API GigaChat
+GIGACHAT_TIMEOUT=60.0  # таймаут чтения ответа GigaChat, секунд
+GIGACHAT_CONNECT_TIMEOUT=5.0  # таймаут установки соединения, секунд
+GIGACHAT_MAX_CONNECTIONS=32  # размер пула keep-alive соединений к GigaChat
+GIGACHAT_TOKEN_REFRESH_MARGIN=300  # за сколько секунд до истечения токена (живет 30 минут) получать новый в фоне
+GIGACHAT_TOKEN_MIN_LIFETIME=5  # токен, которому осталось жить меньше стольких секунд, не используется для запроса
+GIGACHAT_TOKEN_MIN_REFRESH_INTERVAL=1.0  # минимальная пауза между фоновыми обновлениями токена, секунд
+GIGACHAT_TOKEN_RETRY_DELAY=10  # пауза между попытками фонового обновления токена после ошибки, секунд
 
 DEEPSEEK_API_URL="https://api.deepseek.com"
\ No newline at end of file
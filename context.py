@@ -0,0 +1,215 @@
+from collections import OrderedDict
+
+import config
+
+
+class TokenCounter:
+    """
+    Считает токены текста токенизатором LLM. Для удаленных моделей, токенизатор которых недоступен,
+    число токенов оценивается по числу символов
+    """
+    ELLIPSIS = " ..."
+
+    # Больше символов на токен не бывает на практике: по началу такой длины видно, что текст длиннее лимита
+    MAX_CHARS_PER_TOKEN = 16
+
+    def __init__(self, tokenizer=None, chars_per_token=config.CONTEXT_CHARS_PER_TOKEN):
+        self.tokenizer = tokenizer
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+        return int(len(text) / self.chars_per_token) + 1
+
+    def fits(self, text: str, max_tokens: int) -> bool:
+        """
+        :return: помещается ли text в max_tokens токенов. Длинный текст целиком не токенизируется:
+            если лимит превышен уже в начале текста, превышен и во всем тексте
+        """
+        head = text[:max_tokens * self.MAX_CHARS_PER_TOKEN]
+        if self.count(head) > max_tokens:
+            return False
+
+        return len(head) == len(text) or self.count(text) <= max_tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Обрезает текст до max_tokens токенов по границе слова
+        """
+        # Оставляем место под многоточие в конце
+        max_tokens -= self.count(self.ELLIPSIS)
+        if max_tokens <= 0:
+            return ""
+
+        if self.tokenizer is not None:
+            ids = self.tokenizer.encode(text, add_special_tokens=False)
+            if len(ids) <= max_tokens:
+                return text
+            truncated = self.tokenizer.decode(ids[:max_tokens], skip_special_tokens=True)
+        else:
+            max_chars = int(max_tokens * self.chars_per_token)
+            if len(text) <= max_chars:
+                return text
+            truncated = text[:max_chars]
+
+        # Не оставляем оборванное слово в конце
+        cut = truncated.rfind(" ")
+        if cut > len(truncated) // 2:
+            truncated = truncated[:cut]
+
+        return truncated.rstrip() + self.ELLIPSIS
+
+
+def merge_overlapping(left: str, right: str, min_overlap=config.CONTEXT_MIN_OVERLAP_CHARS) -> str:
+    """
+    Склеивает соседние чанки статьи: начало right, совпадающее с концом left (перекрытие CHUNK_OVERLAP), не повторяется
+    :return: склеенный текст или None, если тексты не перекрываются
+    """
+    if right in left:
+        return left
+
+    if left in right:
+        return right
+
+    probe = right[:min_overlap]
+    if len(probe) < min_overlap:
+        return None
+
+    # Ищем самое длинное перекрытие: самое левое вхождение начала right в left, после которого left совпадает с right
+    start = left.find(probe)
+    while start != -1:
+        if right.startswith(left[start:]):
+            return left + right[len(left) - start:]
+        start = left.find(probe, start + 1)
+
+    return None
+
+
+class ContextBuilder:
+    """
+    Собирает контекст для LLM из результатов поиска: группирует чанки по статьям, склеивает соседние
+    и перекрывающиеся чанки, убирает повторы и заполняет контекст статьями по убыванию релевантности,
+    пока не кончится бюджет токенов. Короткие статьи из хранилища текстов (doc_store) попадают в контекст целиком
+    """
+    SEPARATOR = "\n\n"
+
+    def __init__(self, token_counter: TokenCounter, max_tokens=config.CONTEXT_MAX_TOKENS, doc_store=None,
+                 full_article_tokens=config.CONTEXT_FULL_ARTICLE_TOKENS):
+        """
+        :param token_counter: счетчик токенов LLM
+        :param max_tokens: бюджет токенов на контекст
+        :param doc_store: хранилище полных текстов статей (docstore.DocumentStore) или None
+        :param full_article_tokens: статья берется целиком, если она не длиннее стольких токенов и помещается в бюджет
+        """
+        self.token_counter = token_counter
+        self.max_tokens = max_tokens
+        self.doc_store = doc_store
+        self.full_article_tokens = full_article_tokens
+        self.separator_tokens = token_counter.count(self.SEPARATOR)
+
+    @staticmethod
+    def group_by_article(results) -> OrderedDict:
+        """
+        :param results: результаты поиска (объекты с полями score и payload)
+        :return: {wiki_id: {"title": ..., "chunks": {номер чанка: текст}}} в порядке лучшего результата статьи
+        """
+        articles = OrderedDict()
+
+        for result in sorted(results, key=lambda result: result.score, reverse=True):
+            metadata = result.payload.get("metadata", {})
+            content = result.payload.get("content", "")
+
+            if not content:
+                continue
+
+            # Результаты без wiki_id (старые коллекции) считаются отдельными статьями
+            wiki_id = metadata.get("wiki_id", id(result))
+            article = articles.setdefault(wiki_id, {"title": metadata.get("title", ""), "chunks": {}})
+            article["chunks"].setdefault(metadata.get("chunk", len(article["chunks"])), content)
+
+        return articles
+
+    @staticmethod
+    def merge_chunks(chunks: dict) -> list:
+        """
+        Склеивает соседние и перекрывающиеся чанки статьи и убирает повторяющиеся фрагменты
+        :param chunks: {номер чанка: текст}
+        :return: список непересекающихся фрагментов статьи по порядку
+        """
+        spans = []
+        previous_index = None
+
+        for index in sorted(chunks):
+            text = chunks[index].strip()
+
+            if spans and text in spans[-1]:
+                previous_index = index
+                continue
+
+            if any(text in span for span in spans):
+                continue
+
+            if spans and index == previous_index + 1:
+                # Соседние чанки идут в статье подряд: перекрытие убираем, а без перекрытия (чанк был обрезан
+                # по границе абзаца) просто продолжаем фрагмент с новой строки
+                merged = merge_overlapping(spans[-1], text)
+                spans[-1] = merged if merged is not None else spans[-1] + "\n" + text
+            else:
+                spans.append(text)
+
+            previous_index = index
+
+        return spans
+
+    @staticmethod
+    def format_document(title: str, spans: list) -> str:
+        header = f"Статья «{title}»:" if title else "Статья:"
+        return header + "\n" + "\n...\n".join(spans)
+
+    def full_document(self, stored: dict, max_tokens: int):
+        """
+        :param stored: статья из хранилища текстов {"id", "title", "text"} или None
+        :return: статья целиком, если она не длиннее max_tokens токенов, иначе None
+        """
+        if stored is None or not stored["text"].strip():
+            return None
+
+        document = self.format_document(stored["title"], [stored["text"].strip()])
+        return document if self.token_counter.fits(document, max_tokens) else None
+
+    def build(self, results) -> str:
+        """
+        :param results: результаты поиска
+        :return: текст контекста, не длиннее бюджета токенов
+        """
+        documents = []
+        remaining = self.max_tokens
+
+        articles = self.group_by_article(results)
+        # Полные тексты всех найденных статей читаются одним запросом
+        full_texts = self.doc_store.get_many(articles) if self.doc_store is not None else {}
+
+        for wiki_id, article in articles.items():
+            if remaining <= 0:
+                break
+
+            document = self.full_document(full_texts.get(wiki_id), min(self.full_article_tokens, remaining))
+            if document is None:
+                document = self.format_document(article["title"], self.merge_chunks(article["chunks"]))
+
+            tokens = self.token_counter.count(document)
+
+            # Статья, которая целиком не помещается, обрезается, если от неё останется заметная часть
+            if tokens > remaining:
+                if remaining < config.CONTEXT_MIN_DOCUMENT_TOKENS:
+                    break
+
+                document = self.token_counter.truncate(document, remaining)
+                tokens = remaining
+
+            documents.append(document)
+            remaining -= tokens + self.separator_tokens
+
+        return self.SEPARATOR.join(documents)
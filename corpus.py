@@ -0,0 +1,277 @@
+import io
+import os
+import json
+
+import config
+
+# zstandard нужен только для сжатого корпуса
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+JSON_EXTENSION = ".json"        # старый формат: один JSON-массив на файл
+JSONL_EXTENSION = ".jsonl"      # одна страница на строку
+ZSTD_EXTENSION = ".jsonl.zst"   # одна страница на zstd-фрейм
+INDEX_EXTENSION = ".idx"        # строки "id\toffset\tlength" для каждой страницы файла
+
+BATCH_EXTENSIONS = (ZSTD_EXTENSION, JSONL_EXTENSION, JSON_EXTENSION)
+
+
+class CorpusError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def _check_zstd():
+    if zstandard is None:
+        raise CorpusError("Compressed corpus requires zstandard package: pip install zstandard")
+
+def batch_basename(file_index: int, data_path=None) -> str:
+    """
+    Имя файла батча без расширения
+    """
+    return f"{data_path or config.DATA_PATH}/wiki_pages_{file_index}"
+
+def batch_filename(file_index: int, data_path=None, compress=None) -> str:
+    """
+    Имя нового файла батча в формате, заданном в config.CORPUS_COMPRESSION
+    """
+    if compress is None:
+        compress = config.CORPUS_COMPRESSION
+
+    return batch_basename(file_index, data_path) + (ZSTD_EXTENSION if compress else JSONL_EXTENSION)
+
+def find_batch_file(file_index: int, data_path=None):
+    """
+    Ищет существующий файл батча с номером file_index в любом из поддерживаемых форматов
+    :return: имя файла или None
+    """
+    basename = batch_basename(file_index, data_path)
+
+    for extension in BATCH_EXTENSIONS:
+        if os.path.exists(basename + extension):
+            return basename + extension
+
+    return None
+
+def iter_batch_files(data_path=None):
+    """
+    Перебирает файлы батчей страниц в директории data_path по порядку
+    """
+    file_index = 0
+    while (filename := find_batch_file(file_index, data_path)) is not None:
+        yield filename
+        file_index += 1
+
+def index_filename(filename: str) -> str:
+    return filename + INDEX_EXTENSION
+
+def _is_compressed(filename: str) -> bool:
+    return filename.endswith(ZSTD_EXTENSION)
+
+
+def read_index(filename: str) -> dict:
+    """
+    Читает индекс смещений файла батча
+    :param filename: имя файла батча
+    :return: словарь {id страницы: (смещение, длина записи в байтах)}
+    """
+    index = {}
+
+    if not os.path.exists(index_filename(filename)):
+        return index
+
+    with open(index_filename(filename), "r", encoding="utf-8") as f:
+        for line in f:
+            # Последняя строка могла записаться не полностью при аварийном завершении
+            if not line.endswith("\n"):
+                break
+
+            page_id, offset, length = line.split("\t")
+            index[int(page_id)] = (int(offset), int(length))
+
+    return index
+
+
+class CorpusWriter:
+    """
+    Дописывает страницы в файл батча (JSONL или JSONL, сжатый zstd по фрейму на страницу) и ведет индекс смещений.
+    Файл открывается на дозапись: после сбоя запись продолжается с последней целиком записанной страницы.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.compressed = _is_compressed(filename)
+
+        if self.compressed:
+            _check_zstd()
+            self.compressor = zstandard.ZstdCompressor(level=config.CORPUS_ZSTD_LEVEL)
+
+        # Отрезаем хвост, который не попал в индекс (запись страницы оборвалась),
+        # и записи индекса, данные которых не успели записаться
+        file_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        self.index = {
+            page_id: (offset, length)
+            for page_id, (offset, length) in read_index(filename).items()
+            if offset + length <= file_size
+        }
+        valid_size = max((offset + length for offset, length in self.index.values()), default=0)
+
+        self.file = open(filename, "ab")
+        self.file.truncate(valid_size)
+        self.file.seek(valid_size)
+
+        self.index_file = open(index_filename(filename), "w", encoding="utf-8")
+        for page_id, (offset, length) in self.index.items():
+            self.index_file.write(f"{page_id}\t{offset}\t{length}\n")
+
+    def __contains__(self, page_id) -> bool:
+        return page_id in self.index
+
+    def write(self, page: dict):
+        """
+        Дописывает страницу в конец файла
+        :param page: страница ({"id", "title", "text"})
+        """
+        data = (json.dumps(page, ensure_ascii=False) + "\n").encode("utf-8")
+
+        if self.compressed:
+            data = self.compressor.compress(data)
+
+        offset = self.file.tell()
+        self.file.write(data)
+
+        self.index[page["id"]] = (offset, len(data))
+        self.index_file.write(f"{page['id']}\t{offset}\t{len(data)}\n")
+
+    def flush(self):
+        # Сначала данные, потом индекс: индекс никогда не ссылается на незаписанные данные
+        self.file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_pages(filename: str):
+    """
+    Потоково читает страницы из файла батча любого формата
+    :param filename: имя файла батча
+    :return: генератор страниц ({"id", "title", "text"})
+    """
+    if filename.endswith(JSON_EXTENSION):
+        # Старый формат не читается потоково, весь файл загружается в память
+        with open(filename, "r", encoding="utf-8") as file:
+            yield from json.load(file)
+        return
+
+    with open(filename, "rb") as raw_file:
+        if _is_compressed(filename):
+            _check_zstd()
+            raw_file = zstandard.ZstdDecompressor().stream_reader(raw_file, read_across_frames=True)
+
+        for line in io.TextIOWrapper(raw_file, encoding="utf-8"):
+            # Последняя строка могла записаться не полностью при аварийном завершении
+            if not line.endswith("\n"):
+                break
+
+            yield json.loads(line)
+
+def iter_corpus(data_path=None):
+    """
+    Потоково читает страницы всех файлов батчей по порядку
+    """
+    for filename in iter_batch_files(data_path):
+        yield from iter_pages(filename)
+
+def read_page(filename: str, page_id: int, index=None):
+    """
+    Читает одну страницу из файла батча по индексу смещений, не читая остальной файл
+    :param filename: имя файла батча (JSONL или JSONL.zst)
+    :param page_id: id страницы
+    :param index: заранее прочитанный индекс (см. read_index)
+    :return: страница или None, если её нет в файле
+    """
+    if index is None:
+        index = read_index(filename)
+
+    if page_id not in index:
+        return None
+
+    offset, length = index[page_id]
+
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    if _is_compressed(filename):
+        _check_zstd()
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    return json.loads(data)
+
+def find_page(page_id: int, data_path=None):
+    """
+    Ищет страницу по id во всех файлах батчей по их индексам
+    :return: страница или None
+    """
+    for filename in iter_batch_files(data_path):
+        if filename.endswith(JSON_EXTENSION):
+            page = next((p for p in iter_pages(filename) if p["id"] == page_id), None)
+        else:
+            page = read_page(filename, page_id)
+
+        if page is not None:
+            return page
+
+    return None
+
+
+def remove_batch_file(filename: str):
+    for path in (filename, index_filename(filename)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def write_pages(filename: str, pages):
+    """
+    Атомарно записывает страницы в новый файл батча (через временный файл)
+    :param filename: имя файла батча (JSONL или JSONL.zst)
+    :param pages: итерируемый объект страниц
+    """
+    # Расширение временного файла должно совпадать с итоговым, чтобы не поменялся формат
+    tmp_filename = f"{os.path.dirname(filename) or '.'}/tmp.{os.path.basename(filename)}"
+    remove_batch_file(tmp_filename)
+
+    with CorpusWriter(tmp_filename) as writer:
+        for page in pages:
+            writer.write(page)
+
+    os.replace(tmp_filename, filename)
+    os.replace(index_filename(tmp_filename), index_filename(filename))
+
+def convert_corpus(data_path=None, compress=None):
+    """
+    Переводит файлы батчей старого формата (JSON-массив) в JSONL с индексом
+    """
+    for file_index, filename in enumerate(iter_batch_files(data_path)):
+        if not filename.endswith(JSON_EXTENSION):
+            continue
+
+        new_filename = batch_filename(file_index, data_path, compress)
+        write_pages(new_filename, iter_pages(filename))
+        os.remove(filename)
+
+        print(f"Converted {filename} -> {new_filename}")
+
+
+if __name__ == "__main__":
+    convert_corpus()
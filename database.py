@@ -1,9 +1,47 @@
-from uuid import uuid4
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct, UpdateStatus
-from qdrant_client.http.exceptions import UnexpectedResponse
+import json
+import hashlib
+from uuid import uuid5, NAMESPACE_URL
 
-from embeddings import LocalEmbedder
+import numpy as np
+
+import config
+import metrics
+from cache import LRUCache
+from embeddings import Embedder
+from vectorstore import VectorStore
+
+
+# Пространство имен для детерминированных id точек: одна и та же вики дает одни и те же id
+POINT_ID_NAMESPACE = uuid5(NAMESPACE_URL, config.WIKI_API_URL)
+
+
+def point_id(wiki_id, chunk_index) -> str:
+    """
+    Строит детерминированный id точки по id статьи и номеру чанка
+    :param wiki_id: id статьи в вики
+    :param chunk_index: номер чанка в статье
+    :return: строковый UUID
+    """
+    return str(uuid5(POINT_ID_NAMESPACE, f"{wiki_id}:{chunk_index}"))
+
+
+def normalize_query(query: str) -> str:
+    """
+    Приводит запрос к виду, в котором одинаковые по смыслу запросы совпадают: нижний регистр, одиночные пробелы.
+    Статьи в БД тоже приведены к нижнему регистру (см. utils.clear_text)
+    """
+    return " ".join(query.lower().split())
+
+
+def content_hash(text, payload) -> str:
+    """
+    Считает хеш содержимого чанка: текста для эмбеддинга и его payload
+    :param text: текст чанка
+    :param payload: payload чанка
+    :return: hex-строка sha256
+    """
+    serialized = json.dumps({"text": text, "payload": payload}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
 
 
 class EmbeddingError(Exception):
@@ -17,73 +55,223 @@ class DatabaseError(Exception):
 
 
 class DatabaseWorker():
-    def __init__(self, client: QdrantClient, embedder: LocalEmbedder, collection_name: str, size=1024):
+    def __init__(self, store: VectorStore, embedder: Embedder):
         """
-        Класс для работы с базой данных Qdrant
-        :param client: клиент базы данных
-        :param collection_name: имя коллекции
+        Класс для работы с базой данных: векторизация текстов, запись и поиск в хранилище векторов
+        :param store: хранилище векторов (Qdrant или встроенное, см. vectorstore.py)
         :param embedder: объект класса Embedder для векторизации текста
         """
-        self.client = client
+        self.store = store
         self.embedder = embedder
-        self.collection_name = collection_name
-        self.size = size
-    
+
+        # Кэш эмбеддингов запросов и кэш результатов поиска. Результаты зависят от версии коллекции,
+        # которая увеличивается при каждой записи через этот объект
+        self.query_cache = LRUCache(config.QUERY_CACHE_SIZE, config.QUERY_CACHE_TTL)
+        self.result_cache = LRUCache(config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL)
+        self.collection_version = 0
+
+    def invalidate_results(self):
+        """
+        Сбрасывает кэш результатов поиска после изменения коллекции
+        """
+        self.collection_version += 1
+        self.result_cache.clear()
+
+    def cache_stats(self) -> dict:
+        """
+        :return: статистика попаданий и промахов кэшей
+        """
+        return {"query_embeddings": self.query_cache.stats(), "search_results": self.result_cache.stats()}
+
     def create_collection(self):
+        """
+        Создает коллекцию с параметрами из config.py или обновляет параметры существующей
+        """
         try:
-            self.client.get_collection(self.collection_name)
-            print(f"Collection {self.collection_name} already exists")
-        except UnexpectedResponse:
-            self.client.create_collection(
-                collection_name=self.collection_name,
-                vectors_config=VectorParams(
-                    size=self.size,
-                    distance=Distance.COSINE
-                )
-            )
-
-    def add_point(self, text, payload):
+            self.store.create_collection()
+        except Exception as e:
+            raise DatabaseError(f"Failed to create collection: {e}")
+        finally:
+            self.invalidate_results()
+
+    def add_point(self, id, text, payload):
         """
         Векторизует текст и вставляет вектор в коллекцию
+        :param id: id точки (см. point_id)
         :param text: текст для векторизации
         :param payload: дополнительные данные для вектора (title, text)
         """
+        vectors = self.embed_documents([text])
+        self.upsert_points([id], vectors, [payload], wait=True)
+
+    def embed_documents(self, texts):
+        """
+        Векторизует список текстов документов одним батчевым вызовом эмбеддера
+        :param texts: список текстов
+        :return: np.ndarray с эмбеддингами в порядке texts
+        """
         try:
-            embedded_text = self.embedder.encode(text)
+            return self.embedder.encode_batch(list(texts))
         except Exception as e:
-            raise EmbeddingError(f"Failed to embed text: {e}")
-
-        operation_info = self.client.upsert(
-            collection_name=self.collection_name,
-            points=[
-                PointStruct(
-                    id=str(uuid4().hex),    # есть ID wiki, но мы будем использовать свой
-                    vector=embedded_text,
-                    payload=payload
-                )
-            ]
-        )
+            raise EmbeddingError(f"Failed to embed texts: {e}")
+
+    def embed_token_ids(self, input_ids):
+        """
+        Векторизует уже токенизированные чанки (см. utils.split_by_token_chunks) батчевым вызовом эмбеддера
+        :param input_ids: список списков id токенов
+        :return: np.ndarray с эмбеддингами в порядке input_ids
+        """
+        try:
+            return self.embedder.encode_token_ids(input_ids)
+        except Exception as e:
+            raise EmbeddingError(f"Failed to embed texts: {e}")
+
+    def upsert_points(self, ids, vectors, payloads, wait=False):
+        """
+        Вставляет в коллекцию пачку уже посчитанных векторов одним запросом.
+        Точки с существующими id перезаписываются
+        :param ids: список id точек
+        :param vectors: матрица эмбеддингов
+        :param payloads: список payload для каждого вектора
+        :param wait: ждать ли применения изменений. При wait=False изменения только ставятся в очередь,
+            поэтому последнюю пачку загрузки стоит отправлять с wait=True - операции применяются по порядку
+        """
+        try:
+            self.store.upsert(ids, vectors, payloads, wait=wait)
+        except Exception as e:
+            raise DatabaseError(f"Failed to insert {len(ids)} points: {e}")
+        finally:
+            self.invalidate_results()
+
+    def flush(self):
+        """
+        Сохраняет все записанные точки (см. VectorStore.flush). Вызывается в конце загрузки
+        """
+        try:
+            self.store.flush()
+        except Exception as e:
+            raise DatabaseError(f"Failed to flush points: {e}")
+
+    def get_stored_hashes(self, page_size=1024) -> dict:
+        """
+        Читает из коллекции хеши содержимого всех точек (без векторов)
+        :param page_size: число точек за один запрос
+        :return: словарь {id точки: content_hash}
+        """
+        return dict(self.store.iter_payload_field("content_hash", page_size))
 
-        if operation_info.status != UpdateStatus.COMPLETED:
-            raise DatabaseError(f"Failed to insert point: {operation_info}")
+    def delete_points(self, ids):
+        """
+        Удаляет точки из коллекции по id
+        :param ids: список id точек
+        """
+        try:
+            self.store.delete(list(ids))
+        except Exception as e:
+            raise DatabaseError(f"Failed to delete points: {e}")
+        finally:
+            self.invalidate_results()
 
-    def search(self, query, top_k=5):
+    def search_params(self, **kwargs):
+        """
+        Параметры поиска хранилища (см. QdrantVectorStore.search_params и NumpyVectorStore.search_params)
+        """
+        return self.store.search_params(**kwargs)
+
+    def search(self, query, top_k=5, payload_fields=("content", "metadata"), search_params=None):
         """
         Ищет в базе данных top_k наиболее похожих векторов на вектор запроса
         :param query: текст запроса
         :param top_k: количество возвращаемых результатов
+        :param payload_fields: поля payload, которые нужно вернуть (остальные не передаются по сети)
+        :param search_params: параметры поиска (по умолчанию - из config.py, см. search_params)
+        :return: список из top_k наиболее похожих векторов
+        """
+        if search_params is None:
+            search_params = self.search_params()
+
+        with metrics.span("embed"):
+            embedded_query = self.embed_query(query)
+
+        cache_key = (
+            hashlib.sha1(np.asarray(embedded_query, dtype=np.float32).tobytes()).hexdigest(),
+            top_k,
+            tuple(payload_fields),
+            repr(search_params),
+            self.collection_version
+        )
+
+        search_result = self.result_cache.get(cache_key)
+        if search_result is not None:
+            return search_result
+
+        with metrics.span("search", top_k=top_k):
+            search_result = self.search_by_vector(embedded_query, top_k, payload_fields, search_params)
+
+        self.result_cache.put(cache_key, search_result)
+
+        return search_result
+
+    def search_by_vector(self, vector, top_k=5, payload_fields=("content", "metadata"), search_params=None):
+        """
+        Ищет top_k ближайших к вектору точек, минуя кэши
+        :param vector: эмбеддинг запроса
+        :param top_k: количество возвращаемых результатов
+        :param payload_fields: поля payload, которые нужно вернуть
+        :param search_params: параметры поиска (по умолчанию - из config.py, см. search_params)
         :return: список из top_k наиболее похожих векторов
         """
+        return self.search_by_vectors([vector], top_k, payload_fields, search_params)[0]
+
+    def search_by_vectors(self, vectors, top_k=5, payload_fields=("content", "metadata"), search_params=None):
+        """
+        Ищет ближайшие точки сразу для нескольких векторов одним вызовом хранилища (в Qdrant - пакетный поиск), минуя кэши
+        :param vectors: матрица эмбеддингов запросов
+        :return: список результатов поиска в порядке vectors
+        """
+        return self.store.search(vectors, top_k, payload_fields, search_params)
+
+    def search_batch(self, queries, top_k=5, payload_fields=("content", "metadata"), search_params=None):
+        """
+        Ищет результаты сразу для нескольких запросов: запросы векторизуются одним батчем,
+        а хранилище ищет по всем векторам за один вызов. Кэши не используются
+        :param queries: список текстов запросов
+        :return: список результатов поиска в порядке queries
+        """
+        embedded_queries = self.embed_queries(queries)
+
+        with metrics.span("search_batch", queries=len(queries)):
+            return self.search_by_vectors(embedded_queries, top_k, payload_fields, search_params)
+
+    def embed_queries(self, queries):
+        """
+        Векторизует несколько запросов одним батчем, без кэша
+        :param queries: список текстов запросов
+        :return: np.ndarray с эмбеддингами в порядке queries
+        """
         try:
-            embedded_query = self.embedder.encode(query, task="search_query")
+            with metrics.span("embed_batch", queries=len(queries)):
+                return self.embedder.encode_batch([normalize_query(query) for query in queries], task="search_query")
+        except Exception as e:
+            raise EmbeddingError(f"Failed to embed queries: {e}")
+
+    def embed_query(self, query):
+        """
+        Векторизует запрос с кэшированием по нормализованному тексту запроса
+        :param query: текст запроса
+        :return: list-эмбеддинг
+        """
+        normalized_query = normalize_query(query)
+
+        embedded_query = self.query_cache.get(normalized_query)
+        if embedded_query is not None:
+            return embedded_query
+
+        try:
+            embedded_query = self.embedder.encode(normalized_query, task="search_query")
         except Exception as e:
             raise EmbeddingError(f"Failed to embed query: {e}")
-        
-        search_result = self.client.search(
-            collection_name=self.collection_name,
-            query_vector=embedded_query,
-            limit=top_k,
-            with_payload=True
-        )
 
-        return search_result
+        self.query_cache.put(normalized_query, embedded_query)
+
+        return embedded_query
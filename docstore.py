@@ -0,0 +1,108 @@
+import zlib
+import sqlite3
+import hashlib
+import threading
+
+import config
+
+
+class DocumentStore:
+    """
+    Локальное хранилище полных текстов статей, ключ - id статьи в вики.
+    Чанки в Qdrant ссылаются на статью через metadata.wiki_id, поэтому полный текст хранится один раз, а не в каждом чанке.
+    Тексты хранятся очищенными (тем же текстом, который делится на чанки) и сжатыми zlib:
+    по ним в контекст LLM попадают короткие статьи целиком (см. context.ContextBuilder)
+    """
+    def __init__(self, path=config.DOCSTORE_PATH):
+        """
+        :param path: путь к файлу SQLite (":memory:" для хранилища в памяти)
+        """
+        # Соединение общее для потоков сервера, запросы к нему идут по очереди
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS documents (
+                wiki_id INTEGER PRIMARY KEY,
+                title TEXT NOT NULL,
+                text BLOB NOT NULL,
+                content_hash TEXT
+            )
+            """
+        )
+
+        # Хранилища, созданные до появления хеша, дополняются колонкой: их статьи перезапишутся один раз
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(documents)")}
+        if "content_hash" not in columns:
+            self.connection.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+
+        self.connection.commit()
+
+    @staticmethod
+    def content_hash(title: str, text: str) -> str:
+        return hashlib.sha1(f"{title}\n{text}".encode("utf-8")).hexdigest()
+
+    def put(self, wiki_id: int, title: str, text: str) -> bool:
+        """
+        Сохраняет статью, если она новая или изменилась
+        :return: True, если статья записана
+        """
+        content_hash = self.content_hash(title, text)
+
+        with self.lock:
+            row = self.connection.execute("SELECT content_hash FROM documents WHERE wiki_id = ?", (wiki_id,)).fetchone()
+            if row is not None and row[0] == content_hash:
+                return False
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO documents (wiki_id, title, text, content_hash) VALUES (?, ?, ?, ?)",
+                (wiki_id, title, zlib.compress(text.encode("utf-8")), content_hash)
+            )
+
+        return True
+
+    def get(self, wiki_id: int):
+        """
+        :return: статья {"id", "title", "text"} или None
+        """
+        return self.get_many([wiki_id]).get(wiki_id)
+
+    def get_many(self, wiki_ids) -> dict:
+        """
+        :param wiki_ids: список id статей
+        :return: словарь {id статьи: {"id", "title", "text"}} для найденных статей
+        """
+        wiki_ids = list(wiki_ids)
+        documents = {}
+
+        # SQLite ограничивает число параметров запроса
+        for start in range(0, len(wiki_ids), 500):
+            batch = wiki_ids[start:start + 500]
+
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT wiki_id, title, text FROM documents WHERE wiki_id IN ({', '.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+
+            for wiki_id, title, text in rows:
+                documents[wiki_id] = {"id": wiki_id, "title": title, "text": zlib.decompress(text).decode("utf-8")}
+
+        return documents
+
+    def ids(self) -> set:
+        with self.lock:
+            return {wiki_id for wiki_id, in self.connection.execute("SELECT wiki_id FROM documents")}
+
+    def delete(self, wiki_ids):
+        with self.lock:
+            self.connection.executemany("DELETE FROM documents WHERE wiki_id = ?", [(wiki_id,) for wiki_id in wiki_ids])
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
@@ -1,7 +1,22 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+
+import numpy as np
 import torch
 import torch.nn.functional as F
 from transformers import AutoTokenizer, AutoModel, logging as transformers_logging
 
+import config
+
+# onnxruntime нужен только для ONNX-бэкенда
+try:
+    import onnxruntime
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    onnxruntime = None
+
 # Отключаем предупреждения transformers
 transformers_logging.set_verbosity_error()
 
@@ -14,13 +29,18 @@ def pool(hidden_state, mask, pooling_method="cls"):
         return hidden_state[:, 0]
 
 
-class LocalEmbedder():
+class Embedder(ABC):
     """
-    Строит эмбеддинг для текста с помощью локальной модели
+    Базовый класс эмбеддера: токенизация, батчи и паддинг общие, наследники реализуют только проход модели
     """
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained("ai-forever/ru-en-RoSBERTa")
-        self.model = AutoModel.from_pretrained("ai-forever/ru-en-RoSBERTa")
+    # Тип для create_embedder: по нему такой же эмбеддер создается в другом процессе
+    embedder_type = None
+
+    def __init__(self, model_name="ai-forever/ru-en-RoSBERTa", max_length=config.EMBEDDING_MAX_LENGTH):
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.max_length = max_length
+        self.dimension = None
 
     def encode(self, text, task="search_document"):
         """
@@ -29,24 +49,279 @@ class LocalEmbedder():
         :param task: префикс для текста (по умолчанию "search_document" - для улучшения кодирования ответов)
         :return: list-эмбеддинг
         """
-        prefixed_text = f"{task}: {text}"
+        return self.encode_batch([text], task=task, batch_size=1)[0].tolist()
+
+    def encode_batch(self, texts, task="search_document", batch_size=config.EMBEDDING_BATCH_SIZE):
+        """
+        Строит эмбеддинги для списка текстов батчами.
+        Тексты сортируются по длине в токенах, поэтому каждый батч дополняется паддингом
+        только до длины самого длинного текста в нём, а не до max_length.
+        :param texts: список текстов для эмбеддинга
+        :param task: префикс для текстов
+        :param batch_size: размер батча для прохода через модель
+        :return: np.ndarray формы (len(texts), dimension) типа float32, строки в исходном порядке
+        """
+        prefixed_texts = [f"{task}: {text}" for text in texts]
+
+        # Токенизируем один раз без паддинга, паддинг добавляется отдельно для каждого батча
+        encodings = self.tokenizer(prefixed_texts,
+                                   max_length=self.max_length,
+                                   truncation=True)
+
+        return self.encode_token_ids(encodings["input_ids"], batch_size)
+
+    def encode_token_ids(self, input_ids, batch_size=config.EMBEDDING_BATCH_SIZE):
+        """
+        Прогоняет через модель уже токенизированные тексты, группируя их по длине.
+        :param input_ids: список списков id токенов (со спецтокенами и префиксом задачи, см. utils.split_by_token_chunks)
+        :param batch_size: размер батча
+        :return: np.ndarray формы (len(input_ids), dimension) типа float32
+        """
+        embeddings = np.empty((len(input_ids), self.dimension), dtype=np.float32)
+
+        # Длинные тексты идут первыми: самый тяжелый батч выявит нехватку памяти сразу
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]), reverse=True)
+
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+
+            batch = self.tokenizer.pad({"input_ids": [input_ids[i] for i in indices]},
+                                       padding=True,
+                                       return_tensors="np")
+
+            embeddings[indices] = self._embed_batch(batch["input_ids"], batch["attention_mask"])
+
+        return embeddings
+
+    @abstractmethod
+    def _embed_batch(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        """
+        Проход модели для одного батча
+        :return: нормализованные эмбеддинги формы (batch, dimension)
+        """
+
+
+class LocalEmbedder(Embedder):
+    """
+    Строит эмбеддинг для текста с помощью локальной модели
+    """
+    embedder_type = "local"
+
+    def __init__(self, model_name="ai-forever/ru-en-RoSBERTa", max_length=config.EMBEDDING_MAX_LENGTH, num_threads=config.EMBEDDER_NUM_THREADS):
+        super().__init__(model_name, max_length)
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+        self.dimension = self.model.config.hidden_size
 
-        tokenized_inputs = self.tokenizer(prefixed_text,
-                                          max_length=512,
-                                          padding=True,
-                                          truncation=True,
-                                          return_tensors="pt")
+    def _embed_batch(self, input_ids, attention_mask):
+        input_ids = torch.from_numpy(input_ids)
+        attention_mask = torch.from_numpy(attention_mask)
 
         with torch.no_grad():
-            outputs = self.model(**tokenized_inputs)
+            outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
 
         embeddings = pool(
-            outputs.last_hidden_state, 
-            tokenized_inputs["attention_mask"],
+            outputs.last_hidden_state,
+            attention_mask,
             pooling_method="cls"
         )
 
         embeddings = F.normalize(embeddings, p=2, dim=1)
 
-        return embeddings[0].tolist()
-    
\ No newline at end of file
+        return embeddings.numpy()
+
+
+class QuantizedEmbedder(LocalEmbedder):
+    """
+    Локальная модель с динамической int8-квантизацией линейных слоев (torch, CPU)
+    """
+    embedder_type = "local-int8"
+
+    def __init__(self, model_name="ai-forever/ru-en-RoSBERTa", max_length=config.EMBEDDING_MAX_LENGTH, num_threads=config.EMBEDDER_NUM_THREADS):
+        super().__init__(model_name, max_length, num_threads)
+
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class _HiddenStateModel(torch.nn.Module):
+    """
+    Обертка для экспорта в ONNX: фиксирует порядок входов и возвращает только last_hidden_state
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
+class OnnxEmbedder(Embedder):
+    """
+    Модель, экспортированная в ONNX, с динамической int8-квантизацией весов, выполняется в ONNX Runtime на CPU.
+    При первом запуске модель экспортируется и квантуется в model_dir, дальше используется готовый файл
+    """
+    embedder_type = "onnx-int8"
+
+    def __init__(self, model_name="ai-forever/ru-en-RoSBERTa", max_length=config.EMBEDDING_MAX_LENGTH, num_threads=config.EMBEDDER_NUM_THREADS,
+                 model_dir=config.ONNX_MODEL_DIR, quantize=True):
+        if onnxruntime is None:
+            raise ImportError("ONNX embedder requires onnxruntime and onnx packages: pip install onnxruntime onnx")
+
+        super().__init__(model_name, max_length)
+
+        model_path = self._export(model_dir, quantize)
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+
+    def _export(self, model_dir, quantize):
+        """
+        Экспортирует модель в ONNX (и квантует её), если это еще не сделано
+        :return: путь к файлу модели
+        """
+        fp32_path = os.path.join(model_dir, "model.onnx")
+        int8_path = os.path.join(model_dir, "model_int8.onnx")
+        model_path = int8_path if quantize else fp32_path
+
+        if os.path.exists(model_path):
+            return model_path
+
+        os.makedirs(model_dir, exist_ok=True)
+
+        if not os.path.exists(fp32_path):
+            print(f"Exporting {self.model_name} to ONNX...")
+
+            model = _HiddenStateModel(AutoModel.from_pretrained(self.model_name))
+            model.eval()
+
+            sample = self.tokenizer(["search_query: пример"], return_tensors="pt")
+
+            torch.onnx.export(
+                model,
+                (sample["input_ids"], sample["attention_mask"]),
+                fp32_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "last_hidden_state": {0: "batch", 1: "sequence"}
+                },
+                opset_version=17,
+                dynamo=False
+            )
+
+        if quantize:
+            print("Quantizing ONNX model to int8...")
+            quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+        return model_path
+
+    def _embed_batch(self, input_ids, attention_mask):
+        last_hidden_state, = self.session.run(
+            ["last_hidden_state"],
+            {"input_ids": input_ids.astype(np.int64), "attention_mask": attention_mask.astype(np.int64)}
+        )
+
+        # CLS-пулинг и L2-нормализация, как в LocalEmbedder
+        embeddings = last_hidden_state[:, 0]
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+        return embeddings.astype(np.float32)
+
+
+def create_embedder(embedder_type="local", model_name="ai-forever/ru-en-RoSBERTa", num_threads=config.EMBEDDER_NUM_THREADS):
+    """
+    Создает эмбеддер по его типу
+    :param embedder_type: local - fp32 PyTorch, local-int8 - PyTorch с int8-квантизацией, onnx-int8 - ONNX Runtime с int8-квантизацией
+    :param num_threads: число потоков CPU для модели
+    """
+    if embedder_type == "local":
+        embedder = LocalEmbedder(model_name, num_threads=num_threads)
+    elif embedder_type == "local-int8":
+        embedder = QuantizedEmbedder(model_name, num_threads=num_threads)
+    elif embedder_type == "onnx-int8":
+        embedder = OnnxEmbedder(model_name, num_threads=num_threads)
+    else:
+        raise ValueError(f"Unknown embedder type: {embedder_type}")
+
+    return embedder
+
+
+def compare_embedders(embedder: Embedder, reference: Embedder, texts, task="search_document", batch_size=config.EMBEDDING_BATCH_SIZE):
+    """
+    Сравнивает эмбеддинги проверяемого эмбеддера с эталонными (fp32) и время их построения
+    :param embedder: проверяемый эмбеддер
+    :param reference: эталонный эмбеддер
+    :param texts: тексты для сравнения
+    :return: словарь с минимальной и средней косинусной близостью и временем векторизации
+    """
+    start_time = time.perf_counter()
+    reference_embeddings = reference.encode_batch(texts, task=task, batch_size=batch_size)
+    reference_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    embeddings = embedder.encode_batch(texts, task=task, batch_size=batch_size)
+    embedder_time = time.perf_counter() - start_time
+
+    # Эмбеддинги нормализованы, поэтому косинусная близость - скалярное произведение
+    similarities = np.sum(embeddings * reference_embeddings, axis=1)
+
+    return {
+        "min_cosine": float(similarities.min()),
+        "mean_cosine": float(similarities.mean()),
+        "reference_seconds": reference_time,
+        "embedder_seconds": embedder_time
+    }
+
+
+def cli_arguments_preprocess():
+    parser = ArgumentParser(description="A script for checking that a quantized embedder stays close to the fp32 one")
+
+    parser.add_argument("--embedder_type", required=True,
+                        help="Type of embedder to check: local-int8/onnx-int8")
+
+    parser.add_argument("--samples", required=False, type=int, default=256,
+                        help="Number of corpus pages used for comparison")
+
+    parser.add_argument("--threshold", required=False, type=float, default=config.EMBEDDER_MIN_COSINE,
+                        help="Minimal allowed cosine similarity to fp32 embeddings")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    from itertools import islice
+    import corpus
+
+    args = cli_arguments_preprocess()
+
+    texts = [page["text"][:2000] for page in islice(corpus.iter_corpus(), args.samples)]
+
+    reference = LocalEmbedder()
+    embedder = create_embedder(args.embedder_type)
+
+    # Документы векторизуются батчами при загрузке, запросы - по одному при поиске
+    reports = {
+        "documents": compare_embedders(embedder, reference, texts),
+        "queries": compare_embedders(embedder, reference, texts[:64], task="search_query", batch_size=1)
+    }
+
+    for name, report in reports.items():
+        print(f"{name}: " + ", ".join(f"{key}={value:.4f}" for key, value in report.items()))
+
+    min_cosine = min(report["min_cosine"] for report in reports.values())
+
+    if min_cosine < args.threshold:
+        print(f"FAILED: cosine similarity {min_cosine:.4f} is below {args.threshold}")
+        raise SystemExit(1)
+
+    print("OK")
@@ -1,9 +1,23 @@
 import os
-import json
+import time
+import multiprocessing
+from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from transformers import AutoTokenizer
 
 import config
+import corpus
 import utils
+import metrics
 import database
+import docstore
+from embeddings import create_embedder
+
+
+# Чанк статьи, готовый к записи в БД: id точки, текст, id токенов для эмбеддера и payload
+Chunk = namedtuple("Chunk", ["id", "text", "input_ids", "payload"])
 
 
 def is_valid_page(page: dict) -> bool:
@@ -33,71 +47,438 @@ def is_valid_page(page: dict) -> bool:
     return True
 
 
-def write_pages_into_db(filename, db_worker: database.DatabaseWorker):
+def prepare_page(page: dict, tokenizer) -> list:
     """
-    Записывает в БД все страницы из файла filename
+    Очищает страницу и делит её на чанки.
+    :param page: страница
+    :param tokenizer: токенизатор эмбеддера (текст токенизируется один раз, id токенов передаются эмбеддеру)
+    :return: список чанков Chunk или None, если страница не подходит для БД
     """
-    with open(filename, 'r', encoding="utf-8") as file:
-        pages = json.load(file)
+    prepared = prepare_page_document(page, tokenizer)
+    return prepared[1] if prepared is not None else None
 
-        for page in pages:
-            if not is_valid_page(page):
-                print(f"\t Skipping invalid page: {page.get('title')} (id={page.get('id')})")
-                continue
 
-            id = page.get("id")
-            title = page.get("title")
-            text = page.get("text")
-            
-            # Очистим текст от мусора
-            cleared_text = utils.clear_text(text)
-
-            # Делим на чанки
-            chunked_text = utils.split_by_chunks(cleared_text, db_worker.embedder.tokenizer, config.CHUNK_SIZE, config.CHUNK_OVERLAP)
-
-            print(f"\t Writing page: {title} (id={id}), {len(chunked_text)} chunks")
-
-            for i, chunk in enumerate(chunked_text):
-                payload = {
-                    "content": chunk,    # в payload сохраняем весь текст статьи
-                    "full_text": text,
-                    "metadata": {
-                        "wiki_id": id,
-                        "chunk": i,
-                        "title": title
-                    }
-                }
+def prepare_page_document(page: dict, tokenizer):
+    """
+    Очищает страницу и делит её на чанки (см. prepare_page)
+    :return: (очищенный текст для DocumentStore, список чанков Chunk) или None, если страница не подходит для БД
+    """
+    if not is_valid_page(page):
+        return None
+
+    id = page.get("id")
+    title = page.get("title")
+    text = page.get("text")
+
+    # Очистим текст от мусора
+    cleared_text = utils.clear_text(text)
+
+    # Делим на чанки
+    chunked_text = utils.split_by_token_chunks(cleared_text, tokenizer, config.CHUNK_SIZE, config.CHUNK_OVERLAP,
+                                               config.DOCUMENT_PREFIX, config.EMBEDDING_MAX_LENGTH)
+
+    chunks = []
+    for i, (chunk, input_ids) in enumerate(chunked_text):
+        payload = {
+            "content": chunk,    # полный текст статьи лежит в DocumentStore под metadata.wiki_id
+            "metadata": {
+                "wiki_id": id,
+                "chunk": i,
+                "title": title
+            }
+        }
+        payload["content_hash"] = database.content_hash(chunk, payload)
+
+        chunks.append(Chunk(database.point_id(id, i), chunk, input_ids, payload))
+
+    return cleared_text, chunks
+
+
+# Состояние процессов-воркеров: модели загружаются один раз при старте процесса
+_worker_tokenizer = None
+_worker_embedder = None
+
+def _init_chunk_worker(model_name):
+    global _worker_tokenizer
+    _worker_tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+def _prepare_page_in_worker(page):
+    start_time = time.perf_counter()
+    prepared = prepare_page_document(page, _worker_tokenizer)
+    return prepared, time.perf_counter() - start_time
+
+def _init_embed_worker(embedder_type, model_name, num_threads):
+    global _worker_embedder
+    _worker_embedder = create_embedder(embedder_type, model_name, num_threads)
+
+def _embed_in_worker(input_ids):
+    start_time = time.perf_counter()
+    vectors = _worker_embedder.encode_token_ids(input_ids)
+    return vectors, time.perf_counter() - start_time
+
+
+class StageStats:
+    """
+    Пропускная способность стадии загрузки: сколько элементов обработано и сколько времени стадия была занята
+    """
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy_seconds = 0.0
+
+    def add(self, items: int, seconds: float):
+        self.items += items
+        self.busy_seconds += seconds
+
+        metrics.record_stage(f"ingest_{self.name}", seconds, items=items)
+
+    def report(self, wall_seconds: float) -> str:
+        """
+        :param wall_seconds: полное время загрузки
+        :return: строка с пропускной способностью стадии в целом и одного её воркера
+        """
+        return (f"{self.name}: {self.items} {self.unit}, "
+                f"{self.items / max(wall_seconds, 1e-9):.1f} {self.unit}/sec overall, "
+                f"{self.items / max(self.busy_seconds, 1e-9):.1f} {self.unit}/sec per worker, "
+                f"busy {self.busy_seconds:.1f} s")
 
+
+def new_ingest_stats() -> dict:
+    return {
+        "chunk": StageStats("clean/chunk", "pages"),
+        "embed": StageStats("embed", "chunks"),
+        "write": StageStats("write", "chunks")
+    }
+
+
+def iter_page_chunks(filename, tokenizer, doc_store: docstore.DocumentStore = None, chunk_pool=None, max_in_flight=64,
+                     stats=None):
+    """
+    Читает страницы из файла filename, очищает их и делит на чанки.
+    Очищенные тексты новых и изменившихся статей сохраняются в doc_store, в payload чанков остается только ссылка на статью.
+    :param filename: файл батча страниц
+    :param tokenizer: токенизатор эмбеддера (текст токенизируется один раз, id токенов передаются эмбеддеру)
+    :param doc_store: хранилище полных текстов статей
+    :param chunk_pool: пул процессов для очистки и деления на чанки (None - в текущем процессе)
+    :param max_in_flight: максимальное число страниц, одновременно находящихся в chunk_pool
+    :param stats: статистика стадий загрузки (см. new_ingest_stats)
+    :return: генератор чанков Chunk
+    """
+    pages = corpus.iter_pages(filename)
+
+    if chunk_pool is None:
+        def prepare_locally(page):
+            start_time = time.perf_counter()
+            prepared = prepare_page_document(page, tokenizer)
+            return prepared, time.perf_counter() - start_time
+
+        prepared_pages = ((page, prepare_locally(page)) for page in pages)
+    else:
+        # Порядок страниц сохраняется, в памяти одновременно не больше max_in_flight страниц
+        prepared_pages = (
+            (page, future.result())
+            for page, future in utils.submit_bounded(chunk_pool, _prepare_page_in_worker, pages, max_in_flight)
+        )
+
+    for page, (prepared, seconds) in prepared_pages:
+        if stats is not None:
+            stats["chunk"].add(1, seconds)
+
+        if prepared is None:
+            print(f"\t Skipping invalid page: {page.get('title')} (id={page.get('id')})")
+            continue
+
+        cleared_text, chunks = prepared
+
+        # Статья с неизменным текстом не перезаписывается (см. DocumentStore.put)
+        if doc_store is not None:
+            doc_store.put(page["id"], page["title"], cleared_text)
+
+        print(f"\t Writing page: {page['title']} (id={page['id']}), {len(chunks)} chunks")
+
+        yield from chunks
+
+    if doc_store is not None:
+        doc_store.commit()
+
+
+def skip_unchanged_chunks(chunks, stored_hashes: dict, seen_ids: set):
+    """
+    Пропускает чанки, которые уже лежат в БД с тем же хешем содержимого.
+    :param chunks: итерируемый объект чанков Chunk
+    :param stored_hashes: словарь {id точки: content_hash} из БД
+    :param seen_ids: множество, в которое складываются id всех встреченных чанков
+    :return: генератор новых или изменившихся чанков
+    """
+    skipped = 0
+
+    for chunk in chunks:
+        seen_ids.add(chunk.id)
+
+        if stored_hashes.get(chunk.id) == chunk.payload["content_hash"]:
+            skipped += 1
+            continue
+
+        yield chunk
+
+    print(f"Skipped {skipped} unchanged chunks")
+
+
+def write_chunks_into_db(chunks, db_worker: database.DatabaseWorker, batch_size=config.UPSERT_BATCH_SIZE,
+                         embed_pool=None, max_in_flight=2, stats=None):
+    """
+    Записывает в БД чанки пачками по batch_size.
+    Пока пачка N отправляется в Qdrant в отдельном потоке, считаются эмбеддинги следующих пачек:
+    в основном потоке или параллельно в процессах embed_pool. Запись в БД всегда идет из одного потока по порядку.
+    :param chunks: итерируемый объект чанков Chunk
+    :param db_worker: объект для работы с БД
+    :param batch_size: число чанков в одной пачке
+    :param embed_pool: пул процессов для векторизации (None - в текущем процессе)
+    :param max_in_flight: максимальное число пачек, одновременно находящихся в embed_pool
+    :param stats: статистика стадий загрузки (см. new_ingest_stats)
+    :return: число записанных чанков
+    """
+    if stats is None:
+        stats = new_ingest_stats()
+
+    written = 0
+    pending_write = None
+    start_time = time.perf_counter()
+
+    def embed_batches(batches):
+        """
+        :return: генератор пар (пачка, эмбеддинги или None при ошибке) в исходном порядке пачек
+        """
+        if embed_pool is None:
+            for batch in batches:
+                batch_start_time = time.perf_counter()
                 try:
-                    db_worker.add_point(chunk, payload)
-                    print(f"\t\t Added point: chunk {i}")
-                except database.DatabaseError | database.EmbeddingError as e:
-                    print(f"\t\t Error adding point {title} (id={id}) chunk {i}: {e}")
+                    vectors = db_worker.embed_token_ids([chunk.input_ids for chunk in batch])
+                except database.EmbeddingError as e:
+                    print(f"\t\t Error embedding batch of {len(batch)} chunks: {e}")
+                    vectors = None
+
+                stats["embed"].add(len(batch), time.perf_counter() - batch_start_time)
+                yield batch, vectors
+            return
+
+        embedded = utils.submit_bounded(embed_pool, _embed_in_worker, batches, max_in_flight,
+                                        args=lambda batch: ([chunk.input_ids for chunk in batch],))
+
+        for batch, future in embedded:
+            try:
+                vectors, seconds = future.result()
+                stats["embed"].add(len(batch), seconds)
+            except Exception as e:
+                print(f"\t\t Error embedding batch of {len(batch)} chunks: {e}")
+                vectors = None
+
+            yield batch, vectors
+
+    def upsert(ids, vectors, payloads, wait):
+        write_start_time = time.perf_counter()
+        db_worker.upsert_points(ids, vectors, payloads, wait=wait)
+        stats["write"].add(len(ids), time.perf_counter() - write_start_time)
+
+    def finish_write(write):
+        # Дожидаемся отправки предыдущей пачки, чтобы не копить пачки в памяти и сохранить порядок записи
+        batch_len, future = write
+        try:
+            future.result()
+            return batch_len
+        except database.DatabaseError as e:
+            print(f"\t\t Error writing batch of {batch_len} chunks: {e}")
+            return 0
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for (batch, vectors), is_last in utils.with_last(embed_batches(utils.batched(chunks, batch_size))):
+            if vectors is None:
+                continue
+
+            ids = [chunk.id for chunk in batch]
+            payloads = [chunk.payload for chunk in batch]
+
+            if pending_write is not None:
+                written += finish_write(pending_write)
+
+            # Последнюю пачку пишем с wait=True: Qdrant применяет операции по порядку,
+            # так что после её подтверждения записаны и все предыдущие
+            pending_write = (len(batch), writer.submit(upsert, ids, vectors, payloads, is_last))
+
+        if pending_write is not None:
+            written += finish_write(pending_write)
+
+    # Последняя пачка могла не записаться (ошибка векторизации), а встроенное хранилище копит изменения
+    # в памяти, поэтому загрузка всегда завершается явным сохранением
+    try:
+        db_worker.flush()
+    except database.DatabaseError as e:
+        print(f"\t\t Error flushing written chunks: {e}")
+        written = 0
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Written {written} chunks in {elapsed:.1f} s ({written / max(elapsed, 1e-9):.1f} chunks/sec)")
+
+    return written
+
+
+def write_pages_into_db(filename, db_worker: database.DatabaseWorker, stored_hashes: dict,
+                        doc_store: docstore.DocumentStore = None):
+    """
+    Записывает в БД новые и изменившиеся страницы из файла filename
+    :param stored_hashes: словарь {id точки: content_hash} из БД (db_worker.get_stored_hashes()). Запрашивается
+        вызывающим кодом один раз на все файлы: get_stored_hashes перебирает все точки коллекции
+    """
+    chunks = iter_page_chunks(filename, db_worker.embedder.tokenizer, doc_store)
+    write_chunks_into_db(skip_unchanged_chunks(chunks, stored_hashes, set()), db_worker)
+
+def iter_wiki_filenames():
+    """
+    Перебирает файлы батчей страниц в директории config.DATA_PATH по порядку
+    """
+    for file_index, filename in enumerate(corpus.iter_batch_files()):
+        print(f"Uploading pages batch {file_index}")
+        yield filename
+
 
-def write_wiki_into_db(db_worker: database.DatabaseWorker):
+def write_wiki_into_db(db_worker: database.DatabaseWorker, doc_store: docstore.DocumentStore, workers=1, chunk_workers=None,
+                       answer_cache=None):
     """
-    Записывает в БД все страницы из всех батчей в директории config.DATA_PATH
+    Синхронизирует БД со всеми страницами из всех батчей в директории config.DATA_PATH:
+    векторизует только новые и изменившиеся чанки и удаляет чанки удаленных или укоротившихся статей
+    :param workers: число процессов для векторизации (1 - все стадии в текущем процессе)
+    :param chunk_workers: число процессов для очистки и деления на чанки (по умолчанию workers // 4, но не меньше 1)
+    :param answer_cache: семантический кэш ответов LLM, из которого удаляются ответы по изменившимся статьям
     """
     if not os.path.exists(config.DATA_PATH):
         raise Exception("Data package is empty! Load data first!")
 
-    # Пишем все страницы, пока они есть
-    file_index = 0
-    while True:
-        filename = f"{config.DATA_PATH}/wiki_pages_{file_index}.json"
+    stored_hashes = db_worker.get_stored_hashes()
+    seen_ids = set()
+    seen_wiki_ids = set()
+    changed_wiki_ids = set()
+    chunk_counts = {}
+    changed_chunks = 0
 
-        if not os.path.exists(filename):
-            break
-        
-        print(f"Uploading pages batch {file_index}")
-        write_pages_into_db(filename, db_worker)
+    stats = new_ingest_stats()
+    start_time = time.perf_counter()
+
+    chunk_pool = None
+    embed_pool = None
+
+    if workers > 1:
+        # spawn, а не fork: форк процесса с уже загруженным torch может зависнуть на блокировках OpenMP
+        context = multiprocessing.get_context("spawn")
+        embedder = db_worker.embedder
+
+        # Потоки torch делятся между процессами поровну, чтобы процессы не конкурировали за ядра
+        num_threads = config.EMBEDDER_NUM_THREADS or max(1, (os.cpu_count() or 1) // workers)
+
+        chunk_workers = chunk_workers or max(1, workers // 4)
+        chunk_pool = ProcessPoolExecutor(max_workers=chunk_workers, mp_context=context,
+                                         initializer=_init_chunk_worker, initargs=(embedder.model_name,))
+        embed_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                         initializer=_init_embed_worker,
+                                         initargs=(embedder.embedder_type, embedder.model_name, num_threads))
+
+    # Чанки всех файлов идут одним потоком, чтобы пачки не обрывались на границах файлов
+    tokenizer = db_worker.embedder.tokenizer
+    chunks = (
+        chunk
+        for filename in iter_wiki_filenames()
+        for chunk in iter_page_chunks(filename, tokenizer, doc_store, chunk_pool, (chunk_workers or 1) * 16, stats)
+    )
+
+    def track_articles(chunks):
+        for chunk in chunks:
+            metadata = chunk.payload["metadata"]
+            seen_wiki_ids.add(metadata["wiki_id"])
+            chunk_counts[metadata["wiki_id"]] = max(chunk_counts.get(metadata["wiki_id"], 0), metadata["chunk"] + 1)
+            yield chunk
+
+    def count_changed(chunks):
+        nonlocal changed_chunks
+        for chunk in chunks:
+            changed_chunks += 1
+            changed_wiki_ids.add(chunk.payload["metadata"]["wiki_id"])
+            yield chunk
+
+    chunks = count_changed(skip_unchanged_chunks(track_articles(chunks), stored_hashes, seen_ids))
+
+    try:
+        # Каждый процесс держит в работе до двух пачек, чтобы не простаивать между ними
+        written = write_chunks_into_db(chunks, db_worker, embed_pool=embed_pool, max_in_flight=workers * 2,
+                                       stats=stats)
+    finally:
+        for pool in (chunk_pool, embed_pool):
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start_time
+    for stage in stats.values():
+        print(stage.report(elapsed))
 
-        file_index += 1
+    metrics.log_event("ingest_finished", written=written, changed=changed_chunks, seconds=round(elapsed, 3),
+                      stages={stage.name: {"items": stage.items, "busy_seconds": round(stage.busy_seconds, 3)}
+                              for stage in stats.values()})
+
+    # Если часть чанков не записалась, не трогаем старые точки: лучше устаревшие данные, чем пропавшие
+    if written < changed_chunks:
+        print(f"{changed_chunks - written} chunks were not written, skipping removal of stale chunks")
+    else:
+        stale_ids = stored_hashes.keys() - seen_ids
+        db_worker.delete_points(stale_ids)
+        db_worker.flush()
+        print(f"Removed {len(stale_ids)} stale chunks")
+
+        # Статьи, от которых не осталось чанков, больше не нужны и в хранилище текстов
+        stale_wiki_ids = doc_store.ids() - seen_wiki_ids
+        doc_store.delete(stale_wiki_ids)
+        doc_store.commit()
+        print(f"Removed {len(stale_wiki_ids)} stale documents")
+
+        # Статья укоротилась, если пропал чанк сразу за её последним чанком
+        shortened_wiki_ids = {wiki_id for wiki_id, count in chunk_counts.items()
+                              if database.point_id(wiki_id, count) in stale_ids}
+        changed_wiki_ids.update(stale_wiki_ids, shortened_wiki_ids)
+
+    if answer_cache is not None:
+        removed = answer_cache.invalidate_articles(changed_wiki_ids)
+        print(f"Removed {removed} cached answers for changed articles")
 
     print("All done!")
 
+def cli_arguments_preprocess():
+    parser = ArgumentParser(description="A script for vectorizing wiki pages and writing them into the database")
+
+    parser.add_argument("--workers", required=False, type=int, default=1,
+                        help="Number of embedding processes (1 - everything runs in the current process)")
+
+    parser.add_argument("--chunk_workers", required=False, type=int, default=None,
+                        help="Number of text cleaning/chunking processes (default: workers // 4, at least 1)")
+
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Profile the run and print the report to stderr (profiler: {config.PROFILER})")
+
+    parser.add_argument("--profile_output", required=False, default=None,
+                        help="File for the full profiler report (.prof for cProfile, .html for pyinstrument)")
+
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = cli_arguments_preprocess()
+    metrics.setup_json_logging()
+
     db_worker = utils.get_db_worker()
     db_worker.create_collection()
 
-    write_wiki_into_db(db_worker)
+    doc_store = utils.get_document_store()
+    answer_cache = None
+    if config.ANSWER_CACHE_ENABLED:
+        answer_cache = utils.get_answer_cache(db_worker.embedder, update_collection=True)
+
+    with metrics.profiled(args.profile, args.profile_output):
+        write_wiki_into_db(db_worker, doc_store, workers=args.workers, chunk_workers=args.chunk_workers,
+                           answer_cache=answer_cache)
+    doc_store.close()
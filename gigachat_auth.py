@@ -0,0 +1,178 @@
+import os
+import time
+import logging
+import threading
+from uuid import uuid4
+
+import httpx
+
+import config
+from metrics import log_event
+
+
+class TokenError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def http_client_kwargs(ca_bundle_file=config.GIGACHAT_CA_BUNDLE, timeout=config.GIGACHAT_TIMEOUT) -> dict:
+    """
+    Общие настройки HTTP-клиентов GigaChat: сертификат Минцифры, таймауты и пул keep-alive соединений
+    """
+    return {
+        # Без файла сертификата проверяем по системным корневым сертификатам
+        "verify": ca_bundle_file if ca_bundle_file and os.path.exists(ca_bundle_file) else True,
+        "timeout": httpx.Timeout(timeout, connect=config.GIGACHAT_CONNECT_TIMEOUT),
+        "limits": httpx.Limits(max_connections=config.GIGACHAT_MAX_CONNECTIONS,
+                               max_keepalive_connections=config.GIGACHAT_MAX_CONNECTIONS)
+    }
+
+
+class GigaChatTokenManager:
+    """
+    Хранит access token GigaChat и срок его действия. Токен получается один раз при старте, а затем
+    обновляется в фоновом потоке за refresh_margin секунд (но не больше половины срока жизни токена) до истечения, поэтому запросы к модели не ждут авторизации.
+    Если фоновое обновление не успело (или токен отклонен сервером), токен получает первый запрос,
+    которому он нужен, а остальные одновременные запросы ждут его результата
+    """
+    def __init__(self, authorization_key: str, scope: str, client: httpx.Client, auth_url=config.SBER_AUTH_URL,
+                 refresh_margin=config.GIGACHAT_TOKEN_REFRESH_MARGIN, retry_delay=config.GIGACHAT_TOKEN_RETRY_DELAY):
+        """
+        :param authorization_key: ключ авторизации (Basic) из личного кабинета
+        :param scope: версия API (GIGACHAT_API_PERS/GIGACHAT_API_B2B/GIGACHAT_API_CORP)
+        :param client: HTTP-клиент с настроенным сертификатом, общий с запросами к модели
+        :param refresh_margin: за сколько секунд до истечения токена получать новый
+        :param retry_delay: пауза между попытками фонового обновления после ошибки, секунд
+        """
+        self.authorization_key = authorization_key
+        self.scope = scope
+        self.client = client
+        self.auth_url = auth_url
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0.0
+        # Срок жизни последнего полученного токена, секунд
+        self.lifetime = 0.0
+        self.fetches = 0
+
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = None
+
+    def start(self):
+        """
+        Получает первый токен и запускает фоновое обновление
+        """
+        self._refresh(min_lifetime=self.refresh_margin)
+
+        self.thread = threading.Thread(target=self._refresh_loop, daemon=True, name="gigachat-token")
+        self.thread.start()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+    def cached_token(self):
+        """
+        :return: действующий токен или None, если его нужно получить
+        """
+        with self.lock:
+            if self.access_token is not None and time.time() < self.expires_at - config.GIGACHAT_TOKEN_MIN_LIFETIME:
+                return self.access_token
+
+        return None
+
+    def token(self) -> str:
+        """
+        :return: действующий токен; при необходимости получает новый в текущем потоке
+        """
+        return self.cached_token() or self._refresh(min_lifetime=config.GIGACHAT_TOKEN_MIN_LIFETIME)
+
+    def invalidate(self, token: str):
+        """
+        Сервер отклонил token: следующий запрос получит новый
+        """
+        with self.lock:
+            if self.access_token == token:
+                self.access_token = None
+
+        self.wakeup.set()
+
+    def _refresh(self, min_lifetime: float) -> str:
+        """
+        Получает новый токен, если текущему осталось жить меньше min_lifetime секунд.
+        Одновременно запрос на авторизацию отправляет только один поток
+        """
+        with self.fetch_lock:
+            with self.lock:
+                if self.access_token is not None and time.time() < self.expires_at - min_lifetime:
+                    return self.access_token
+
+            access_token, expires_at = self._fetch()
+
+            with self.lock:
+                self.access_token = access_token
+                self.expires_at = expires_at
+                self.lifetime = expires_at - time.time()
+                self.fetches += 1
+
+            return access_token
+
+    def _fetch(self):
+        """
+        :return: (access token, время истечения в секундах unix time)
+        """
+        try:
+            response = self.client.post(
+                self.auth_url,
+                headers={
+                    "Content-Type": "application/x-www-form-urlencoded",
+                    "Accept": "application/json",
+                    "RqUID": str(uuid4()),
+                    "Authorization": f"Basic {self.authorization_key}"
+                },
+                data={"scope": self.scope}
+            )
+            response.raise_for_status()
+            response_json = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise TokenError(f"Failed to get GigaChat access token: {e}")
+
+        # expires_at приходит в миллисекундах
+        return response_json["access_token"], response_json["expires_at"] / 1000
+
+    def _margin(self) -> float:
+        """
+        :return: за сколько секунд до истечения обновлять токен. Токен, живущий не дольше refresh_margin,
+            обновляется на середине срока жизни, иначе фоновый поток запрашивал бы новый токен без остановки
+        """
+        with self.lock:
+            return min(self.refresh_margin, self.lifetime / 2)
+
+    def _refresh_loop(self):
+        while not self.closed:
+            margin = self._margin()
+
+            with self.lock:
+                if self.access_token is None:
+                    delay = 0
+                else:
+                    delay = max(config.GIGACHAT_TOKEN_MIN_REFRESH_INTERVAL, self.expires_at - margin - time.time())
+
+            if delay > 0 and self.wakeup.wait(delay):
+                # Разбудили раньше срока: токен отклонен или менеджер закрыт
+                self.wakeup.clear()
+
+            if self.closed:
+                return
+
+            try:
+                self._refresh(min_lifetime=self._margin())
+            except TokenError as e:
+                log_event("gigachat_token_refresh_failed", logging.WARNING, retry_in=self.retry_delay, error=str(e))
+                self.wakeup.wait(self.retry_delay)
+                self.wakeup.clear()
@@ -0,0 +1,175 @@
+import json
+import time
+import threading
+from uuid import uuid4
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+AUTH_PATH = "/api/v2/oauth"
+CHAT_PATH = "/api/v1/chat/completions"
+
+
+class StubState:
+    """
+    Выданные токены и счетчики запросов заглушки
+    """
+    def __init__(self, token_ttl: float, delay: float):
+        self.token_ttl = token_ttl
+        self.delay = delay
+
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.auth_requests = 0
+        self.chat_requests = 0
+        self.rejected = 0
+
+    def issue_token(self) -> dict:
+        token = uuid4().hex
+        expires_at = time.time() + self.token_ttl
+
+        with self.lock:
+            self.tokens[token] = expires_at
+            self.auth_requests += 1
+
+        return {"access_token": token, "expires_at": int(expires_at * 1000)}
+
+    def check_token(self, token: str) -> bool:
+        with self.lock:
+            self.chat_requests += 1
+
+            if self.tokens.get(token, 0) > time.time():
+                return True
+
+            self.rejected += 1
+            return False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"auth_requests": self.auth_requests, "chat_requests": self.chat_requests, "rejected": self.rejected}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Отвечает как API GigaChat: выдает токены с ограниченным сроком действия и отвечает на запросы чата
+    эхом вопроса. Запросы с неизвестным или истекшим токеном получают 401
+    """
+    # Keep-alive, как у настоящего API: клиент может переиспользовать соединения
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.state.stats())
+        else:
+            self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        body = self._read_body()
+
+        if self.path == AUTH_PATH:
+            if not self.headers.get("Authorization", "").startswith("Basic ") or not self.headers.get("RqUID"):
+                self._send_json(401, {"message": "Authorization error"})
+                return
+
+            self._send_json(200, self.server.state.issue_token())
+        elif self.path == CHAT_PATH:
+            token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+
+            if not self.server.state.check_token(token):
+                self._send_json(401, {"message": "Token has expired"})
+                return
+
+            self._chat(json.loads(body))
+        else:
+            self._send_json(404, {"message": "Not found"})
+
+    def _chat(self, request: dict):
+        question = next((m["content"] for m in reversed(request.get("messages", [])) if m.get("role") == "user"), "")
+        answer = f"Ответ заглушки на вопрос: {question}"
+
+        time.sleep(self.server.state.delay)
+
+        if not request.get("stream"):
+            self._send_json(200, {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "model": request.get("model"),
+                "object": "chat.completion"
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        words = answer.split(" ")
+        events = [
+            {"choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}]}
+            for i, word in enumerate(words)
+        ]
+
+        for event in events:
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+
+def create_stub_server(host="127.0.0.1", port=0, token_ttl=1800.0, delay=0.0) -> ThreadingHTTPServer:
+    """
+    Создает заглушку API GigaChat. Для тестов удобно запускать её в фоновом потоке:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    :param port: 0 - любой свободный порт (см. server.server_address)
+    :param token_ttl: время жизни выдаваемых токенов, секунд
+    :param delay: задержка ответа чата, секунд
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(token_ttl, delay)
+
+    return server
+
+
+def cli_arguments_preprocess():
+    parser = ArgumentParser(description="A local stub of the GigaChat API (OAuth and chat completions) for testing")
+
+    parser.add_argument("--host", required=False, default="127.0.0.1",
+                        help="Host to bind")
+
+    parser.add_argument("--port", required=False, type=int, default=8090,
+                        help="Port to bind")
+
+    parser.add_argument("--token_ttl", required=False, type=float, default=1800.0,
+                        help="Lifetime of issued access tokens in seconds")
+
+    parser.add_argument("--delay", required=False, type=float, default=0.0,
+                        help="Delay of every chat answer in seconds")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = cli_arguments_preprocess()
+
+    server = create_stub_server(args.host, args.port, args.token_ttl, args.delay)
+    host, port = server.server_address
+    print(f"GigaChat stub: SBER_AUTH_URL=http://{host}:{port}{AUTH_PATH} GIGACHAT_API_URL=http://{host}:{port}{CHAT_PATH}")
+
+    server.serve_forever()
@@ -1,12 +1,29 @@
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from gigachat import GigaChat
-from openai import OpenAI
+import copy
+import json
+import time
+import logging
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
 
-import requests
-from uuid import uuid4
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+from transformers.pytorch_utils import Conv1D
+from openai import OpenAI, AsyncOpenAI
+import httpx
 
 import config
+from context import TokenCounter
+from metrics import log_event
+from gigachat_auth import GigaChatTokenManager, http_client_kwargs
+
+# Слои кэша, которые при дописывании заменяют тензоры, а не пишут в них (transformers >= 4.56)
+try:
+    from transformers.cache_utils import DynamicLayer, DynamicSlidingWindowLayer
+    _APPEND_ONLY_LAYERS = (DynamicLayer, DynamicSlidingWindowLayer)
+except ImportError:
+    _APPEND_ONLY_LAYERS = ()
 
 
 class InvalidAuthKeyException(Exception):
@@ -17,110 +34,548 @@ class LLM:
     def answer(self, system_prompt: str, user_prompt: str) -> str:
         pass
 
+    def token_counter(self) -> TokenCounter:
+        """
+        :return: счетчик токенов промпта. По умолчанию токены оцениваются по числу символов
+        """
+        return TokenCounter()
+
+    def stats(self) -> dict:
+        """
+        :return: статистика вызовов модели (задержки, ошибки); по умолчанию не собирается
+        """
+        return {}
+
+    def cache_prompt_prefix(self, prefix: str):
+        """
+        Сообщает модели неизменную начальную часть системных промптов (см. promts.get_static_prompt),
+        чтобы та заранее подготовила её кэш. Удаленные API кэшируют общие префиксы сами, поэтому по умолчанию ничего не делает
+        """
+        pass
+
+    async def aanswer(self, system_prompt: str, user_prompt: str) -> str:
+        """
+        Асинхронная версия answer. По умолчанию выполняет answer в отдельном потоке, не блокируя event loop
+        """
+        return await asyncio.to_thread(self.answer, system_prompt, user_prompt)
+
+    def stream_answer(self, system_prompt: str, user_prompt: str):
+        """
+        Генерирует ответ по частям по мере его готовности. По умолчанию отдает весь ответ одной частью
+        :return: генератор фрагментов текста ответа
+        """
+        yield self.answer(system_prompt, user_prompt)
+
+    async def astream_answer(self, system_prompt: str, user_prompt: str):
+        """
+        Асинхронная версия stream_answer. По умолчанию читает stream_answer в отдельном потоке
+        """
+        stream = self.stream_answer(system_prompt, user_prompt)
+        done = object()
+
+        while (chunk := await asyncio.to_thread(next, stream, done)) is not done:
+            yield chunk
+
+class BatchScheduler:
+    """
+    Собирает одновременные запросы в батчи: после первого запроса ждет остальные не дольше max_wait секунд
+    (или пока батч не заполнится) и обрабатывает весь батч одним вызовом run_batch в фоновом потоке
+    """
+    def __init__(self, run_batch, max_batch_size: int, max_wait: float):
+        """
+        :param run_batch: функция, принимающая список запросов и возвращающая список результатов в том же порядке
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def submit(self, item) -> Future:
+        """
+        :return: future с результатом обработки item
+        """
+        future = Future()
+        self.queue.put((item, future))
+
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+        return future
+
+    def _collect_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect_batch()
+
+            try:
+                results = self.run_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class _DynamicInt8Linear(torch.nn.Module):
+    """
+    Линейный слой с динамической int8-квантизацией. Квантованное умножение считается в fp32,
+    поэтому вход приводится к fp32, а результат возвращается в типе входа (остальная модель остается в bf16/fp16)
+    """
+    def __init__(self, linear: torch.nn.Linear):
+        super().__init__()
+
+        self.linear = torch.ao.quantization.quantize_dynamic(
+            torch.nn.Sequential(linear), {torch.nn.Linear}, dtype=torch.qint8
+        )[0]
+
+    def forward(self, x):
+        return self.linear(x.float()).to(x.dtype)
+
+
+def _as_linear(module):
+    """
+    :return: nn.Linear с весами module (nn.Linear или Conv1D из transformers, как в GPT-2 и ruGPT-3.5) или None
+    """
+    if isinstance(module, torch.nn.Linear):
+        linear = torch.nn.Linear(module.in_features, module.out_features, bias=module.bias is not None)
+        weight = module.weight
+    elif isinstance(module, Conv1D):
+        # Conv1D хранит веса транспонированными: (in_features, out_features)
+        linear = torch.nn.Linear(module.weight.shape[0], module.nf, bias=module.bias is not None)
+        weight = module.weight.t()
+    else:
+        return None
+
+    with torch.no_grad():
+        linear.weight.copy_(weight.float())
+        if module.bias is not None:
+            linear.bias.copy_(module.bias.float())
+
+    return linear
+
+
+def quantize_linear_int8(model):
+    """
+    Динамическая int8-квантизация линейных слоев (nn.Linear и Conv1D, torch, CPU). Слои квантуются по одному,
+    поэтому в fp32 одновременно находится только один слой, а не вся модель. Остальные веса (эмбеддинги,
+    нормализации) остаются в исходном типе. Выходной слой, связанный с эмбеддингами входа, не квантуется:
+    его веса общие с эмбеддингами, и квантованная копия только добавила бы памяти
+    """
+    input_embeddings = model.get_input_embeddings()
+    tied_weight = input_embeddings.weight if input_embeddings is not None else None
+
+    quantized = 0
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if tied_weight is not None and getattr(child, "weight", None) is tied_weight:
+                continue
+
+            linear = _as_linear(child)
+            if linear is None:
+                continue
+
+            setattr(module, name, _DynamicInt8Linear(linear))
+            quantized += 1
+
+    if quantized == 0:
+        raise ValueError(f"int8 quantization found no linear layers in {type(model).__name__}, use 8bit or 4bit")
+
+    return model
+
+
+class _EventStoppingCriteria(StoppingCriteria):
+    """
+    Останавливает generate, когда установлено событие stop
+    """
+    def __init__(self, stop: threading.Event):
+        self.stop = stop
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.stop.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def _copy_cache(cache):
+    """
+    Копия KV-кэша для одного запроса. Слои DynamicCache не меняют тензоры на месте: generate и crop заменяют их
+    новыми (torch.cat, срез), поэтому копии нужны только свои объекты слоев, а тензоры префикса остаются общими.
+    Кэши, которые пишут в тензоры на месте (StaticCache и т.п.), копируются целиком
+    """
+    layers = getattr(cache, "layers", None)
+    if not _APPEND_ONLY_LAYERS or layers is None or any(type(layer) not in _APPEND_ONLY_LAYERS for layer in layers):
+        return copy.deepcopy(cache)
+
+    copied = copy.copy(cache)
+    copied.layers = [copy.copy(layer) for layer in layers]
+
+    return copied
+
+
 class LocalLLM(LLM):
-    def __init__(self, model_name="ai-forever/ruGPT-3.5-13B", device=None):
+    QUANTIZATIONS = (None, "int8", "8bit", "4bit")
+
+    def __init__(self, model_name="ai-forever/ruGPT-3.5-13B", device=None, dtype=config.LOCAL_LLM_DTYPE,
+                 quantization=config.LOCAL_LLM_QUANTIZATION, max_batch_size=config.LOCAL_LLM_MAX_BATCH_SIZE,
+                 batch_wait=config.LOCAL_LLM_BATCH_WAIT):
+        """
+        :param dtype: тип весов модели (float32, bfloat16, float16)
+        :param quantization: None, int8 - динамическая int8-квантизация PyTorch (только CPU),
+            8bit/4bit - квантизация bitsandbytes при загрузке
+        :param max_batch_size: сколько одновременных вызовов answer генерируются одним батчем
+        :param batch_wait: сколько секунд после первого запроса ждать остальные запросы батча
+        """
         if device is None:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
             self.device = torch.device(device)
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name
-        )
 
-    def answer(self, system_prompt: str, user_prompt: str) -> str:
+        # В батче промпты разной длины дополняются слева, чтобы генерация у всех продолжалась с последнего токена
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self.model = self._load_model(model_name, getattr(torch, dtype), quantization)
+
+        # Модель одна на процесс: параллельные generate только делят между собой память и ядра
+        self.generate_lock = threading.Lock()
+
+        # KV-кэши статических префиксов системных промптов: {текст префикса: (id токенов префикса, кэш)}
+        self.prefix_caches = {}
+
+        self.scheduler = BatchScheduler(self._answer_batch, max_batch_size, batch_wait) if max_batch_size > 1 else None
+
+    def _load_model(self, model_name: str, dtype: torch.dtype, quantization: str):
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {quantization}. Available: {self.QUANTIZATIONS}")
+
+        # Веса читаются из safetensors через mmap прямо в нужный тип, без промежуточной fp32 копии модели
+        kwargs = dict(dtype=dtype, low_cpu_mem_usage=True)
+
+        if quantization in ("8bit", "4bit"):
+            try:
+                from transformers import BitsAndBytesConfig
+                import bitsandbytes  # noqa: F401
+            except ImportError:
+                raise ImportError("8bit/4bit quantization requires bitsandbytes: pip install bitsandbytes")
+
+            if quantization == "8bit":
+                kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+            else:
+                kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=dtype
+                )
+
+            # bitsandbytes сам размещает квантованные веса, переносить модель через .to нельзя
+            return AutoModelForCausalLM.from_pretrained(model_name, device_map={"": self.device}, **kwargs)
+
+        model = AutoModelForCausalLM.from_pretrained(model_name, **kwargs)
+
+        if quantization == "int8":
+            if self.device.type != "cpu":
+                raise ValueError("int8 quantization is supported only on CPU, use 8bit or 4bit on GPU")
+            model = quantize_linear_int8(model)
+
+        return model.to(self.device)
+
+    def token_counter(self) -> TokenCounter:
+        return TokenCounter(self.tokenizer)
+
+    def _render_prompt(self, system_prompt: str, user_prompt: str) -> str:
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ]
-        
-        inputs = self.tokenizer.apply_chat_template(
+
+        return self.tokenizer.apply_chat_template(
             messages,
             add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
+            tokenize=False
+        )
+
+    def _prepare_inputs(self, system_prompt: str, user_prompt: str):
+        # Текст шаблона уже содержит спецтокены, поэтому токенизируем его без добавления своих
+        return self.tokenizer(
+            self._render_prompt(system_prompt, user_prompt),
+            add_special_tokens=False,
             return_tensors="pt"
         ).to(self.device)
 
-        outputs = self.model.generate(
-            **inputs,
-            max_new_tokens=512
-        )
+    def cache_prompt_prefix(self, prefix: str):
+        """
+        Считает KV-кэш для начала промпта до конца prefix включительно (вместе с началом шаблона чата).
+        Запросы, системный промпт которых начинается с prefix, не пересчитывают эти токены заново
+        """
+        if prefix in self.prefix_caches:
+            return
+
+        rendered = self._render_prompt(prefix, "")
+
+        # Шаблон чата может изменить текст системного промпта (например, обрезать пробелы через | trim):
+        # тогда префикс не найти в промпте, и для этой роли промпт считается целиком
+        position = rendered.find(prefix)
+        if position == -1:
+            log_event("prefix_cache_skipped", logging.WARNING, reason="prefix is changed by the chat template")
+            return
+
+        prefix_text = rendered[:position + len(prefix)]
+
+        prefix_ids = self.tokenizer(prefix_text, add_special_tokens=False, return_tensors="pt")["input_ids"].to(self.device)
+
+        with self.generate_lock, torch.no_grad():
+            outputs = self.model(input_ids=prefix_ids, use_cache=True)
 
-        return self.tokenizer.decode(outputs[0][inputs["input_ids"].shape[-1]:], skip_special_tokens=True)
+        self.prefix_caches[prefix] = (prefix_ids[0], outputs.past_key_values)
+
+    def _prefix_cache(self, system_prompt: str, input_ids):
+        """
+        Подбирает KV-кэш префикса для запроса
+        :return: копия кэша, обрезанная до общего с input_ids начала, или None
+        """
+        for prefix, (prefix_ids, cache) in self.prefix_caches.items():
+            if not system_prompt.startswith(prefix):
+                continue
+
+            # Токенизатор может склеить последние токены префикса с началом продолжения,
+            # поэтому используем только реально совпадающее начало. Хотя бы один токен должен остаться для generate
+            length = min(len(prefix_ids), len(input_ids) - 1)
+            mismatch = (prefix_ids[:length] != input_ids[:length]).nonzero()
+            common = int(mismatch[0]) if len(mismatch) else length
+
+            if common == 0 or (common < len(prefix_ids) and not hasattr(cache, "crop")):
+                return None
+
+            # generate дописывает в кэш токены запроса, поэтому каждому запросу нужна своя копия
+            cache = _copy_cache(cache)
+            if common < len(prefix_ids):
+                cache.crop(common - len(prefix_ids))
+
+            return cache
+
+        return None
+
+    def _generate_kwargs(self, system_prompt: str, user_prompt: str) -> dict:
+        inputs = self._prepare_inputs(system_prompt, user_prompt)
+        kwargs = dict(inputs, max_new_tokens=config.LOCAL_LLM_MAX_NEW_TOKENS)
+
+        cache = self._prefix_cache(system_prompt, inputs["input_ids"][0])
+        if cache is not None:
+            kwargs["past_key_values"] = cache
+
+        return kwargs
+
+    def _answer_single(self, system_prompt: str, user_prompt: str) -> str:
+        kwargs = self._generate_kwargs(system_prompt, user_prompt)
+
+        with self.generate_lock:
+            outputs = self.model.generate(**kwargs)
+
+        return self.tokenizer.decode(outputs[0][kwargs["input_ids"].shape[-1]:], skip_special_tokens=True)
+
+    def _answer_batch(self, prompts: list) -> list:
+        """
+        Генерирует ответы на несколько промптов одним вызовом generate
+        :param prompts: список пар (system_prompt, user_prompt)
+        :return: список ответов в том же порядке
+        """
+        # Одиночный запрос генерируется с KV-кэшем префикса; в батче префиксы разной длины после
+        # дополнения слева не совпадают по позициям, поэтому батч считается целиком
+        if len(prompts) == 1:
+            return [self._answer_single(*prompts[0])]
+
+        inputs = self.tokenizer(
+            [self._render_prompt(system_prompt, user_prompt) for system_prompt, user_prompt in prompts],
+            add_special_tokens=False,
+            padding=True,
+            return_tensors="pt"
+        ).to(self.device)
+
+        with self.generate_lock:
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=config.LOCAL_LLM_MAX_NEW_TOKENS,
+                pad_token_id=self.tokenizer.pad_token_id
+            )
+
+        prompt_length = inputs["input_ids"].shape[-1]
+
+        return [self.tokenizer.decode(output[prompt_length:], skip_special_tokens=True) for output in outputs]
+
+    def answer(self, system_prompt: str, user_prompt: str) -> str:
+        if self.scheduler is None:
+            return self._answer_single(system_prompt, user_prompt)
+
+        # Одновременные вызовы answer из разных потоков (сервер) собираются в общий батч
+        return self.scheduler.submit((system_prompt, user_prompt)).result()
+
+    def stream_answer(self, system_prompt: str, user_prompt: str):
+        kwargs = self._generate_kwargs(system_prompt, user_prompt)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop = threading.Event()
+        errors = []
+
+        def generate():
+            try:
+                with self.generate_lock:
+                    if not stop.is_set():
+                        self.model.generate(**kwargs, streamer=streamer,
+                                            stopping_criteria=StoppingCriteriaList([_EventStoppingCriteria(stop)]))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # Без end() читатель streamer ждал бы следующий фрагмент вечно
+                streamer.end()
+
+        # generate кладет токены в streamer из отдельного потока, а мы читаем их по мере появления
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+
+        try:
+            for text in streamer:
+                if text:
+                    yield text
+        finally:
+            # Если читатель закрыл генератор раньше конца ответа, generate останавливается на следующем токене
+            # и освобождает generate_lock
+            stop.set()
+
+        thread.join()
+
+        if errors:
+            raise errors[0]
 
 class RemoteGigaChatLLM(LLM):
-    def __init__(self, model_name: str, scope: str, authorization_key: str):
-        self.auth_url = config.SBER_AUTH_URL
-        self.model_url = config.GIGACHAT_API_URL
-        self.scope = scope
-        self.authorization_key = authorization_key
-
-        self.giga = GigaChat(
-            model=model_name,
-            credentials=authorization_key,
-            ca_bundle_file="russian_trusted_root_ca.cer"
-        )
+    """
+    Модель GigaChat через REST API. Один пул HTTP-соединений (keep-alive) на все одновременные запросы,
+    access token обновляется заранее в фоне (см. gigachat_auth.GigaChatTokenManager)
+    """
+    def __init__(self, model_name: str, scope: str, authorization_key: str, auth_url=config.SBER_AUTH_URL,
+                 api_url=config.GIGACHAT_API_URL, ca_bundle_file=config.GIGACHAT_CA_BUNDLE):
+        self.model_name = model_name
+        self.model_url = api_url
+        self.ca_bundle_file = ca_bundle_file
+
+        self.client = httpx.Client(**http_client_kwargs(ca_bundle_file))
+        # Асинхронный клиент создается при первом запросе: он привязан к event loop, в котором используется
+        self.async_client = None
+
+        self.tokens = GigaChatTokenManager(authorization_key, scope, self.client, auth_url)
+        self.tokens.start()
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(**http_client_kwargs(self.ca_bundle_file))
+
+        return self.async_client
+
+    def _payload(self, system_prompt: str, user_prompt: str, stream=False) -> dict:
+        return {
+            "model": self.model_name,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            "stream": stream
+        }
+
+    @staticmethod
+    def _headers(token: str) -> dict:
+        return {"Accept": "application/json", "Authorization": f"Bearer {token}"}
 
-        self.access_key = self.generate_access_key()
+    def _check_response(self, response: httpx.Response, token: str):
+        if response.status_code == 401:
+            self.tokens.invalidate(token)
+            raise InvalidAuthKeyException("Invalid authorization key. Maybe, key expired")
 
-    def generate_access_key(self) -> str:
-        # payload = f"scope={self.scope}"
+        response.raise_for_status()
 
-        # headers = {
-        #   'Content-Type': 'application/x-www-form-urlencoded',
-        #   'Accept': 'application/json',
-        #   'RqUID': uuid4().hex,
-        #   'Authorization': f"Basic {self.authorization_key}"
-        # }
+    @staticmethod
+    def _stream_content(line: str):
+        """
+        :return: текст фрагмента из строки server-sent events или None
+        """
+        if not line.startswith("data:"):
+            return None
 
-        # response = requests.request("POST", self.auth_url, headers=headers, data=payload, verify=False)
-        
-        # print(response)
-        # response_json = response.json()
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
 
-        # return response_json.get("access_token", "")
-        return self.giga.get_token()
+        choices = json.loads(data).get("choices")
+        if choices:
+            return choices[0].get("delta", {}).get("content")
 
+        return None
 
     def answer(self, system_prompt: str, user_prompt: str) -> str:
-        # headers = {
-        #   'Content-Type': 'application/json',
-        #   'Accept': 'application/json',
-        #   'Authorization': f"Bearer {self.authorization_key}"
-        # }
-
-        # messages = [
-        #     {"role": "system", "content": system_prompt},
-        #     {"role": "user", "content": user_prompt}
-        # ]
-
-        # payload={
-        #     "model": "GigaChat",
-        #     "messages": messages,
-        #     "stream": False,
-        #     "repetition_penalty": 1
-        # }
-
-        # response = requests.request("POST", self.model_url, headers=headers, data=payload)
-        
-        # if response.status_code == 200:
-        #     response_json = response.json()
-        #     return response_json["choices"][0]["message"]["content"]
-        # elif response.status_code == 401:
-        #     print("Exception 401 occuried! Authorization key was regenerated! Try to send query again...")
-        #     self.last_access_key = self.get_access_key()
-        #     raise InvalidAuthKeyException("Invalid authorization key. Maybe, key expired")
-        # else:
-        #     raise Exception(f"Request error occured: {response.json()}")
-        response = self.giga.chat(system_prompt)
+        token = self.tokens.token()
+        response = self.client.post(self.model_url, headers=self._headers(token),
+                                    json=self._payload(system_prompt, user_prompt))
+        self._check_response(response, token)
 
-        return response.choices[0].message.content
+        return response.json()["choices"][0]["message"]["content"]
+
+    async def aanswer(self, system_prompt: str, user_prompt: str) -> str:
+        # Получение токена блокирует поток, поэтому, если действующего токена нет, ждем его вне event loop
+        token = self.tokens.cached_token() or await asyncio.to_thread(self.tokens.token)
+        response = await self._get_async_client().post(self.model_url, headers=self._headers(token),
+                                                       json=self._payload(system_prompt, user_prompt))
+        self._check_response(response, token)
+
+        return response.json()["choices"][0]["message"]["content"]
+
+    def stream_answer(self, system_prompt: str, user_prompt: str):
+        token = self.tokens.token()
+
+        with self.client.stream("POST", self.model_url, headers=self._headers(token),
+                                json=self._payload(system_prompt, user_prompt, stream=True)) as response:
+            self._check_response(response, token)
+
+            for line in response.iter_lines():
+                content = self._stream_content(line)
+                if content:
+                    yield content
+
+    async def astream_answer(self, system_prompt: str, user_prompt: str):
+        token = self.tokens.cached_token() or await asyncio.to_thread(self.tokens.token)
+
+        async with self._get_async_client().stream("POST", self.model_url, headers=self._headers(token),
+                                                   json=self._payload(system_prompt, user_prompt, stream=True)) as response:
+            self._check_response(response, token)
+
+            async for line in response.aiter_lines():
+                content = self._stream_content(line)
+                if content:
+                    yield content
 
 class RemoteDeepseekLLM(LLM):
     def __init__(self, api_key: str):
         self.client = OpenAI(api_key=api_key, base_url=config.DEEPSEEK_API_URL)
+        self.async_client = AsyncOpenAI(api_key=api_key, base_url=config.DEEPSEEK_API_URL)
 
     def answer(self, system_prompt: str, user_prompt: str) -> str:
         response = self.client.chat.completions.create(
@@ -135,3 +590,42 @@ class RemoteDeepseekLLM(LLM):
 
         return response.choices[0].message.content
 
+    async def aanswer(self, system_prompt: str, user_prompt: str) -> str:
+        response = await self.async_client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            stream=False
+        )
+
+        return response.choices[0].message.content
+
+    def stream_answer(self, system_prompt: str, user_prompt: str):
+        stream = self.client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            stream=True
+        )
+
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def astream_answer(self, system_prompt: str, user_prompt: str):
+        stream = await self.async_client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            stream=True
+        )
+
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
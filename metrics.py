@@ -0,0 +1,236 @@
+import sys
+import json
+import asyncio
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextvars
+from uuid import uuid4
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import config
+
+
+class Histogram:
+    """
+    Потокобезопасная гистограмма в формате Prometheus: накопительные счетчики по границам buckets, сумма и число значений
+    """
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=config.METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        self.lock = threading.Lock()
+        # {значения меток: [счетчики по bucket (+Inf последним), сумма]}
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> str:
+        """
+        :return: гистограмма в текстовом формате Prometheus
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+
+        with self.lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self.series.items())
+
+        for key, counts, total in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+
+        return "\n".join(lines)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def histogram(name: str, documentation: str, labelnames=(), buckets=config.METRICS_BUCKETS) -> Histogram:
+    """
+    :return: гистограмма name из общего реестра (создается при первом обращении)
+    """
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = Histogram(name, documentation, labelnames, buckets)
+        return _registry[name]
+
+
+def render_prometheus() -> str:
+    """
+    :return: все метрики реестра в текстовом формате Prometheus (для GET /metrics)
+    """
+    with _registry_lock:
+        metrics = list(_registry.values())
+
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+STAGE_SECONDS = histogram("rag_stage_duration_seconds", "Duration of RAG pipeline stages in seconds", ("stage",))
+
+
+logger = logging.getLogger("rag")
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Пишет каждую запись лога одной строкой JSON: время, уровень, событие и его поля
+    """
+    def format(self, record) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", {}))
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_json_logging(level=config.LOG_LEVEL, stream=None):
+    """
+    Направляет логи пайплайна (логгер rag) в stream (по умолчанию stderr) в виде JSON-строк
+    """
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter())
+
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def log_event(event: str, level=logging.INFO, **fields):
+    """
+    Пишет структурированное событие в лог
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
+
+
+# Id трассировки текущего запроса: все стадии одного ответа попадают в лог с одним trace_id
+_trace_id = contextvars.ContextVar("rag_trace_id", default=None)
+
+
+def run_in_executor(executor, func, *args):
+    """
+    loop.run_in_executor с контекстом вызывающего кода: сам run_in_executor контекст не копирует,
+    и стадии, выполненные в пуле потоков, получали бы свой trace_id вместо trace_id запроса
+    :return: awaitable с результатом func(*args)
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(executor, contextvars.copy_context().run, func, *args)
+
+
+def record_stage(stage: str, seconds: float, **fields):
+    """
+    Учитывает длительность стадии, измеренную вручную (например, время до первого токена)
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    log_event("span", logging.DEBUG, trace_id=_trace_id.get(), stage=stage, duration_ms=round(seconds * 1000, 3), **fields)
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """
+    Измеряет длительность блока: значение попадает в гистограмму rag_stage_duration_seconds{stage=...}
+    и, при уровне логирования DEBUG, в JSON-лог вместе с fields и trace_id запроса
+    """
+    token = None
+    if _trace_id.get() is None:
+        token = _trace_id.set(uuid4().hex[:16])
+
+    start_time = time.perf_counter()
+    error = None
+
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        if error is not None:
+            fields["error"] = error
+
+        record_stage(stage, time.perf_counter() - start_time, **fields)
+
+        if token is not None:
+            try:
+                _trace_id.reset(token)
+            except ValueError:
+                # Асинхронный генератор, брошенный без aclose, завершается в другом контексте
+                pass
+
+
+@contextmanager
+def profiled(enabled=True, output=None, profiler=config.PROFILER):
+    """
+    Профилирует блок и печатает отчет в stderr
+    :param enabled: False - блок выполняется без профилирования
+    :param output: файл для полного отчета (cProfile - .prof для snakeviz/pstats, pyinstrument - html)
+    :param profiler: cprofile или pyinstrument (нужен пакет pyinstrument)
+    """
+    if not enabled:
+        yield
+        return
+
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("pyinstrument is not installed, falling back to cProfile", file=sys.stderr)
+        else:
+            instrument = Profiler()
+            instrument.start()
+            try:
+                yield
+            finally:
+                instrument.stop()
+                print(instrument.output_text(unicode=True, color=False), file=sys.stderr)
+
+                if output:
+                    with open(output, "w", encoding="utf-8") as f:
+                        f.write(instrument.output_html())
+            return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(config.PROFILE_TOP_N)
+
+        if output:
+            profile.dump_stats(output)
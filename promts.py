@@ -1,13 +1,36 @@
-def get_system_prompt(user_prompt: str, context: str, role: str = "default") -> str:
+# Промпт состоит из статической части роли (инструкции, стиль, примеры) и динамической части (документы и вопрос).
+# Статическая часть идет первой и не меняется между запросами: так у всех запросов одной роли общий префикс токенов,
+# который переиспользуют кэш контекста DeepSeek и KV-кэш LocalLLM (см. LocalLLM.cache_prompt_prefix)
+ROLES = ("default", "bandit")
+
+
+def get_static_prompt(role: str = "default") -> str:
+    """
+    :return: статическая часть системного промпта роли, одинаковая для всех запросов
+    """
     if role == "default":
-        return _default_system_prompt(user_prompt, context)
+        return _default_system_prompt()
     elif role == "bandit":
-        return _bandit_system_prompt(user_prompt, context)
+        return _bandit_system_prompt()
     else:
         raise ValueError(f"Unknown role: {role}")
 
-def _default_system_prompt(user_prompt, context) -> str:
-        return (f"""
+def get_dynamic_prompt(user_prompt: str, context: str) -> str:
+    """
+    :return: часть системного промпта, зависящая от запроса: найденные документы и вопрос
+    """
+    return (f"""
+            Документы базы знаний: <CONTEXT_START>{context}<CONTEXT_END>
+
+            Вопрос: {user_prompt}
+        """
+    )
+
+def get_system_prompt(user_prompt: str, context: str, role: str = "default") -> str:
+    return get_static_prompt(role) + get_dynamic_prompt(user_prompt, context)
+
+def _default_system_prompt() -> str:
+        return ("""
             Ты - умный и доброжелательный ассистент, который помогает людям находить информацию в текстах.
             Отвечай на вопросы, используя только предоставленные документы.
             Если ответ не найден в документах, скажи 'Извините, я не знаю ответа на этот вопрос.'
@@ -16,8 +39,8 @@ def _default_system_prompt(user_prompt, context) -> str:
             - Эксперт по лору и сюжетным линиям игр S.T.A.L.K.E.R.
 
             Инструкция:
-            1. Анализируй содержание релевантных документов базы знаний: <CONTEXT_START>{context}<CONTEXT_END>
-            2. Отвечай максимально конкретно на вопрос {user_prompt}
+            1. Анализируй содержание релевантных документов базы знаний, они приведены ниже между <CONTEXT_START> и <CONTEXT_END>
+            2. Отвечай максимально конкретно на вопрос, он приведен после документов
             3. Если в документах нет информации для ответа, скажи 'Извините, я не знаю ответа на этот вопрос.'
             4. Пиши ответ на русском языке, избегай англицизмов и жаргонизмов.
             5. Не придумывай информацию, избегай лишних слов и воды.
@@ -43,8 +66,8 @@ def _default_system_prompt(user_prompt, context) -> str:
         """
         )
 
-def _bandit_system_prompt(user_prompt, context) -> str:
-        return (f"""
+def _bandit_system_prompt() -> str:
+        return ("""
             Ты - бывалый бандит, который ценит порядки и следит за базаром.
             Отвечай на вопросы молодого маслёнка, используя только предоставленные доки.
             Если инфы нет, скажи 'Не ну ты внатуре загнул, чё попроще спроси, а?.'
@@ -54,8 +77,8 @@ def _bandit_system_prompt(user_prompt, context) -> str:
             - Харизматичный и ровный мужик
 
             Инструкция:
-            1. Анализируй содержание релевантных документов базы знаний: <CONTEXT_START>{context}<CONTEXT_END>
-            2. Отвечай максимально конкретно на вопрос {user_prompt}
+            1. Анализируй содержание релевантных документов базы знаний, они приведены ниже между <CONTEXT_START> и <CONTEXT_END>
+            2. Отвечай максимально конкретно на вопрос, он приведен после документов
             3. Если в документах нет информации для ответа, скажи 'Не ну ты внатуре загнул, чё попроще спроси, а?'
             4. Пиши ответ на русском языке, можешь использовать тюремные жаргонизмы.
             5. Не придумывай информацию, избегай лишних слов и воды.
@@ -0,0 +1,363 @@
+import time
+import random
+import asyncio
+import inspect
+import threading
+from collections import deque
+
+import numpy as np
+
+import config
+from llm import LLM
+from context import TokenCounter
+
+
+class LLMUnavailableError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class BackendStats:
+    """
+    Статистика вызовов одной модели: задержки последних успешных ответов, число ошибок, таймаутов и дублирований
+    """
+    def __init__(self, window=config.ROUTER_STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedged = 0
+        self.wins = 0
+
+    def record(self, latency=None, error=None):
+        """
+        :param latency: время успешного ответа в секундах
+        :param error: исключение неудачного вызова
+        """
+        with self.lock:
+            self.calls += 1
+
+            if error is None:
+                self.latencies.append(latency)
+            elif isinstance(error, asyncio.TimeoutError):
+                self.timeouts += 1
+            else:
+                self.errors += 1
+
+    def count_hedged(self):
+        with self.lock:
+            self.hedged += 1
+
+    def count_win(self):
+        """
+        Дублированный запрос к этой модели ответил раньше основного
+        """
+        with self.lock:
+            self.wins += 1
+
+    def percentile(self, q: float):
+        """
+        :return: q-й перцентиль задержки в секундах или None, если ответов еще не было
+        """
+        with self.lock:
+            if not self.latencies:
+                return None
+            return float(np.percentile(self.latencies, q))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {"calls": self.calls, "errors": self.errors, "timeouts": self.timeouts,
+                     "hedged": self.hedged, "wins": self.wins}
+
+        stats["latency_ms"] = {
+            f"p{q}": round(float(np.percentile(latencies, q)) * 1000, 1) if latencies else None
+            for q in (50, 95, 99)
+        }
+
+        return stats
+
+
+class CircuitBreaker:
+    """
+    Отключает модель после failures неудачных или медленных вызовов подряд. Через reset_timeout секунд
+    модели дается один пробный вызов: при успехе она снова используется, при неудаче отключается заново
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures=config.ROUTER_BREAKER_FAILURES, reset_timeout=config.ROUTER_BREAKER_RESET):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def allow(self) -> bool:
+        """
+        :return: можно ли сейчас вызывать модель. В полуоткрытом состоянии разрешается только один пробный вызов
+        """
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+
+            return False
+
+    def release(self):
+        """
+        Пробный вызов отменен без результата: следующий вызов снова может стать пробным
+        """
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failures:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RouterLLM(LLM):
+    """
+    Отвечает через несколько моделей в порядке приоритета. У каждого ответа есть общий срок deadline.
+    Если основная модель не ответила за время своего p95 (hedge_quantile), тот же запрос дублируется следующей
+    модели и берется первый ответ. Модели, которые часто ошибаются или отвечают слишком медленно, временно отключаются
+    (CircuitBreaker), а при ошибке всех моделей запрос повторяется с экспоненциальной задержкой со случайным разбросом
+    """
+    def __init__(self, backends: dict, deadline=config.ROUTER_DEADLINE, retries=config.ROUTER_RETRIES,
+                 hedge_quantile=config.ROUTER_HEDGE_QUANTILE, hedge_delay=config.ROUTER_HEDGE_DELAY,
+                 hedge_min_samples=config.ROUTER_HEDGE_MIN_SAMPLES, slow_call=config.ROUTER_SLOW_CALL):
+        """
+        :param backends: {название: объект LLM} в порядке приоритета
+        :param deadline: время на весь ответ в секундах, включая повторы
+        :param retries: число повторов, если ни одна модель не ответила
+        :param hedge_quantile: перцентиль задержки основной модели, после которого запрос дублируется
+        :param hedge_delay: задержка перед дублированием, пока ответов меньше hedge_min_samples
+        :param slow_call: ответ дольше стольких секунд считается неудачей для CircuitBreaker
+        """
+        if not backends:
+            raise ValueError("RouterLLM needs at least one backend")
+
+        self.backends = dict(backends)
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.slow_call = slow_call
+
+        self.breakers = {name: CircuitBreaker() for name in self.backends}
+        self.backend_stats = {name: BackendStats() for name in self.backends}
+
+        # Все асинхронные вызовы моделей идут в одном event loop: клиенты API привязываются к loop, в котором созданы
+        self.loop = None
+        self.loop_lock = threading.Lock()
+
+    def token_counter(self) -> TokenCounter:
+        return next(iter(self.backends.values())).token_counter()
+
+    def cache_prompt_prefix(self, prefix: str):
+        for backend in self.backends.values():
+            backend.cache_prompt_prefix(prefix)
+
+    def stats(self) -> dict:
+        return {
+            name: dict(self.backend_stats[name].snapshot(), circuit=self.breakers[name].state)
+            for name in self.backends
+        }
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True, name="llm-router").start()
+
+            return self.loop
+
+    def _hedge_delay(self, name: str) -> float:
+        stats = self.backend_stats[name]
+
+        if len(stats.latencies) < self.hedge_min_samples:
+            return self.hedge_delay
+
+        return stats.percentile(self.hedge_quantile)
+
+    async def _call(self, name: str, system_prompt: str, user_prompt: str, timeout: float) -> str:
+        start_time = time.monotonic()
+
+        try:
+            answer = await asyncio.wait_for(self.backends[name].aanswer(system_prompt, user_prompt), timeout)
+        except asyncio.CancelledError:
+            # Проигравший дублированный запрос отменяется и не считается ни успехом, ни ошибкой
+            self.breakers[name].release()
+            raise
+        except Exception as e:
+            self.backend_stats[name].record(error=e)
+            self.breakers[name].record_failure()
+            raise
+
+        latency = time.monotonic() - start_time
+        self.backend_stats[name].record(latency=latency)
+
+        if latency > self.slow_call:
+            self.breakers[name].record_failure()
+        else:
+            self.breakers[name].record_success()
+
+        return answer
+
+    async def _attempt(self, system_prompt: str, user_prompt: str, deadline_at: float) -> str:
+        """
+        Одна попытка ответа: основная модель и, при задержке или ошибке, дублирование на следующую доступную
+        """
+        # CircuitBreaker.allow занимает пробный вызов полуоткрытой модели, поэтому спрашиваем его только
+        # непосредственно перед запуском, иначе не запущенная модель осталась бы с занятым пробным вызовом
+        candidates = list(self.backends)
+        tasks = {}
+
+        def start():
+            """
+            Запускает следующую доступную модель
+            :return: её название или None, если доступных моделей не осталось
+            """
+            while candidates:
+                name = candidates.pop(0)
+                if self.breakers[name].allow():
+                    timeout = max(0.0, deadline_at - time.monotonic())
+                    tasks[asyncio.ensure_future(self._call(name, system_prompt, user_prompt, timeout))] = name
+                    return name
+
+            return None
+
+        primary = start()
+        if primary is None:
+            raise LLMUnavailableError("All LLM backends are unavailable (circuit open)")
+
+        hedge_at = time.monotonic() + self._hedge_delay(primary)
+        last_error = None
+
+        try:
+            while tasks:
+                now = time.monotonic()
+                wait_until = min(hedge_at, deadline_at) if candidates else deadline_at
+
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, wait_until - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    name = tasks.pop(task)
+
+                    if task.exception() is None:
+                        if name != primary:
+                            self.backend_stats[name].count_win()
+                        return task.result()
+
+                    last_error = task.exception()
+
+                    # Модель ошиблась: сразу пробуем следующую, не дожидаясь времени дублирования
+                    start()
+
+                if not done:
+                    if time.monotonic() >= deadline_at:
+                        error = asyncio.TimeoutError(f"No LLM answer within {self.deadline}s")
+
+                        for name in tasks.values():
+                            self.backend_stats[name].record(error=error)
+                            self.breakers[name].record_failure()
+
+                        raise error
+
+                    if candidates and time.monotonic() >= hedge_at:
+                        name = start()
+                        if name is not None:
+                            self.backend_stats[name].count_hedged()
+        finally:
+            for task, name in tasks.items():
+                # Задача, отмененная до первого шага, не заходит в _call, и пробный вызов освобождается здесь
+                if inspect.getcoroutinestate(task.get_coro()) == inspect.CORO_CREATED:
+                    self.breakers[name].release()
+                task.cancel()
+
+        raise last_error
+
+    async def _answer(self, system_prompt: str, user_prompt: str) -> str:
+        deadline_at = time.monotonic() + self.deadline
+
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._attempt(system_prompt, user_prompt, deadline_at)
+            except Exception:
+                remaining = deadline_at - time.monotonic()
+                if attempt == self.retries or remaining <= 0:
+                    raise
+
+                # Экспоненциальная задержка со случайным разбросом, чтобы повторы разных запросов не шли волной
+                backoff = random.uniform(0, min(config.ROUTER_BACKOFF_MAX, config.ROUTER_BACKOFF_BASE * 2 ** attempt))
+                await asyncio.sleep(min(backoff, remaining))
+
+    def answer(self, system_prompt: str, user_prompt: str) -> str:
+        return asyncio.run_coroutine_threadsafe(self._answer(system_prompt, user_prompt), self._get_loop()).result()
+
+    async def aanswer(self, system_prompt: str, user_prompt: str) -> str:
+        future = asyncio.run_coroutine_threadsafe(self._answer(system_prompt, user_prompt), self._get_loop())
+        return await asyncio.wrap_future(future)
+
+    def stream_answer(self, system_prompt: str, user_prompt: str):
+        """
+        Отдает ответ первой доступной модели по частям. Ответ не дублируется, но если модель ошиблась
+        до первого фрагмента, запрос уходит следующей модели
+        """
+        last_error = None
+
+        for name, backend in self.backends.items():
+            if not self.breakers[name].allow():
+                continue
+
+            start_time = time.monotonic()
+            started = False
+
+            try:
+                for chunk in backend.stream_answer(system_prompt, user_prompt):
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                # Читатель закрыл генератор: вызов прерван без результата, пробный вызов освобождается
+                self.breakers[name].release()
+                raise
+            except Exception as e:
+                self.backend_stats[name].record(error=e)
+                self.breakers[name].record_failure()
+
+                if started:
+                    raise
+
+                last_error = e
+                continue
+
+            self.backend_stats[name].record(latency=time.monotonic() - start_time)
+            self.breakers[name].record_success()
+            return
+
+        raise last_error or LLMUnavailableError("All LLM backends are unavailable (circuit open)")
@@ -1,23 +1,34 @@
 import utils
+import metrics
 import database
 from argparse import ArgumentParser
 
 
-def cli_arguments_preprocess() -> str:
+def cli_arguments_preprocess():
     parser = ArgumentParser(description="A script for search related with query documents in database")
 
     parser.add_argument('query', help='Query that will be encoded and searched for')
 
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the search and print the report to stderr")
+
+    parser.add_argument("--profile_output", required=False, default=None,
+                        help="File for the full profiler report (.prof for cProfile, .html for pyinstrument)")
+
     args = parser.parse_args()
 
-    return args.query
+    return args
 
 if __name__ == "__main__":
+    args = cli_arguments_preprocess()
+    metrics.setup_json_logging()
+
     db_worker = utils.get_db_worker()
-    query = cli_arguments_preprocess()
+    query = args.query
 
     try:
-        results = db_worker.search(query.lower())
+        with metrics.profiled(args.profile, args.profile_output):
+            results = db_worker.search(query.lower())
         print(f"Query: {query}")
 
         for i, res in enumerate(results, 1):
@@ -0,0 +1,176 @@
+import asyncio
+from argparse import ArgumentParser
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel
+
+import config
+import metrics
+import database
+from answer import RAGAssistant
+
+
+class QueueFullError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class RequestLimiter:
+    """
+    Ограничивает число одновременно обрабатываемых запросов и длину очереди ожидающих.
+    Если очередь заполнена, запрос сразу отклоняется, а не копится в памяти
+    """
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_pending = max_concurrent + max_queue
+        self.pending = 0
+
+    def check(self):
+        """
+        Проверяет, есть ли место в очереди, не занимая его
+        """
+        if self.pending >= self.max_pending:
+            raise QueueFullError("Server is overloaded, try again later")
+
+    async def __aenter__(self):
+        self.check()
+
+        self.pending += 1
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.pending -= 1
+            raise
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
+        self.pending -= 1
+
+
+class AnswerRequest(BaseModel):
+    question: str
+    role: str = "default"
+
+
+def create_app(assistant: RAGAssistant, embed_workers=config.SERVER_EMBED_WORKERS,
+               max_concurrent=config.SERVER_MAX_CONCURRENT, max_queue=config.SERVER_MAX_QUEUE) -> FastAPI:
+    """
+    Создает ASGI-приложение поверх уже загруженного RAGAssistant: модели загружаются один раз при старте сервера
+    :param assistant: RAG-ассистент с загруженными моделями
+    :param embed_workers: число потоков для векторизации запросов (CPU)
+    :param max_concurrent: максимальное число одновременно обрабатываемых запросов
+    :param max_queue: максимальное число запросов, ожидающих обработки
+    """
+    limiter = RequestLimiter(max_concurrent, max_queue)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        app.state.embed_executor = ThreadPoolExecutor(max_workers=embed_workers, thread_name_prefix="embed")
+        yield
+        app.state.embed_executor.shutdown(wait=False)
+
+    app = FastAPI(title="S.T.A.L.K.E.R. RAG System", lifespan=lifespan)
+
+    async def limited(make_awaitable):
+        """
+        Выполняет запрос под ограничением RequestLimiter; работа начинается только после получения слота
+        """
+        try:
+            async with limiter:
+                return await make_awaitable()
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/metrics")
+    async def prometheus_metrics():
+        return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/stats")
+    async def stats():
+        return {"llm": assistant.model.stats(), "caches": assistant.db_worker.cache_stats()}
+
+    @app.get("/search")
+    async def search(query: str, top_k: int = 5):
+        try:
+            results = await limited(lambda: metrics.run_in_executor(app.state.embed_executor, assistant.retrieve, query, top_k))
+        except database.EmbeddingError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        return {
+            "query": query,
+            "results": [
+                {
+                    "title": r.payload.get("metadata", {}).get("title"),
+                    "wiki_id": r.payload.get("metadata", {}).get("wiki_id"),
+                    "score": r.score,
+                    "content": r.payload.get("content")
+                }
+                for r in results
+            ]
+        }
+
+    @app.post("/answer")
+    async def answer(request: AnswerRequest):
+        try:
+            answer = await limited(lambda: assistant.agenerate_answer(request.question, request.role, app.state.embed_executor))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=f"LLM error: {e}")
+
+        return {"question": request.question, "answer": answer}
+
+    @app.post("/answer/stream")
+    async def answer_stream(request: AnswerRequest):
+        # Переполнение очереди проверяем до начала ответа, чтобы успеть вернуть 503
+        try:
+            limiter.check()
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+        async def generate():
+            # Слот ограничителя занят, пока ответ не отдан целиком
+            async with limiter:
+                async for chunk in assistant.astream_answer(request.question, request.role, app.state.embed_executor):
+                    yield chunk
+
+        return StreamingResponse(generate(), media_type="text/plain; charset=utf-8")
+
+    return app
+
+
+def cli_arguments_preprocess():
+    parser = ArgumentParser(description="HTTP server for searching documents and asking LLM questions about the lore of S.T.A.L.K.E.R.")
+
+    parser.add_argument("--model_type", required=True,
+                        help="Type of model: gigachat-remote/deepseek-remote/local/router")
+
+    parser.add_argument("--model_name", required=False, default=None,
+                        help="Name of model like GigaChat-Pro or Hugging Face model (in local model case)")
+
+    parser.add_argument("--host", required=False, default="127.0.0.1",
+                        help="Host to bind")
+
+    parser.add_argument("--port", required=False, type=int, default=8000,
+                        help="Port to bind")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = cli_arguments_preprocess()
+    metrics.setup_json_logging()
+
+    assistant = RAGAssistant(model_type=args.model_type, model_name=args.model_name)
+
+    # Один процесс: модели загружены один раз и общие для всех запросов
+    uvicorn.run(create_app(assistant), host=args.host, port=args.port, workers=1)
@@ -1,14 +1,19 @@
 import os
 import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice
 from dotenv import load_dotenv
 from transformers import AutoTokenizer
 
 from qdrant_client import QdrantClient
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 import config
 import database
-from embeddings import LocalEmbedder
+import answer_cache
+import docstore
+import vectorstore
+from embeddings import create_embedder
 
 
 load_dotenv()
@@ -16,25 +21,97 @@ load_dotenv()
 DATABASE_CONNECTION_URL = os.getenv("DATABASE_CONNECTION_URL")
 
 
-def get_db_worker(embedder_type="local"):
+def get_vector_store(store_type=config.VECTOR_STORE):
+    """
+    Создает и возвращает хранилище векторов
+    :param store_type: qdrant - сервер Qdrant по адресу DATABASE_CONNECTION_URL, numpy - встроенное хранилище
+        в config.VECTOR_STORE_PATH (по умолчанию config.VECTOR_STORE)
+    """
+    if store_type == "qdrant":
+        client = QdrantClient(DATABASE_CONNECTION_URL)
+        return vectorstore.QdrantVectorStore(client, config.COLLECTION_NAME, config.VECTOR_SIZE)
+    elif store_type == "numpy":
+        return vectorstore.NumpyVectorStore(config.VECTOR_STORE_PATH, config.VECTOR_SIZE)
+    else:
+        raise ValueError(f"Unknown vector store type: {store_type}")
+
+def get_db_worker(embedder_type=config.EMBEDDER_TYPE, store_type=config.VECTOR_STORE):
     """
     Создает и возвращает объект DatabaseWorker
-    :param embedder: тип эмбеддера (по умолчанию "local")
+    :param embedder_type: тип эмбеддера: local/local-int8/onnx-int8 (по умолчанию config.EMBEDDER_TYPE)
+    :param store_type: тип хранилища векторов: qdrant/numpy (по умолчанию config.VECTOR_STORE)
     """
-    client = QdrantClient(DATABASE_CONNECTION_URL)
-    embedder = None
+    store = get_vector_store(store_type)
+    embedder = create_embedder(embedder_type)
 
-    if embedder_type == "local":
-        embedder = LocalEmbedder()
+    db_worker = database.DatabaseWorker(store, embedder)
+    return db_worker
+
+def get_answer_cache(embedder, store_type=config.VECTOR_STORE, update_collection=False):
+    """
+    Создает и возвращает семантический кэш ответов LLM в отдельной коллекции хранилища векторов
+    :param embedder: эмбеддер, которым векторизуются вопросы (от него зависит версия коллекции)
+    :param store_type: тип хранилища векторов: qdrant/numpy (по умолчанию config.VECTOR_STORE)
+    :param update_collection: привести параметры существующей коллекции к config.py
+        (как и у основной коллекции, это делает только filldb.py)
+    """
+    if store_type == "qdrant":
+        client = QdrantClient(DATABASE_CONNECTION_URL)
+        store = vectorstore.QdrantVectorStore(client, config.ANSWER_CACHE_COLLECTION, config.VECTOR_SIZE)
+    elif store_type == "numpy":
+        store = vectorstore.NumpyVectorStore(config.ANSWER_CACHE_PATH, config.VECTOR_SIZE)
     else:
-        raise Exception(f"Unknown embedder type: {embedder}")
+        raise ValueError(f"Unknown vector store type: {store_type}")
 
-    db_worker = database.DatabaseWorker(client,
-                                        embedder,
-                                        config.COLLECTION_NAME,
-                                        config.VECTOR_SIZE
-                                        )
-    return db_worker
+    store.create_collection(update=update_collection)
+
+    return answer_cache.SemanticAnswerCache(store, answer_cache.collection_version(embedder.model_name))
+
+def get_document_store(create=True):
+    """
+    Создает и возвращает хранилище полных текстов статей
+    :param create: False - не создавать хранилище, если его еще нет (вернуть None)
+    """
+    if not create and not os.path.exists(config.DOCSTORE_PATH):
+        return None
+
+    if not os.path.exists(config.DATA_PATH):
+        os.mkdir(config.DATA_PATH)
+
+    return docstore.DocumentStore(config.DOCSTORE_PATH)
+
+# Все конструкции, которые вырезаются из текста, в одном регулярном выражении: текст просматривается один раз.
+# Lookahead по первому символу позволяет быстро пропускать позиции, с которых не начинается ни одна конструкция.
+# Порядок альтернатив повторяет порядок старых проходов: {{...}} и ссылки на файлы проверяются раньше [[...]] и [...],
+# <ref>...</ref> - раньше остальных HTML-тегов.
+_CLEAN_PATTERN = re.compile(r"""
+    (?=[_rп{|мt\[<])
+    (?:
+          __(?:disambig|notoc|статическое_перенаправление)__            # служебные конструкции
+        | redirect[^\n]*
+        | перенаправление[^\n]*
+        | \{\{[^\n]*?\}\}                                                # {{...}}
+        | (?P<media>\|?(?:мини|thumb)\|[^\n]*(?:\n|\Z))                 # медиа-вставки (мини|..., thumb|...)
+        | \[(?:
+              \[file:[^\n]*?\]\]                                          # [[file:...]]
+            | \[(?P<target>[^\]|]+)\|?(?P<label>[^\]]+)?\]\]              # [[статья|текст]] -> текст
+            | [^\n]*?\]                                                   # внешние ссылки
+          )
+        | <(?:ref[^\n]*?>[^\n]*?</ref>|[^\n]*?>)                         # <ref>...</ref> и HTML-теги
+    )
+""", re.VERBOSE)
+
+_HEADER_PATTERN = re.compile(r"^(?:это статья о[^\n]*?\.|см\.? также[^\n]*)", re.MULTILINE)
+
+def _clean_match(match: re.Match) -> str:
+    if match.group("media") is not None:
+        return " "
+
+    target = match.group("target")
+    if target is not None:
+        return match.group("label") or target
+
+    return ""
 
 def clear_text(text: str) -> str:
     """
@@ -44,37 +121,113 @@ def clear_text(text: str) -> str:
     """
     text = text.lower()
 
-    # Удаляем специальные конструкции
-    text = re.sub(r'__disambig__', '', text)
-    text = re.sub(r'__notoc__', '', text)
-    text = re.sub(r'__статическое_перенаправление__', '', text)
-    text = re.sub(r'redirect.*', '', text)
-    text = re.sub(r'перенаправление.*', '', text)
-    text = re.sub(r'\{\{.*?\}\}', '', text) # {{...}}
+    # Удаляем специальные конструкции, медиа-вставки, wiki/HTML теги и ссылки за один проход
+    text = _CLEAN_PATTERN.sub(_clean_match, text)
 
+    # Приводим кавычки к нормальному виду
+    text = text.replace("«", '"').replace("»", '"').replace("“", '"').replace("”", '"')
 
-    # Удаляем медиа-вставки (мини|..., thumb|..., File:...)
-    text = re.sub(r'\|?мини\|.*?(\n|$)', ' ', text)
-    text = re.sub(r'\|?thumb\|.*?(\n|$)', ' ', text)
-    text = re.sub(r'\[\[file:.*?\]\]', '', text)
+    # Убираем шапки. Проход по началам строк дорогой, а шапки есть в немногих статьях
+    if "это статья о" in text or "см также" in text or "см. также" in text:
+        text = _HEADER_PATTERN.sub("", text)
 
+    return text
 
-    # Удаляем wiki/HTML теги и ссылки
-    text = re.sub(r'<ref.*?>.*?</ref>', '', text)
-    text = re.sub(r'<.*?>', '', text) # HTML-теги
-    text = re.sub(r'\[\[([^\]|]+)\|?([^\]]+)?\]\]', 
-                  lambda m: m.group(2) if m.group(2) else m.group(1),
-                  text)
-    text = re.sub(r'\[.*?\]', '', text) # внешние ссылки
+def split_by_token_chunks(text: str, tokenizer: AutoTokenizer, chunk_size=512, overlap=64,
+                          prefix="search_document: ", max_length=512) -> list:
+    """
+    Разбивает текст на чанки по токенам, токенизируя его один раз.
+    Чанки режутся по границам строк (абзацев), если в окне есть такая граница, иначе - по токенам.
+    Для каждого чанка сразу собираются id токенов для эмбеддера: спецтокены, префикс задачи и токены чанка,
+    так что чанк вместе с префиксом гарантированно помещается в max_length и не обрезается при векторизации.
+    :param text: исходный текст
+    :param tokenizer: быстрый (fast) токенизатор эмбеддера
+    :param chunk_size: максимальный размер чанка в токенах
+    :param overlap: размер перекрытия между чанками в токенах
+    :param prefix: префикс задачи эмбеддера
+    :param max_length: максимальная длина входа эмбеддера в токенах
+    :return: список пар (текст чанка, id токенов для эмбеддера)
+    """
+    if not tokenizer.is_fast:
+        raise ValueError("Token chunking requires a fast tokenizer with offsets mapping")
 
-    # Приводим кавычки к нормальному виду
-    text = text.replace("«", '"').replace("»", '"').replace("“", '"').replace("”", '"')
+    encoding = tokenizer(prefix + text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = encoding["offset_mapping"]
 
-    # Убираем шапки
-    text = re.sub(r'^это статья о.*?\.', '', text, flags=re.MULTILINE)
-    text = re.sub(r'^см\.? также.*', '', text, flags=re.MULTILINE)
+    # Токены префикса заканчиваются не дальше его конца, остальные - токены текста (концы токенов не убывают)
+    prefix_length = bisect_right(offsets, len(prefix), key=lambda offset: offset[1])
+    prefix_ids = encoding["input_ids"][:prefix_length]
+    ids = encoding["input_ids"][prefix_length:]
+    offsets = [(token_start - len(prefix), token_end - len(prefix)) for token_start, token_end in offsets[prefix_length:]]
 
-    return text
+    # Вход модели (BERT/RoBERTa): [CLS] префикс чанк [SEP]
+    budget = min(chunk_size, max_length - 2 - len(prefix_ids))
+
+    # Границы строк: токены, перед которыми в тексте стоит перевод строки
+    boundaries = [i for i in range(1, len(ids)) if offsets[i][0] > 0 and text[offsets[i][0] - 1] == "\n"]
+
+    def is_blank(i):
+        return not text[offsets[i][0]:offsets[i][1]].strip()
+
+    def starts_word(i):
+        return offsets[i][0] > 0 and text[offsets[i][0] - 1].isspace()
+
+    def head_ids(window_start, window_end):
+        """
+        Токены префикса и первого слова чанка. Слово после перевода строки токенизируется без признака пробела
+        и иначе, чем после префикса, поэтому префикс и первое слово токенизируются вместе - как у первого чанка
+        и у запросов (префикс: текст)
+        :return: (id токенов, номер первого токена чанка после первого слова)
+        """
+        cut = window_start + 1
+        while cut < window_end and not starts_word(cut):
+            cut += 1
+
+        head_text = prefix + text[offsets[window_start][0]:offsets[cut - 1][1]]
+        return tokenizer(head_text, add_special_tokens=False)["input_ids"], cut
+
+    chunks = []
+    start = 0
+
+    while start < len(ids):
+        end = min(start + budget, len(ids))
+        cut_at_boundary = False
+
+        if end < len(ids):
+            # Последняя граница строки внутри окна
+            j = bisect_right(boundaries, end) - 1
+            if j >= 0 and boundaries[j] > start:
+                end = boundaries[j]
+                cut_at_boundary = True
+
+        # Отбрасываем пробельные токены по краям чанка
+        window_start, window_end = start, end
+        while window_start < window_end and is_blank(window_start):
+            window_start += 1
+        while window_end > window_start and is_blank(window_end - 1):
+            window_end -= 1
+
+        if window_start < window_end:
+            chunk_text = text[offsets[window_start][0]:offsets[window_end - 1][1]]
+            head, cut = head_ids(window_start, window_end)
+
+            # Заново токенизированное первое слово изредка бывает длиннее исходного: вход не должен превысить max_length
+            input_ids = ([tokenizer.cls_token_id] + head + ids[cut:window_end])[:max_length - 1] + [tokenizer.sep_token_id]
+            chunks.append((chunk_text, input_ids))
+
+        if end >= len(ids):
+            break
+
+        # Следующий чанк начинается с первой строки, попадающей в перекрытие, либо просто за overlap токенов до конца
+        if cut_at_boundary:
+            k = bisect_left(boundaries, end - overlap)
+            next_start = boundaries[k] if k < len(boundaries) and boundaries[k] <= end else end
+        else:
+            next_start = end - overlap
+
+        start = max(next_start, start + 1)
+
+    return chunks
 
 def split_by_chunks(text: str, tokenizer: AutoTokenizer, chunk_size=512, overlap=64) -> list:
     """
@@ -84,11 +237,55 @@ def split_by_chunks(text: str, tokenizer: AutoTokenizer, chunk_size=512, overlap
     :param overlap: размер перекрытия между чанками
     :return: список чанков
     """
-    splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
-        tokenizer=tokenizer,
-        chunk_size=chunk_size,
-        chunk_overlap=overlap,
-        separators=["\n\n", "\n"]
-    )
-    
-    return splitter.split_text(text)
\ No newline at end of file
+    return [chunk for chunk, _ in split_by_token_chunks(text, tokenizer, chunk_size, overlap)]
+
+def batched(iterable, batch_size: int):
+    """
+    Разбивает итерируемый объект на списки длины batch_size (последний может быть короче).
+    :param iterable: исходная последовательность
+    :param batch_size: размер пачки
+    :return: генератор списков
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def with_last(iterable):
+    """
+    Помечает последний элемент последовательности.
+    :param iterable: исходная последовательность
+    :return: генератор пар (элемент, является ли он последним)
+    """
+    iterator = iter(iterable)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+
+    for item in iterator:
+        yield previous, False
+        previous = item
+
+    yield previous, True
+
+def submit_bounded(executor, fn, iterable, max_in_flight: int, args=None):
+    """
+    Отправляет элементы в executor, держа в работе не больше max_in_flight задач одновременно
+    (Executor.map сразу забирает всю входную последовательность).
+    :param executor: пул потоков или процессов
+    :param fn: функция для выполнения
+    :param iterable: входные элементы
+    :param max_in_flight: максимальное число задач в работе
+    :param args: функция, строящая кортеж аргументов fn по элементу (по умолчанию - сам элемент)
+    :return: генератор пар (элемент, future) в исходном порядке
+    """
+    pending = deque()
+
+    for item in iterable:
+        pending.append((item, executor.submit(fn, *(args(item) if args else (item,)))))
+
+        if len(pending) >= max_in_flight:
+            yield pending.popleft()
+
+    while pending:
+        yield pending.popleft()
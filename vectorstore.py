@@ -0,0 +1,727 @@
+import os
+import json
+import atexit
+import mmap
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import (
+    Distance, VectorParams, VectorParamsDiff, CollectionParamsDiff, HnswConfigDiff, PointStruct, PointIdsList,
+    UpdateStatus, ScalarQuantization, ScalarQuantizationConfig, ScalarType, BinaryQuantization,
+    BinaryQuantizationConfig, Disabled, SearchParams, QuantizationSearchParams, SearchRequest
+)
+
+import config
+
+
+# Результат поиска встроенного хранилища. Совместим по полям id, score и payload с ScoredPoint из Qdrant
+SearchHit = namedtuple("SearchHit", ["id", "score", "payload"])
+
+
+class VectorStoreError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def normalize_vectors(vectors) -> np.ndarray:
+    """
+    Приводит векторы к матрице float32 с единичной нормой строк: косинусная близость становится скалярным произведением
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def select_payload(payload: dict, payload_fields) -> dict:
+    """
+    :param payload_fields: нужные поля payload (None - все поля)
+    """
+    if payload_fields is None:
+        return payload
+
+    return {field: payload[field] for field in payload_fields if field in payload}
+
+
+class VectorStore(ABC):
+    """
+    Хранилище векторов с payload, с которым работает DatabaseWorker.
+    Id точек - строки (см. database.point_id), близость - косинусная
+    """
+    def __init__(self, size: int):
+        self.size = size
+
+    @abstractmethod
+    def create_collection(self, update=True):
+        """
+        Создает коллекцию, если её нет, иначе приводит её параметры к config.py
+        :param update: False - существующую коллекцию не трогать (параметры обновляет только filldb.py)
+        """
+
+    def update_collection(self) -> bool:
+        """
+        Приводит параметры существующей коллекции к config.py
+        :return: True, если параметры изменились
+        """
+        return False
+
+    @abstractmethod
+    def drop_collection(self):
+        """
+        Удаляет коллекцию вместе со всеми точками
+        """
+
+    @abstractmethod
+    def upsert(self, ids, vectors, payloads, wait=False):
+        """
+        Вставляет или перезаписывает точки
+        :param wait: ждать ли, пока изменения станут видны поиску
+        """
+
+    @abstractmethod
+    def delete(self, ids):
+        """
+        Удаляет точки по id; удаленные точки сразу перестают находиться поиском
+        """
+
+    @abstractmethod
+    def count(self) -> int:
+        """
+        :return: число точек в коллекции
+        """
+
+    def flush(self):
+        """
+        Сохраняет все принятые изменения. По умолчанию ничего не делает: Qdrant применяет операции по порядку
+        и сохраняет их сам
+        """
+
+    @abstractmethod
+    def iter_payload_field(self, field: str, page_size=1024):
+        """
+        Перебирает значение одного поля payload у всех точек, не читая векторы
+        :return: генератор пар (id точки, значение поля)
+        """
+
+    def search_params(self, **kwargs):
+        """
+        :return: параметры поиска по умолчанию (из config.py), формат зависит от хранилища
+        """
+        return None
+
+    @abstractmethod
+    def search(self, vectors, top_k=5, payload_fields=("content", "metadata"), search_params=None) -> list:
+        """
+        Ищет ближайшие точки сразу для нескольких векторов запросов
+        :param vectors: матрица эмбеддингов запросов (или один эмбеддинг)
+        :param top_k: количество результатов для каждого запроса
+        :param payload_fields: поля payload, которые нужно вернуть
+        :param search_params: параметры поиска (см. search_params)
+        :return: список списков результатов (объекты с полями id, score и payload) в порядке запросов
+        """
+
+
+class QdrantVectorStore(VectorStore):
+    """
+    Коллекция на сервере Qdrant (или в локальном режиме QdrantClient)
+    """
+    def __init__(self, client: QdrantClient, collection_name: str, size=1024):
+        super().__init__(size)
+
+        self.client = client
+        self.collection_name = collection_name
+
+    def hnsw_config(self) -> HnswConfigDiff:
+        """
+        :return: параметры графа HNSW из config.py
+        """
+        return HnswConfigDiff(m=config.HNSW_M, ef_construct=config.HNSW_EF_CONSTRUCT, on_disk=config.HNSW_ON_DISK)
+
+    def quantization_config(self):
+        """
+        :return: параметры квантизации векторов из config.py (None - без квантизации)
+        """
+        if config.QUANTIZATION is None:
+            return None
+        elif config.QUANTIZATION == "scalar":
+            return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8,
+                                                                      quantile=config.QUANTIZATION_QUANTILE,
+                                                                      always_ram=config.QUANTIZATION_ALWAYS_RAM))
+        elif config.QUANTIZATION == "binary":
+            return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=config.QUANTIZATION_ALWAYS_RAM))
+        else:
+            raise ValueError(f"Unknown quantization type: {config.QUANTIZATION}")
+
+    def create_collection(self, update=True):
+        """
+        Создает коллекцию с параметрами индекса из config.py.
+        Если коллекция уже существует и update=True, обновляет её параметры на месте (см. update_collection)
+        """
+        if self.client.collection_exists(self.collection_name):
+            if update:
+                print(f"Collection {self.collection_name} already exists")
+                self.update_collection()
+            return
+
+        self.client.create_collection(
+            collection_name=self.collection_name,
+            vectors_config=VectorParams(
+                size=self.size,
+                distance=Distance.COSINE,
+                on_disk=config.VECTORS_ON_DISK
+            ),
+            hnsw_config=self.hnsw_config(),
+            quantization_config=self.quantization_config(),
+            on_disk_payload=config.PAYLOAD_ON_DISK
+        )
+
+    def update_collection(self) -> bool:
+        """
+        Приводит параметры индекса существующей коллекции к config.py без перезаписи точек.
+        Qdrant перестраивает индекс в фоне, поиск продолжает работать
+        :return: True, если параметры изменились
+        """
+        collection_config = self.client.get_collection(self.collection_name).config
+        params = collection_config.params
+        hnsw = collection_config.hnsw_config
+
+        changes = {}
+
+        if params.on_disk_payload != config.PAYLOAD_ON_DISK:
+            changes["collection_params"] = CollectionParamsDiff(on_disk_payload=config.PAYLOAD_ON_DISK)
+
+        if bool(params.vectors.on_disk) != config.VECTORS_ON_DISK:
+            changes["vectors_config"] = {"": VectorParamsDiff(on_disk=config.VECTORS_ON_DISK)}
+
+        if (hnsw.m, hnsw.ef_construct, bool(hnsw.on_disk)) != (config.HNSW_M, config.HNSW_EF_CONSTRUCT, config.HNSW_ON_DISK):
+            changes["hnsw_config"] = self.hnsw_config()
+
+        quantization = self.quantization_config()
+        if collection_config.quantization_config != quantization:
+            changes["quantization_config"] = quantization if quantization is not None else Disabled.DISABLED
+
+        if not changes:
+            return False
+
+        try:
+            self.client.update_collection(collection_name=self.collection_name, **changes)
+        except Exception as e:
+            raise VectorStoreError(f"Failed to update collection {self.collection_name}: {e}")
+
+        print(f"Collection {self.collection_name} updated: {', '.join(changes)}")
+
+        return True
+
+    def drop_collection(self):
+        if self.client.collection_exists(self.collection_name):
+            self.client.delete_collection(self.collection_name)
+
+    def upsert(self, ids, vectors, payloads, wait=False):
+        """
+        При wait=False Qdrant только ставит операцию в очередь, поэтому последнюю пачку загрузки стоит
+        отправлять с wait=True - операции применяются по порядку
+        """
+        points = [
+            PointStruct(
+                id=id,
+                vector=vector.tolist(),
+                payload=payload
+            )
+            for id, vector, payload in zip(ids, vectors, payloads)
+        ]
+
+        operation_info = self.client.upsert(
+            collection_name=self.collection_name,
+            points=points,
+            wait=wait
+        )
+
+        if operation_info.status not in (UpdateStatus.COMPLETED, UpdateStatus.ACKNOWLEDGED):
+            raise VectorStoreError(f"Failed to insert points: {operation_info}")
+
+    def delete(self, ids, batch_size=1024):
+        """
+        :param batch_size: число id в одном запросе
+        """
+        ids = list(ids)
+
+        for start in range(0, len(ids), batch_size):
+            self.client.delete(
+                collection_name=self.collection_name,
+                points_selector=PointIdsList(points=ids[start:start + batch_size]),
+                wait=True
+            )
+
+    def count(self) -> int:
+        return self.client.count(self.collection_name).count
+
+    def iter_payload_field(self, field: str, page_size=1024):
+        offset = None
+
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.collection_name,
+                limit=page_size,
+                offset=offset,
+                with_payload=[field],
+                with_vectors=False
+            )
+
+            for point in points:
+                yield str(point.id), point.payload.get(field)
+
+            if offset is None:
+                return
+
+    def search_params(self, hnsw_ef=config.SEARCH_HNSW_EF, rescore=config.SEARCH_RESCORE,
+                      oversampling=config.SEARCH_OVERSAMPLING) -> SearchParams:
+        """
+        Параметры поиска: ширина поиска по графу и использование квантованных векторов
+        :param hnsw_ef: ширина поиска по графу HNSW (None - значение Qdrant по умолчанию)
+        :param rescore: пересчитывать ли близость кандидатов по исходным векторам
+        :param oversampling: во сколько раз больше кандидатов отбирать по квантованным векторам
+        """
+        quantization = None
+        if config.QUANTIZATION is not None:
+            quantization = QuantizationSearchParams(rescore=rescore, oversampling=oversampling)
+
+        return SearchParams(hnsw_ef=hnsw_ef, quantization=quantization)
+
+    def search(self, vectors, top_k=5, payload_fields=("content", "metadata"), search_params: SearchParams = None) -> list:
+        if search_params is None:
+            search_params = self.search_params()
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+
+        with_payload = list(payload_fields) if payload_fields is not None else True
+
+        if len(vectors) == 1:
+            return [self.client.search(
+                collection_name=self.collection_name,
+                query_vector=vectors[0].tolist(),
+                limit=top_k,
+                with_payload=with_payload,
+                search_params=search_params
+            )]
+
+        return self.client.search_batch(
+            collection_name=self.collection_name,
+            requests=[
+                SearchRequest(vector=vector.tolist(), limit=top_k, with_payload=with_payload, params=search_params)
+                for vector in vectors
+            ]
+        )
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Встроенное хранилище без сервера для небольших корпусов, которые в основном читаются.
+    Нормированные векторы лежат в .npy, который открывается через memory map, payload - в JSON,
+    записанных подряд в один файл, с отдельным массивом смещений. Поиск точный: одно матричное умножение
+    и argpartition. Для больших коллекций строится IVF-разбиение (k-means), и при поиске просматриваются
+    только nprobe ближайших кластеров.
+    Изменения сразу видны поиску, но копятся в памяти: файлы перезаписываются целиком (вместе с IVF-разбиением),
+    поэтому на диск изменения пишутся, только когда их наберется flush_ratio от размера коллекции
+    (и не меньше flush_min_changes точек), а также при flush и при выходе из процесса
+    """
+    VECTORS_FILE = "vectors.npy"
+    IDS_FILE = "ids.json"
+    PAYLOADS_FILE = "payloads.bin"
+    OFFSETS_FILE = "offsets.npy"
+    META_FILE = "meta.json"
+    IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+    IVF_ORDER_FILE = "ivf_order.npy"
+    IVF_OFFSETS_FILE = "ivf_offsets.npy"
+
+    # Для float16 матрица умножается блоками с приведением к float32: BLAS не работает с float16
+    SEARCH_BLOCK_ROWS = 65536
+
+    def __init__(self, path: str, size=1024, dtype=config.VECTOR_STORE_DTYPE,
+                 ivf_min_points=config.VECTOR_STORE_IVF_MIN_POINTS, ivf_lists=config.VECTOR_STORE_IVF_LISTS,
+                 flush_min_changes=config.VECTOR_STORE_FLUSH_MIN_CHANGES, flush_ratio=config.VECTOR_STORE_FLUSH_RATIO):
+        """
+        :param path: директория хранилища
+        :param size: размерность векторов
+        :param dtype: тип хранения векторов: float32 или float16 (вдвое меньше памяти)
+        :param ivf_min_points: с какого числа векторов строить IVF-разбиение (None - никогда)
+        :param ivf_lists: число кластеров IVF (None - корень из числа векторов)
+        :param flush_min_changes: минимальное число измененных точек для автоматической записи на диск
+        :param flush_ratio: доля коллекции, после изменения которой изменения записываются на диск
+        """
+        super().__init__(size)
+
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.ivf_min_points = ivf_min_points
+        self.ivf_lists = ivf_lists
+        self.flush_min_changes = flush_min_changes
+        self.flush_ratio = flush_ratio
+
+        self.lock = threading.RLock()
+        self._load()
+
+        # Изменения, не набравшие порога записи, сохраняются при выходе из процесса
+        atexit.register(self.flush)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _reset(self):
+        self.ids = []
+        self.rows = {}
+        self.vectors = np.empty((0, self.size), dtype=self.dtype)
+        self.payloads = []         # сериализованные payload, если хранилище изменялось
+        self.payload_blob = b""    # иначе payload читаются из файла по смещениям
+        self.payload_offsets = np.zeros(1, dtype=np.int64)
+        self.ivf = None            # (центроиды, строки по кластерам, смещения кластеров)
+
+        self.pending = {}          # новые точки: id -> (вектор, payload)
+        self.deleted = set()       # удаленные строки
+        self.dirty = False
+        self.unflushed = 0         # число изменений с последней записи на диск
+
+    def _load(self):
+        """
+        Открывает файлы хранилища. Векторы и payload не читаются в память целиком
+        """
+        self._reset()
+
+        if not os.path.exists(self._file(self.META_FILE)):
+            return
+
+        with open(self._file(self.META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        if meta["size"] != self.size:
+            raise VectorStoreError(f"Vector store {self.path} has vectors of size {meta['size']}, expected {self.size}")
+
+        with open(self._file(self.IDS_FILE), "r", encoding="utf-8") as f:
+            self.ids = json.load(f)
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+
+        self.vectors = np.load(self._file(self.VECTORS_FILE), mmap_mode="r")
+        self.payload_offsets = np.load(self._file(self.OFFSETS_FILE))
+
+        # mmap не умеет отображать пустой файл
+        if self.payload_offsets[-1] > 0:
+            with open(self._file(self.PAYLOADS_FILE), "rb") as f:
+                self.payload_blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if os.path.exists(self._file(self.IVF_CENTROIDS_FILE)):
+            self.ivf = (
+                np.load(self._file(self.IVF_CENTROIDS_FILE)),
+                np.load(self._file(self.IVF_ORDER_FILE)),
+                np.load(self._file(self.IVF_OFFSETS_FILE))
+            )
+
+    def _payload_bytes(self, row: int) -> bytes:
+        if self.payloads:
+            return self.payloads[row]
+
+        return self.payload_blob[self.payload_offsets[row]:self.payload_offsets[row + 1]]
+
+    def _materialize(self):
+        """
+        Переносит векторы и payload в память перед первым изменением
+        """
+        if isinstance(self.vectors, np.memmap) or not self.vectors.flags.writeable:
+            self.vectors = np.array(self.vectors, dtype=self.dtype)
+
+        if not self.payloads and self.ids:
+            self.payloads = [bytes(self._payload_bytes(row)) for row in range(len(self.ids))]
+
+    def _consolidate(self):
+        """
+        Применяет накопленные в памяти удаления и новые точки к матрице векторов
+        """
+        if not self.pending and not self.deleted:
+            return
+
+        self._materialize()
+
+        keep = [row for row in range(len(self.ids)) if row not in self.deleted]
+        new_ids = list(self.pending)
+
+        vectors = [self.vectors[keep]]
+        if new_ids:
+            vectors.append(np.stack([self.pending[id][0] for id in new_ids]))
+
+        self.ids = [self.ids[row] for row in keep] + new_ids
+        self.rows = {id: row for row, id in enumerate(self.ids)}
+        self.vectors = np.concatenate(vectors).astype(self.dtype, copy=False)
+        self.payloads = [self.payloads[row] for row in keep] + [self.pending[id][1] for id in new_ids]
+
+        self.pending = {}
+        self.deleted = set()
+        self.ivf = None
+
+    def create_collection(self, update=True):
+        if os.path.exists(self._file(self.META_FILE)):
+            if update:
+                print(f"Vector store {self.path} already exists")
+                self.update_collection()
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        with self.lock:
+            self.dirty = True
+            self.flush()
+
+    def update_collection(self) -> bool:
+        """
+        Приводит тип хранения векторов к config.py (или параметру dtype)
+        """
+        with self.lock:
+            if self.vectors.dtype == self.dtype:
+                return False
+
+            self.vectors = np.array(self.vectors, dtype=self.dtype)
+            self.dirty = True
+            self.flush()
+
+        print(f"Vector store {self.path} updated: dtype {self.dtype}")
+
+        return True
+
+    def drop_collection(self):
+        with self.lock:
+            self._reset()
+
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+
+    def upsert(self, ids, vectors, payloads, wait=False):
+        """
+        Изменения видны поиску сразу, поэтому wait не нужен: на диск они пишутся пачками (см. _maybe_flush)
+        """
+        vectors = normalize_vectors(vectors).astype(self.dtype)
+
+        with self.lock:
+            for id, vector, payload in zip(ids, vectors, payloads):
+                serialized = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                # Существующая точка не перезаписывается на месте: поиск читает снимок массивов без блокировки.
+                # Старая строка удаляется, а новая версия добавляется при следующем _consolidate в новые массивы
+                row = self.rows.get(id)
+                if row is not None:
+                    self.deleted.add(row)
+
+                self.pending[id] = (vector, serialized)
+                self.unflushed += 1
+
+            self.dirty = True
+            self._maybe_flush()
+
+    def delete(self, ids):
+        with self.lock:
+            for id in ids:
+                removed = self.pending.pop(id, None) is not None
+
+                row = self.rows.get(id)
+                if row is not None and row not in self.deleted:
+                    self.deleted.add(row)
+                    removed = True
+
+                if removed:
+                    self.unflushed += 1
+                    self.dirty = True
+
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        """
+        Записывает изменения на диск, если их накопилось достаточно относительно размера коллекции:
+        так каждое изменение в среднем стоит O(1 / flush_ratio) перезаписанных строк, а не всю коллекцию
+        """
+        if self.unflushed >= max(self.flush_min_changes, self.flush_ratio * len(self.ids)):
+            self.flush()
+
+    def count(self) -> int:
+        with self.lock:
+            return len(self.ids) - len(self.deleted) + len(self.pending)
+
+    def iter_payload_field(self, field: str, page_size=1024):
+        with self.lock:
+            self._consolidate()
+            ids = self.ids
+            payloads = [self._payload_bytes(row) for row in range(len(ids))]
+
+        for id, payload in zip(ids, payloads):
+            yield id, json.loads(payload).get(field)
+
+    def flush(self):
+        """
+        Записывает изменения на диск: файлы пишутся рядом и атомарно подменяют старые, после чего
+        хранилище заново открывается через memory map
+        """
+        with self.lock:
+            self._consolidate()
+
+            if not self.dirty:
+                return
+
+            os.makedirs(self.path, exist_ok=True)
+
+            self._materialize()
+            offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+            np.cumsum([len(payload) for payload in self.payloads], out=offsets[1:])
+
+            ivf = None
+            if self.ivf_min_points is not None and len(self.ids) >= self.ivf_min_points:
+                ivf = self._build_ivf(self.vectors)
+
+            # Старые отображения файлов не закрываются: ими может пользоваться идущий поиск,
+            # а подмена файла через os.replace их не затрагивает
+            self._write_atomic(self.VECTORS_FILE, lambda f: np.save(f, self.vectors))
+            self._write_atomic(self.OFFSETS_FILE, lambda f: np.save(f, offsets))
+            self._write_atomic(self.PAYLOADS_FILE, lambda f: f.writelines(self.payloads))
+            self._write_atomic(self.IDS_FILE, lambda f: f.write(json.dumps(self.ids).encode("utf-8")))
+
+            if ivf is not None:
+                for name, array in zip((self.IVF_CENTROIDS_FILE, self.IVF_ORDER_FILE, self.IVF_OFFSETS_FILE), ivf):
+                    self._write_atomic(name, lambda f, array=array: np.save(f, array))
+            else:
+                for name in (self.IVF_CENTROIDS_FILE, self.IVF_ORDER_FILE, self.IVF_OFFSETS_FILE):
+                    if os.path.exists(self._file(name)):
+                        os.remove(self._file(name))
+
+            # meta.json пишется последним: по нему хранилище считается созданным
+            meta = {"size": self.size, "dtype": self.dtype.name, "count": len(self.ids)}
+            self._write_atomic(self.META_FILE, lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+            self._load()
+
+    def _write_atomic(self, name: str, write):
+        tmp_filename = self._file(f"tmp.{name}")
+
+        with open(tmp_filename, "wb") as f:
+            write(f)
+
+        os.replace(tmp_filename, self._file(name))
+
+    def _build_ivf(self, vectors, iterations=10, seed=0):
+        """
+        Строит IVF-разбиение сферическим k-means
+        :return: (центроиды, номера строк, упорядоченные по кластерам, смещения кластеров в этом порядке)
+        """
+        rng = np.random.default_rng(seed)
+        lists = self.ivf_lists or max(1, int(np.sqrt(len(vectors))))
+
+        # Центроиды обучаются на выборке, на всех векторах считается только итоговое разбиение
+        sample_size = min(len(vectors), lists * 256)
+        # Кластеров не может быть больше векторов выборки (ivf_lists из config.py может оказаться больше коллекции)
+        lists = min(lists, sample_size)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, lists, replace=False)]
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+
+            # Пустые кластеры переинициализируются случайными векторами выборки
+            empty = np.bincount(assignment, minlength=lists) == 0
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+
+            centroids = normalize_vectors(sums)
+
+        assignment = np.concatenate([
+            np.argmax(np.asarray(vectors[start:start + self.SEARCH_BLOCK_ROWS], dtype=np.float32) @ centroids.T, axis=1)
+            for start in range(0, len(vectors), self.SEARCH_BLOCK_ROWS)
+        ])
+
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=lists), out=offsets[1:])
+
+        return centroids, order, offsets
+
+    def search_params(self, nprobe=config.VECTOR_STORE_NPROBE) -> dict:
+        """
+        :param nprobe: число просматриваемых кластеров IVF (если разбиение построено)
+        """
+        return {"nprobe": nprobe}
+
+    def _scores(self, vectors, queries: np.ndarray) -> np.ndarray:
+        """
+        :return: матрица близостей (число векторов, число запросов)
+        """
+        if vectors.dtype == np.float32:
+            return vectors @ queries.T
+
+        return np.concatenate([
+            np.asarray(vectors[start:start + self.SEARCH_BLOCK_ROWS], dtype=np.float32) @ queries.T
+            for start in range(0, len(vectors), self.SEARCH_BLOCK_ROWS)
+        ]) if len(vectors) else np.empty((0, len(queries)), dtype=np.float32)
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        :return: индексы top_k наибольших значений по убыванию
+        """
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def search(self, vectors, top_k=5, payload_fields=("content", "metadata"), search_params: dict = None) -> list:
+        if search_params is None:
+            search_params = self.search_params()
+
+        queries = normalize_vectors(vectors)
+
+        # Снимок состояния: изменения не трогают массивы на месте, а _consolidate и flush подменяют их целиком,
+        # поэтому поиск может идти без блокировки
+        with self.lock:
+            self._consolidate()
+            ids, matrix, ivf = self.ids, self.vectors, self.ivf
+            payloads, payload_blob, payload_offsets = self.payloads, self.payload_blob, self.payload_offsets
+
+        def payload_bytes(row):
+            if payloads:
+                return payloads[row]
+            return payload_blob[payload_offsets[row]:payload_offsets[row + 1]]
+
+        if top_k <= 0 or not ids:
+            return [[] for _ in queries]
+
+        if ivf is None:
+            # Одно матричное умножение на все запросы сразу
+            scores = self._scores(matrix, queries)
+            candidates = [np.arange(len(ids))] * len(queries)
+            query_scores = [scores[:, i] for i in range(len(queries))]
+        else:
+            centroids, order, offsets = ivf
+            nprobe = min(search_params.get("nprobe") or len(centroids), len(centroids))
+
+            candidates = []
+            query_scores = []
+            for query, centroid_scores in zip(queries, queries @ centroids.T):
+                lists = self._top_k(centroid_scores, nprobe)
+                rows = np.sort(np.concatenate([order[offsets[l]:offsets[l + 1]] for l in lists]))
+
+                candidates.append(rows)
+                query_scores.append(self._scores(matrix[rows], query[None, :])[:, 0])
+
+        results = []
+        for rows, scores in zip(candidates, query_scores):
+            hits = []
+            for index in self._top_k(scores, top_k):
+                row = int(rows[index])
+                payload = select_payload(json.loads(payload_bytes(row)), payload_fields)
+                hits.append(SearchHit(ids[row], float(scores[index]), payload))
+
+            results.append(hits)
+
+        return results
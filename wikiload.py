@@ -1,129 +1,462 @@
 import os
 import time
-import requests
 import json
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Parsing library for MediaWiki markup
 import mwparserfromhell
 
 import config
+import corpus
 
 
-def fetch_page_content(page_id: str):
+class RateLimiter:
     """
-    Загружает текст статьи по её названию.
+    Потокобезопасный token bucket: не больше rate запросов в секунду с допустимым всплеском burst
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Блокирует поток, пока в ведре не появится токен
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait_time = (1 - self.tokens) / self.rate
+
+            time.sleep(wait_time)
+
+
+class WikiClient:
+    """
+    Клиент MediaWiki API с общим пулом соединений, ограничением частоты запросов и повторами при ошибках
+    """
+    def __init__(self, api_url=config.WIKI_API_URL, requests_per_second=config.WIKI_REQUESTS_PER_SECOND,
+                 max_workers=config.WIKI_MAX_WORKERS):
+        self.api_url = api_url
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second, burst=max_workers)
+
+        # Повторяем запрос при перегрузке API, учитывая заголовок Retry-After
+        retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, params: dict) -> dict:
+        """
+        Выполняет GET-запрос к API с учетом ограничения частоты
+        :param params: параметры запроса
+        :return: JSON-ответ
+        """
+        self.rate_limiter.acquire()
+
+        response = self.session.get(self.api_url, params=params, timeout=60)
+        response.raise_for_status()
+
+        return response.json()
+
+
+def fetch_pages_content(client: WikiClient, page_ids: list) -> dict:
+    """
+    Загружает тексты статей по их id одним запросом (MediaWiki отдает до 50 страниц за раз).
+    :param client: клиент API
+    :param page_ids: список id страниц (не больше config.WIKI_PAGES_PER_REQUEST)
+    :return: словарь {id страницы: {"revid": id ревизии, "text": текст без вики-разметки}}
     """
     params = {
         "action": "query",
-        "prop": "extracts",
         "prop": "revisions",
-        "rvprop": "content",
+        "rvprop": "ids|content",
         "rvslots": "main",
-        "pageids": page_id,
+        "pageids": "|".join(str(page_id) for page_id in page_ids),
         "format": "json"
     }
 
-    response = requests.get(config.WIKI_API_URL, params=params)
-    response.raise_for_status()
+    contents = {}
+
+    # Если суммарный текст страниц слишком большой, API отдает его частями через rvcontinue
+    while True:
+        data = client.get(params)
 
-    data = response.json()
+        for page in data["query"]["pages"].values():
+            if "revisions" not in page:
+                continue
 
-    # Получаем текст статьи и удаляем вики-разметку
-    text = data["query"]["pages"][str(page_id)]["revisions"][-1]["slots"]["main"]["*"]
-    wikicode = mwparserfromhell.parse(text)
+            # Получаем текст статьи и удаляем вики-разметку
+            revision = page["revisions"][-1]
+            wikicode = mwparserfromhell.parse(revision["slots"]["main"]["*"])
 
-    return wikicode.strip_code()
+            contents[page["pageid"]] = {
+                "revid": revision["revid"],
+                "text": wikicode.strip_code()
+            }
 
-def fetch_all_pages_content(pages: list, filename: str, report_times=10):
+        if "continue" not in data:
+            return contents
+
+        params.update(data["continue"])
+
+def fetch_page_content(page_id: str, client: WikiClient = None):
     """
-    Загружает текст всех страниц из списка pages и сохраняет их в файл filename.
+    Загружает текст статьи по её id.
+    """
+    if client is None:
+        client = WikiClient()
+
+    content = fetch_pages_content(client, [page_id]).get(int(page_id))
+
+    return content["text"] if content else None
+
+def fetch_pages_groups(pages: list, client: WikiClient, report_times=10):
+    """
+    Загружает тексты страниц группами по config.WIKI_PAGES_PER_REQUEST в несколько потоков.
+    :param pages: список страниц ({"pageid", "title"})
+    :param client: клиент API
+    :return: генератор списков загруженных страниц ({"id", "title", "text", "revid"}) в порядке pages
     """
-    wiki_data = []
     total_pages = len(pages)
     report_interval = max(1, total_pages // report_times)
 
-    for i, p in enumerate(pages, 1):
-        page_id = p["pageid"]
-        text = fetch_page_content(page_id)
+    page_groups = [
+        pages[start:start + config.WIKI_PAGES_PER_REQUEST]
+        for start in range(0, total_pages, config.WIKI_PAGES_PER_REQUEST)
+    ]
+
+    fetched = 0
+
+    with ThreadPoolExecutor(max_workers=client.max_workers) as executor:
+        # map сохраняет порядок групп, поэтому порядок страниц в файле тот же, что и в списке
+        contents_by_group = executor.map(
+            lambda group: fetch_pages_content(client, [p["pageid"] for p in group]),
+            page_groups
+        )
+
+        for group, contents in zip(page_groups, contents_by_group):
+            fetched_pages = []
 
-        wiki_data.append({
-            "id": page_id,
-            "title": p["title"],
-            "text": text
-        })
+            for p in group:
+                page_id = p["pageid"]
 
-        if i % report_interval == 0:
-            print(f"\t\t\tFetched {i} pages...")
+                if page_id not in contents:
+                    print(f"\t\t\tPage {p['title']} (id={page_id}) has no content, skipping")
+                    continue
 
-        time.sleep(0.5)  # не спамим
+                fetched_pages.append({
+                    "id": page_id,
+                    "title": p["title"],
+                    "text": contents[page_id]["text"],
+                    "revid": contents[page_id]["revid"]
+                })
 
-    # Набрали и загрузили pages_per_file -> выгружаем wiki_data в отдельный файл
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(wiki_data, f, indent=4, ensure_ascii=False)
+            yield fetched_pages
 
+            previous_fetched = fetched
+            fetched += len(group)
 
-def save_wiki(pages_per_file=5000, requests_limit=500):
+            if fetched // report_interval > previous_fetched // report_interval:
+                print(f"\t\t\tFetched {fetched} pages...")
+
+def fetch_all_pages_content(pages: list, filename: str, client: WikiClient) -> dict:
     """
-    Загружает и сохраняет содержимое всех страниц вики, разбивая на файлы по pages_per_file страниц.
+    Загружает текст всех страниц из списка pages и сохраняет их в файл filename.
+    Загруженные группы страниц сразу дописываются в файл, поэтому при повторном запуске
+    после сбоя уже загруженные страницы не запрашиваются заново.
+    :return: словарь {id страницы: id ревизии} для сохраненных страниц
     """
-    if not os.path.exists(config.DATA_PATH):
-        os.mkdir(config.DATA_PATH)
-    
-    print("Fetching wiki pages...")
+    revisions = {}
+
+    with corpus.CorpusWriter(filename) as writer:
+        if writer.index:
+            print(f"\t\t\tResuming: {len(writer.index)} pages already fetched")
+
+        remaining_pages = []
+        for p in pages:
+            if p["pageid"] in writer:
+                # Для уже сохраненных страниц берем id ревизии из списка страниц
+                revisions[p["pageid"]] = p["revid"]
+            else:
+                remaining_pages.append(p)
+
+        for fetched_pages in fetch_pages_groups(remaining_pages, client):
+            for page in fetched_pages:
+                writer.write({"id": page["id"], "title": page["title"], "text": page["text"]})
+                revisions[page["id"]] = page["revid"]
+
+            writer.flush()
 
-    # Сначала получаем список всех страниц
-    pages = []
+    return revisions
+
+
+def new_crawl_state() -> dict:
+    """
+    Состояние обхода вики, сохраняемое в config.WIKI_STATE_PATH:
+        continue - курсор allpages, с которого продолжается получение списка страниц
+        listing_done - получен ли уже весь список страниц
+        file_index - номер файла батча, который заполняется сейчас
+        pending - страницы текущего батча, для которых еще не сохранен текст
+        pages - {id страницы: {"revid": id ревизии, "file": номер файла батча}} для всех сохраненных страниц
+    """
+    return {
+        "continue": {},
+        "listing_done": False,
+        "file_index": 0,
+        "pending": [],
+        "pages": {}
+    }
+
+def load_crawl_state():
+    if not os.path.exists(config.WIKI_STATE_PATH):
+        return None
+
+    with open(config.WIKI_STATE_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_crawl_state(state: dict):
+    tmp_filename = f"{config.WIKI_STATE_PATH}.tmp"
+    with open(tmp_filename, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+
+    os.replace(tmp_filename, config.WIKI_STATE_PATH)
+
+def list_pages(client: WikiClient, cursor: dict, requests_limit=500):
+    """
+    Получает очередную порцию списка статей вместе с id их последних ревизий.
+    :param client: клиент API
+    :param cursor: параметры продолжения из предыдущего ответа (пустой словарь для начала)
+    :param requests_limit: максимальное число страниц за запрос
+    :return: (список страниц {"pageid", "title", "revid"} в порядке allpages, курсор или None, если страниц больше нет)
+    """
     params = {
         "action": "query",
-        "list": "allpages",         # запрос: все страницы
-        "apnamespace": 0,           # только статьи
-        "aplimit": requests_limit,  # максимальное число страниц за запрос
-        "format": "json"
+        "generator": "allpages",     # запрос: все страницы
+        "gapnamespace": 0,           # только статьи
+        "gaplimit": requests_limit,  # максимальное число страниц за запрос
+        "prop": "info",              # вместе с id последней ревизии
+        "format": "json",
+        **cursor
     }
 
-    iteration = 0
-    file_index = 0
-    is_pages_remaining = True
+    data = client.get(params)
 
-    while is_pages_remaining:
-        response = requests.get(config.WIKI_API_URL, params=params)
-        response.raise_for_status()
-        
-        data = response.json()
+    pages = [
+        {"pageid": p["pageid"], "title": p["title"], "revid": p["lastrevid"]}
+        for p in data.get("query", {}).get("pages", {}).values()
+    ]
 
-        pages.extend(data["query"]["allpages"])
+    # Генератор отдает страницы словарем, восстанавливаем порядок allpages (по названию)
+    pages.sort(key=lambda p: p["title"])
 
-        iteration += 1
-        print(f"\t Iteration {iteration}. Fetched {len(data['query']['allpages'])} titles.")
+    return pages, data.get("continue")
+
+
+def save_wiki(pages_per_file=5000, requests_limit=500, restart=False):
+    """
+    Загружает и сохраняет содержимое всех страниц вики, разбивая на файлы по pages_per_file страниц.
+    Прогресс сохраняется в config.WIKI_STATE_PATH, прерванная загрузка продолжается с места остановки.
+    """
+    if not os.path.exists(config.DATA_PATH):
+        os.mkdir(config.DATA_PATH)
+
+    state = None if restart else load_crawl_state()
+
+    if restart:
+        # Иначе CorpusWriter найдет страницы в старых индексах батчей и пропустит их как уже записанные
+        file_index = 0
+        while (filename := corpus.find_batch_file(file_index)) is not None:
+            corpus.remove_batch_file(filename)
+            if corpus.find_batch_file(file_index) is None:
+                file_index += 1
+
+    if state is None:
+        state = new_crawl_state()
+    elif state["listing_done"] and not state["pending"]:
+        print("Wiki is already fetched. Use --delta to fetch changed pages or --restart to fetch everything again")
+        return
+    else:
+        print(f"Resuming fetch from batch {state['file_index']}")
+
+    print("Fetching wiki pages...")
 
-        # Если набралось pages_per_file страниц, то начинаем извлекать текст статей и сохраняем их в новый файл
-        if len(pages) >= pages_per_file:
+    client = WikiClient()
+    iteration = 0
+
+    while True:
+        # Если набралось pages_per_file страниц (или список закончился), то извлекаем текст статей и сохраняем их в новый файл
+        if state["pending"] and (len(state["pending"]) >= pages_per_file or state["listing_done"]):
             print("\t\tFetching pages content...")
 
-            filename = f"{config.DATA_PATH}/wiki_pages_{file_index}.json"
-            fetch_all_pages_content(pages, filename)
+            filename = corpus.batch_filename(state["file_index"])
+            revisions = fetch_all_pages_content(state["pending"], filename, client)
+
+            print(f"\t\t{len(revisions)} pages saved to {filename}")
+
+            for page_id, revid in revisions.items():
+                state["pages"][str(page_id)] = {"revid": revid, "file": state["file_index"]}
+
+            state["file_index"] += 1
+            state["pending"] = []  # очищаем список страниц после сохранения
+            save_crawl_state(state)
+
+        if state["listing_done"]:
+            break
+
+        pages, cursor = list_pages(client, state["continue"], requests_limit)
 
-            print(f"\t\tNext {pages_per_file} saved to {filename}")
+        iteration += 1
+        print(f"\t Iteration {iteration}. Fetched {len(pages)} titles.")
 
-            file_index += 1
-            pages = []  # очищаем список страниц после сохранения
+        state["pending"].extend(pages)
 
         # Проверяем, есть ли ещё страницы для загрузки
-        if "continue" in data:
-            params.update(data["continue"])  # обновляем параметры для следующего запроса
-            time.sleep(0.5)  # не спамим
+        state["continue"] = cursor or {}
+        state["listing_done"] = cursor is None
+        save_crawl_state(state)
+
+    print("All done!")
+
+def update_wiki(pages_per_file=5000, requests_limit=500):
+    """
+    Догружает изменения вики с прошлой загрузки: сравнивает id последних ревизий страниц с сохраненными
+    и скачивает только новые и изменившиеся страницы. Измененные страницы переписываются в своих файлах батчей,
+    удаленные из вики страницы удаляются, новые страницы записываются в новый файл батча.
+    """
+    state = load_crawl_state()
+
+    if state is None or not state["listing_done"] or state["pending"]:
+        print("Full fetch is not finished yet. Run without --delta first")
+        return
+
+    client = WikiClient()
+
+    print("Fetching wiki revisions...")
+
+    listed_pages = []
+    cursor = {}
+    while cursor is not None:
+        pages, cursor = list_pages(client, cursor, requests_limit)
+        listed_pages.extend(pages)
+
+    stored_pages = state["pages"]
+    listed_ids = {str(p["pageid"]) for p in listed_pages}
+
+    changed_pages = [
+        p for p in listed_pages
+        if stored_pages.get(str(p["pageid"]), {}).get("revid") != p["revid"]
+    ]
+    removed_ids = stored_pages.keys() - listed_ids
+
+    print(f"\t{len(changed_pages)} pages changed, {len(removed_ids)} pages removed")
+
+    # Группируем изменения по файлам батчей; новые страницы пишем в новые файлы
+    changes_by_file = {}
+    new_pages = []
+
+    for page_id in removed_ids:
+        changes_by_file.setdefault(stored_pages[page_id]["file"], {})[int(page_id)] = None
+
+    fetched_pages = [page for group in fetch_pages_groups(changed_pages, client) for page in group]
+    fetched_ids = {str(p["id"]) for p in fetched_pages}
+
+    for page in fetched_pages:
+        stored_page = stored_pages.get(str(page["id"]))
+
+        if stored_page is None:
+            new_pages.append(page)
         else:
-            is_pages_remaining = False  # все страницы загружены
-    
-    if pages:
-        # Сохраняем оставшиеся страницы, если они есть
-        print("\t\tFetching remaining pages content...")
+            changes_by_file.setdefault(stored_page["file"], {})[page["id"]] = page
+
+    # Страницы, у которых пропал текст, удаляем так же, как удаленные
+    for page in changed_pages:
+        page_id = str(page["pageid"])
+        if page_id not in fetched_ids and page_id in stored_pages:
+            changes_by_file.setdefault(stored_pages[page_id]["file"], {})[page["pageid"]] = None
+
+    def apply_changes(file_pages, changes):
+        for page in file_pages:
+            if page["id"] not in changes:
+                yield page
+            elif changes[page["id"]] is not None:
+                changed_page = changes[page["id"]]
+                yield {"id": changed_page["id"], "title": changed_page["title"], "text": changed_page["text"]}
+
+    for file_index, changes in sorted(changes_by_file.items()):
+        old_filename = corpus.find_batch_file(file_index)
+        filename = corpus.batch_filename(file_index)
 
-        filename = f"{config.DATA_PATH}/wiki_pages_{file_index}.json"
-        fetch_all_pages_content(pages, filename)
+        # Файл переписывается потоково; старый формат заодно переводится в текущий
+        corpus.write_pages(filename, apply_changes(corpus.iter_pages(old_filename), changes))
 
-        print(f"\t\tRemaining {len(pages)} saved to {filename}")
+        if old_filename != filename:
+            corpus.remove_batch_file(old_filename)
+
+        for page_id, page in changes.items():
+            if page is None:
+                stored_pages.pop(str(page_id), None)
+            else:
+                stored_pages[str(page_id)] = {"revid": page["revid"], "file": file_index}
+
+        save_crawl_state(state)
+        print(f"\t\tUpdated {len(changes)} pages in {filename}")
+
+    for start in range(0, len(new_pages), pages_per_file):
+        batch = new_pages[start:start + pages_per_file]
+        filename = corpus.batch_filename(state["file_index"])
+
+        corpus.write_pages(filename, ({"id": p["id"], "title": p["title"], "text": p["text"]} for p in batch))
+
+        for page in batch:
+            stored_pages[str(page["id"])] = {"revid": page["revid"], "file": state["file_index"]}
+
+        state["file_index"] += 1
+        save_crawl_state(state)
+        print(f"\t\t{len(batch)} new pages saved to {filename}")
 
     print("All done!")
 
-save_wiki(pages_per_file=1000, requests_limit=500)
+
+def cli_arguments_preprocess():
+    parser = ArgumentParser(description="A script for fetching S.T.A.L.K.E.R. wiki pages into the data directory")
+
+    parser.add_argument("--pages_per_file", required=False, type=int, default=1000,
+                        help="Number of pages in one batch file")
+
+    parser.add_argument("--requests_limit", required=False, type=int, default=500,
+                        help="Number of page titles fetched per allpages request")
+
+    parser.add_argument("--delta", action="store_true",
+                        help="Fetch only pages changed since the last fetch")
+
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore saved progress and fetch the whole wiki again")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = cli_arguments_preprocess()
+
+    if args.delta:
+        update_wiki(pages_per_file=args.pages_per_file, requests_limit=args.requests_limit)
+    else:
+        save_wiki(pages_per_file=args.pages_per_file, requests_limit=args.requests_limit, restart=args.restart)